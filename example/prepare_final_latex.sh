@@ -13,56 +13,41 @@ set -e  # exit when any command fails
 >>>> source "/path/to/script/environment/bin/activate"
 >>>> root= "/path/to/paper/"
 
-echo "Remove previously flattened files..."
-rm -rf "$root/flat-latex"/*
-
-# Remove comments from sources
-echo "Removing comments from sources..."
->>>> arxiv_latex_cleaner "$root/subdir"  # Creates meso_inference_arXiv directory
-# Copy the .bib file arxiv_latex_cleaner forgot
->>>> cp "$root/subdir/bibliography.bib" "$root/subdir_arXiv/bibliography.bib"
-
-# Combine all source files and expand macros
+# Combine all source files, expand macros and remove comments
+# (--incremental only updates the files of flat-latex which changed since the
+# last run, and removes those which are no longer used)
 echo "Combining source files and expanding macros..."
->>>> cd "$root/subdir_arXiv"
+>>>> cd "$root/subdir"
 # Don't rename figures - we need to copy .eps files first
-expand-latex-macros --renamefigs="" main.tex "$root/flat-latex"
-# Remove the temporary directory created by arxiv_latex_cleaner
+expand-latex-macros --incremental --strip-comments --renamefigs="" main.tex "$root/flat-latex"
 cd "$root"
->>>> rm -r "$root/subdir_arXiv"
 
 # Manage EPS figures
 # Copy the .eps files (flat-latex only copies .pdf figures)
 echo "Copying .eps files into flattened directory..."
->>>> python "$root/cp_eps_files.py" "$root/flat-latex" "$root/subdir/figures"
+>>>> cp-eps "$root/flat-latex" "$root/subdir/figures"
 cd "$root/flat-latex"
 # Convert the .eps files to CMYK
 echo "Converting .eps files to CMYK..."
 convert-to-cmyk --format eps --in-place "$root/flat-latex"
 
-# Rename figures
-echo "Renaming figures to the journal's format..."
-rename-figures --renamestr="$figprefix" --start=1 --figexts="eps" "$root/flat-latex/merged-clean.tex"
-
-# Embed bibliography
 # Remove underscore from bib filename
-echo "Removing underscore from bibliography filename to avoid compilation error..."
 # flap adds underscores to filenames in subdirs, which is illegal for the bibliography
->>>> mv folder_bibliography.bib folder-bibliography.bib
->>>> sed -i "s/\\\\bibliography{folder_bibliography}/\\\\bibliography{folder-bibliography}/g" merged-clean.renamed.tex
+echo "Removing underscore from bibliography filename to avoid compilation error..."
+postprocess-latex --fix-bib merged-clean.tex merged-clean.tex
 # Create the bbl file
-echo "Compiling source with \`latex merged-clean.renamed.tex\`..."
-latex merged-clean.renamed.tex
-rm merged-clean.renamed.dvi
-echo "Compiling references with \`bibtex merged-clean.renamed.aux\`..."
-bibtex merged-clean.renamed.aux
-# Embed the .bbl file into the .tex
-echo "Embedding .bbl file with \`python ../substitute_bib.py \"merged-clean.renamed\"\`..."
->>>> python ../substitute_bib.py "merged-clean.renamed"
-
-# Rename source to set the text in title bar
-# (This might not actually do anything…)
-mv merged-clean.renamed.embedbib.tex "$finalpdftitle.tex"
+echo "Compiling source with \`latex merged-clean.tex\`..."
+latex merged-clean.tex
+rm merged-clean.dvi
+echo "Compiling references with \`bibtex merged-clean.aux\`..."
+bibtex merged-clean.aux
+
+# Rename figures to the journal's format and embed the bibliography, in one
+# pass. The output name sets the text in title bar (this might not actually
+# do anything…)
+echo "Renaming figures and embedding the bibliography..."
+postprocess-latex --renamestr="$figprefix" --start=1 --figexts="eps" \
+    --embed-bbl merged-clean.bbl merged-clean.tex "$finalpdftitle.tex"
 
 # Compile final document
 # Compile thrice to ensure all refs are OK
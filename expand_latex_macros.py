@@ -81,7 +81,9 @@ then remove all *-clean.tex files!
 
 """
 
-import sys, os, re, shelve
+import sys, os, io, re, shelve, pickle, hashlib, contextlib, copy, types
+import zlib
+import collections
 from warnings import warn
 from pathlib import Path
 import shutil
@@ -106,6 +108,26 @@ class ArgumentError(RuntimeError):
 class ParsingError(ValueError):
     pass
 
+class Cyclic_definition_error(ParsingError):
+    """Exception raised when macro definitions use each other in a cycle.
+
+    Attributes:
+        cycle -- names of the macros in the cycle; the first one is repeated
+                 at the end
+    """
+
+    def __init__(self, cycle):
+        self.cycle = cycle
+        super().__init__("Cyclic macro definitions: " + " -> ".join(cycle))
+
+class Incomplete_call(Exception):
+    """Raised by the compiled engine when a macro call runs past the end of
+    the tokens being expanded."""
+
+class Unresolvable_call(Exception):
+    """Raised by the compiled engine when a macro call cannot be expanded in
+    a single substitution pass."""
+
 class Empty_text_error(ValueError):
     """Exception raised for errors in the input.
 
@@ -118,6 +140,115 @@ class Empty_text_error(ValueError):
         self.data = data
         self.message = message
 
+class Expansion_limit_error(RuntimeError):
+    """Exception raised when an expansion exceeds its Expansion_budget.
+
+    Attributes:
+        macro -- name of the macro being expanded (environments as {name}),
+                 or None
+        limit -- name of the exceeded limit
+    """
+
+    def __init__(self, message, macro=None, limit=None):
+        self.macro = macro
+        self.limit = limit
+        super().__init__(message)
+
+    def __reduce__(self):  # Keep the attributes across worker processes
+        return (type(self), (str(self), self.macro, self.limit))
+
+class Expansion_cancelled(Expansion_limit_error):
+    """Exception raised when an expansion is cancelled by its caller."""
+
+class Expansion_budget:
+    """
+    Limits on an expansion, to protect against macro bombs and runaway
+    output. They are checked each time a macro is expanded, and the time and
+    cancellation also for each chunk of output (None means no limit):
+
+      max_expansions   -- number of macro expansions
+      max_ratio        -- tokens produced by all expansions (nested ones
+                          included) per token tokenized
+      max_seconds      -- wall-clock time since the budget was created
+      max_macro_tokens -- tokens produced by a single expansion
+
+    `cancel` may be called from another thread to stop the expansion, which
+    then raises Expansion_cancelled.
+    A budget is meant for a single expansion; in worker processes (see
+    Tex_stream.jobs), each process gets its own copy of the limits.
+    """
+    def __init__(self, max_expansions=None, max_ratio=None, max_seconds=None,
+                 max_macro_tokens=None):
+        import threading, time
+        self.max_expansions = max_expansions
+        self.max_ratio = max_ratio
+        self.max_seconds = max_seconds
+        self.max_macro_tokens = max_macro_tokens
+        self.expansions = 0
+        self.produced = 0
+        self.input_tokens = 0
+        self.started = time.monotonic()
+        self._cancelled = threading.Event()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_cancelled"] = self._cancelled.is_set()
+        return state
+
+    def __setstate__(self, state):
+        import threading
+        cancelled = state.pop("_cancelled")
+        self.__dict__.update(state)
+        self._cancelled = threading.Event()
+        if cancelled:
+            self._cancelled.set()
+
+    def cancel(self):
+        self._cancelled.set()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def add_input(self, ntokens):
+        self.input_tokens += ntokens
+
+    def check(self, macro=None):
+        "Raise if the expansion was cancelled or ran out of time."
+        import time
+        if self._cancelled.is_set():
+            raise Expansion_cancelled("Expansion cancelled", macro, "cancel")
+        if (self.max_seconds is not None
+            and time.monotonic() - self.started > self.max_seconds):
+            where = " (while expanding %s)" % (macro) if macro else ""
+            raise Expansion_limit_error(
+                "Expansion took more than %g s%s" % (self.max_seconds, where),
+                macro, "max_seconds")
+
+    def charge(self, macro, ntokens):
+        "Account for an expansion of macro which produced ntokens tokens."
+        self.expansions += 1
+        self.produced += ntokens
+        if (self.max_macro_tokens is not None
+            and ntokens > self.max_macro_tokens):
+            raise Expansion_limit_error(
+                "Expansion of %s produced %d tokens, more than the limit of "
+                "%d tokens per macro" % (macro, ntokens, self.max_macro_tokens),
+                macro, "max_macro_tokens")
+        if (self.max_expansions is not None
+            and self.expansions > self.max_expansions):
+            raise Expansion_limit_error(
+                "More than %d macro expansions (the last one of %s)"
+                % (self.max_expansions, macro), macro, "max_expansions")
+        if (self.max_ratio is not None and self.input_tokens
+            and self.produced > self.max_ratio * self.input_tokens):
+            raise Expansion_limit_error(
+                "Expansions produced %d tokens for %d input tokens, more than "
+                "the limit ratio of %g (the last one of %s)"
+                % (self.produced, self.input_tokens, self.max_ratio, macro),
+                macro, "max_ratio")
+        self.check(macro)
+
 def die(error_message, exception):
     emsg = str(exception)
     if len(emsg) > 0:
@@ -164,6 +295,773 @@ def cut_extension(filename, ext):
         file = file[:index]
     return file
 
+def read_tex_file(filename):
+    """
+    Return the content of filename as a string, with its newlines
+    translated as in text mode.
+    The string is decoded from a memory map of the file, which saves
+    reading the bytes into a buffer first; the whole string is built all
+    the same, so the peak memory is that of the decoded text.
+    """
+    import mmap, locale
+    with open(filename, "rb") as fp:
+        if os.fstat(fp.fileno()).st_size == 0:
+            return ""
+        with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            text = str(mm, locale.getpreferredencoding(False))
+    if "\r" in text:
+        # Same newline translation as a file opened in text mode
+        text = text.replace("\r\n", "\n").replace("\r", "\n")
+    return text
+
+def copy_file_into(filename, fp, chunk_size=1 << 16):
+    """
+    Append the content of filename to the open file object fp, with its
+    newlines translated as by read_tex_file.
+    If fp is a real file and filename has no carriage return, the copy is
+    done by the kernel (zero-copy); otherwise it is done in chunks of
+    chunk_size characters.
+    """
+    import mmap
+    try:
+        out_fd = fp.fileno()
+    except (AttributeError, io.UnsupportedOperation):
+        out_fd = None
+    if out_fd is not None and hasattr(os, "sendfile"):
+        with open(filename, "rb") as in_fp:
+            in_fd = in_fp.fileno()
+            size = os.fstat(in_fd).st_size
+            if size == 0:
+                return
+            with mmap.mmap(in_fd, 0, access=mmap.ACCESS_READ) as mm:
+                # The raw bytes only need no translation without a \r
+                raw = mm.find(b"\r") < 0
+            if raw:
+                fp.flush()
+                offset = 0
+                try:
+                    while offset < size:
+                        sent = os.sendfile(out_fd, in_fd, offset,
+                                           size - offset)
+                        if sent == 0:
+                            break
+                        offset += sent
+                    return
+                except OSError:
+                    if offset:
+                        raise
+                    # sendfile not supported for these files; fall back
+    with open(filename, "r") as in_fp:
+        shutil.copyfileobj(in_fp, fp, chunk_size)
+
+
+def atomic_write(filename, data):
+    """
+    Write data (bytes) to filename, such that concurrent readers see either
+    the old or the new content, never a partial file.
+    """
+    import tempfile
+    directory = os.path.dirname(os.path.abspath(filename))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmpname = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as fp:
+            fp.write(data)
+        os.replace(tmpname, filename)
+    except BaseException:
+        if os.path.exists(tmpname):
+            os.remove(tmpname)
+        raise
+
+def file_hash(filename, chunk_size=1 << 16):
+    "Return the sha256 digest of the content of filename."
+    h = hashlib.sha256()
+    with open(filename, "rb") as fp:
+        for block in iter(lambda: fp.read(chunk_size), b""):
+            h.update(block)
+    return h.digest()
+
+def same_content(filename1, filename2):
+    "Whether two existing files have the same content."
+    if os.path.getsize(filename1) != os.path.getsize(filename2):
+        return False
+    return file_hash(filename1) == file_hash(filename2)
+
+class Output_summary:
+    """
+    Record which outputs of a run were actually touched, and which were left
+    alone because their content did not change.
+    """
+    def __init__(self):
+        self.written = []
+        self.unchanged = []
+        self.moved = []
+        self.removed = []
+
+    def add(self, filename, changed):
+        (self.written if changed else self.unchanged).append(str(filename))
+
+    def report(self, fp=None):
+        fp = sys.stdout if fp is None else fp
+        fp.write("Outputs: %d written, %d unchanged, %d figures moved, "
+                 "%d removed\n"
+                 % (len(self.written), len(self.unchanged), len(self.moved),
+                    len(self.removed)))
+        for filename in self.written:
+            fp.write("  written: %s\n" % (filename))
+        for src, dst in self.moved:
+            fp.write("  moved: %s -> %s\n" % (src, dst))
+        for filename in self.removed:
+            fp.write("  removed: %s\n" % (filename))
+
+def _stat_key(filename):
+    "Return [size, mtime in ns] of filename, or None if it does not exist."
+    try:
+        st = os.stat(filename)
+    except OSError:
+        return None
+    return [st.st_size, st.st_mtime_ns]
+
+class Output_manifest:
+    """
+    Record of the files placed in an output directory by the previous run,
+    so that the next one only touches those which changed.
+    For each file (by its path relative to the directory), it stores its
+    source (None for generated files), the sha256 of its content, and the
+    size and mtime of the source and of the placed file; if the file was
+    then renamed (see Rename_figures), also its new name, in "renamed", and
+    the stat is that of the renamed file.
+    """
+    filename = ".expand-latex-macros-manifest.json"
+    version = 1
+
+    def __init__(self, directory):
+        import json
+        self.directory = os.path.abspath(directory)
+        self.path = os.path.join(self.directory, self.filename)
+        try:
+            with open(self.path) as fp:
+                data = json.load(fp)
+        except (OSError, ValueError):
+            data = {}
+        if data.get("version") != self.version:
+            data = {}
+        self.entries = data.get("files", {})
+
+    def name(self, target):
+        return os.path.relpath(os.path.abspath(target), self.directory)
+
+    def up_to_date(self, name, source, path=None):
+        """Whether the file name was placed from source, and neither has
+        changed since, judging by their size and mtime. path is where the
+        placed file is, if not at name.
+        """
+        entry = self.entries.get(name)
+        if path is None:
+            path = os.path.join(self.directory, name)
+        return (entry is not None
+                and os.path.abspath(source) == entry["source"]
+                and _stat_key(source) == entry["source_stat"]
+                and _stat_key(path) == entry["stat"])
+
+    def renamed_file(self, name, source):
+        """Return the path to which the file name, placed from source, was
+        renamed, if neither has changed since; otherwise None."""
+        entry = self.entries.get(name)
+        if entry is None or entry.get("renamed") is None:
+            return None
+        path = os.path.join(self.directory, entry["renamed"])
+        return path if self.up_to_date(name, source, path) else None
+
+    def record(self, name, source, digest):
+        self.entries[name] = {
+            "source": None if source is None else os.path.abspath(source),
+            "source_stat": None if source is None else _stat_key(source),
+            "sha256": digest,
+            "stat": _stat_key(os.path.join(self.directory, name))}
+
+    def save(self):
+        import json
+        atomic_write(self.path, json.dumps(
+            {"version": self.version, "files": self.entries},
+            indent=1, sort_keys=True).encode())
+
+def current_rss():
+    """
+    Return the resident set size of this process in bytes, or None where it
+    cannot be read (it is read from /proc, so only on Linux).
+    """
+    try:
+        with open("/proc/self/statm") as fp:
+            return int(fp.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+class Memory_profiler:
+    """
+    Record the memory used by each stage of a run, with tracemalloc and by
+    sampling the RSS from a background thread. When not enabled, stages
+    cost nothing.
+
+    Stages may nest (e.g. definitions are loaded during tokenization); the
+    memory of a stage includes that of its sub-stages. For each stage, the
+    report gives the traced memory at its start and end, its peak, and the
+    top allocation sites of the memory it retained.
+    """
+    def __init__(self, enabled=False, top=10, interval=0.01):
+        self.enabled = enabled
+        self.top = top
+        self.interval = interval
+        self.stages = []
+        self._open = []
+        self._sampler = None
+
+    def start(self):
+        if not self.enabled:
+            return
+        import threading, tracemalloc
+        tracemalloc.start()
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._sampler = threading.Thread(target=self._sample, daemon=True)
+        self._sampler.start()
+
+    def stop(self):
+        if self._sampler is None:
+            return
+        import tracemalloc
+        self._stopped.set()
+        self._sampler.join()
+        self._sampler = None
+        tracemalloc.stop()
+
+    def _sample(self):
+        while not self._stopped.wait(self.interval):
+            rss = current_rss()
+            if rss is None:
+                return
+            with self._lock:
+                for stage in self._open:
+                    stage["rss_peak"] = max(stage["rss_peak"], rss)
+
+    def _snapshot(self):
+        import tracemalloc
+        return tracemalloc.take_snapshot().filter_traces(
+            [tracemalloc.Filter(False, tracemalloc.__file__),
+             tracemalloc.Filter(False, "<frozen importlib._bootstrap*>")])
+
+    def _update_peaks(self):
+        import tracemalloc
+        peak = tracemalloc.get_traced_memory()[1]
+        for stage in self._open:
+            stage["traced_peak"] = max(stage["traced_peak"], peak)
+
+    @contextlib.contextmanager
+    def stage(self, name, file=None):
+        if self._sampler is None:
+            yield
+            return
+        import time, tracemalloc
+        before = self._snapshot()
+        rss = current_rss()
+        stage = {"stage": name, "file": None if file is None else str(file),
+                 "traced_start": tracemalloc.get_traced_memory()[0],
+                 "traced_peak": 0, "rss_start": rss, "rss_peak": rss or 0}
+        with self._lock:
+            self._update_peaks()
+            if hasattr(tracemalloc, "reset_peak"):  # Python >= 3.9
+                tracemalloc.reset_peak()
+            self._open.append(stage)
+            self.stages.append(stage)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            stage["seconds"] = time.perf_counter() - start
+            with self._lock:
+                self._update_peaks()
+                self._open.remove(stage)
+            stage["traced_end"] = tracemalloc.get_traced_memory()[0]
+            stage["traced_retained"] = (stage["traced_end"]
+                                        - stage["traced_start"])
+            stage["rss_end"] = rss = current_rss()
+            if rss is None:
+                stage["rss_peak"] = None
+            else:
+                stage["rss_peak"] = max(stage["rss_peak"], rss)
+            stats = self._snapshot().compare_to(before, "lineno")
+            stage["top_allocations"] = [
+                {"site": "%s:%d" % (stat.traceback[0].filename,
+                                    stat.traceback[0].lineno),
+                 "size": stat.size, "size_diff": stat.size_diff,
+                 "count_diff": stat.count_diff}
+                for stat in stats[:self.top]]
+
+    def report(self):
+        return {"version": 1, "stages": self.stages}
+
+    def write_report(self, filename):
+        import json
+        with open(filename, "w") as fp:
+            json.dump(self.report(), fp, indent=2)
+
+class Time_profiler:
+    """
+    Time each stage of a run, with the same stages as Memory_profiler.
+    The run may also be profiled with cProfile (see `write_pstats`), and by
+    sampling the stack of the profiled thread every `interval` seconds (see
+    `write_collapsed`). When not enabled, stages cost nothing.
+
+    Stages may nest; the time of a stage includes that of its sub-stages,
+    and the totals of the report only count the outermost stage of each
+    name, so that they don't count nested stages twice.
+    """
+    def __init__(self, enabled=False, cprofile=False, sample=False,
+                 interval=0.001):
+        self.enabled = enabled
+        self.cprofile = cprofile
+        self.sample = sample
+        self.interval = interval
+        self.stages = []
+        self.samples = collections.Counter()
+        self.seconds = None
+        self._open = []
+        self._start = None
+        self._profile = None
+        self._sampler = None
+
+    def start(self):
+        if not self.enabled:
+            return
+        import threading, time
+        self._start = time.perf_counter()
+        if self.sample:
+            self._thread = threading.get_ident()
+            self._stopped = threading.Event()
+            self._sampler = threading.Thread(target=self._sample, daemon=True)
+            self._sampler.start()
+        if self.cprofile:
+            import cProfile
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+
+    def stop(self):
+        if self._start is None:
+            return
+        import time
+        if self._profile is not None:
+            self._profile.disable()
+        if self._sampler is not None:
+            self._stopped.set()
+            self._sampler.join()
+            self._sampler = None
+        self.seconds = time.perf_counter() - self._start
+        self._start = None
+
+    def _sample(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self._thread)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append("%s (%s:%d)" % (code.co_name,
+                                             os.path.basename(code.co_filename),
+                                             code.co_firstlineno))
+                frame = frame.f_back
+            # Frames are rooted at the open stages
+            stages = ["[%s]" % (stage["stage"]) for stage in list(self._open)]
+            self.samples[";".join(stages + stack[::-1])] += 1
+
+    @contextlib.contextmanager
+    def stage(self, name, file=None):
+        if self._start is None:
+            yield
+            return
+        import time
+        start = time.perf_counter()
+        stage = {"stage": name, "file": None if file is None else str(file),
+                 "start": start - self._start, "depth": len(self._open),
+                 "nested": any(name == s["stage"] for s in self._open)}
+        self._open.append(stage)
+        self.stages.append(stage)
+        try:
+            yield
+        finally:
+            stage["seconds"] = time.perf_counter() - start
+            self._open.remove(stage)
+
+    def report(self):
+        totals = {}
+        for stage in self.stages:
+            if stage["nested"] or "seconds" not in stage:
+                continue
+            total = totals.setdefault(stage["stage"],
+                                      {"seconds": 0., "count": 0})
+            total["seconds"] += stage["seconds"]
+            total["count"] += 1
+        return {"version": 1, "seconds": self.seconds, "totals": totals,
+                "stages": self.stages}
+
+    def write_report(self, filename):
+        import json
+        with open(filename, "w") as fp:
+            json.dump(self.report(), fp, indent=2)
+
+    def write_pstats(self, filename):
+        "Write the cProfile statistics, to be read with pstats."
+        self._profile.dump_stats(filename)
+
+    def write_collapsed(self, filename):
+        "Write the sampled stacks in the collapsed format of flamegraph tools."
+        with open(filename, "w") as fp:
+            for stack, count in sorted(self.samples.items()):
+                fp.write("%s %d\n" % (stack, count))
+
+class Profiler_group:
+    "Several profilers (like Memory_profiler) used as one."
+    def __init__(self, *profilers):
+        self.profilers = profilers
+
+    def start(self):
+        for profiler in self.profilers:
+            profiler.start()
+
+    def stop(self):
+        for profiler in reversed(self.profilers):
+            profiler.stop()
+
+    @contextlib.contextmanager
+    def stage(self, name, file=None):
+        # The first profilers are the outermost: their own cost is not
+        # counted by the following ones
+        with contextlib.ExitStack() as stack:
+            for profiler in self.profilers:
+                stack.enter_context(profiler.stage(name, file))
+            yield
+
+@contextlib.contextmanager
+def output_file(filename, summary=None, buffering=-1):
+    """
+    Open filename for writing text, but only replace it if the new content
+    differs from the existing one: the content is written to a temporary
+    file, whose hash is compared to that of filename. Unchanged files keep
+    their mtime, so that make-like tools don't rebuild what depends on them.
+    The outcome is recorded in summary, if given.
+    """
+    filename = str(filename)
+    tmpname = "%s.%d.tmp" % (filename, os.getpid())
+    try:
+        with open(tmpname, "w", buffering=buffering) as fp:
+            yield fp
+        changed = not (os.path.isfile(filename)
+                       and same_content(tmpname, filename))
+        if changed:
+            os.replace(tmpname, filename)
+    finally:
+        if os.path.exists(tmpname):
+            os.remove(tmpname)
+    if summary is not None:
+        summary.add(filename, changed)
+
+def move_if_changed(src, dst, summary=None):
+    """
+    Move src to dst, unless dst already has the same content: src is then
+    simply removed, and dst keeps its mtime.
+    """
+    if os.path.isfile(dst) and same_content(src, dst):
+        os.remove(src)
+    else:
+        Path(src).replace(dst)
+        if summary is not None:
+            summary.moved.append((str(src), str(dst)))
+
+def _reflink(src, dst):
+    """
+    Create dst as a copy-on-write clone of src, sharing its data blocks, on
+    file systems which support it (FICLONE on Linux: btrfs, XFS, ...).
+    Return whether it succeeded; dst is not left behind if it did not.
+    """
+    try:
+        import fcntl
+    except ImportError:
+        return False
+    FICLONE = 0x40049409
+    try:
+        with open(src, "rb") as src_fp, open(dst, "xb") as dst_fp:
+            fcntl.ioctl(dst_fp.fileno(), FICLONE, src_fp.fileno())
+        return True
+    except OSError:
+        if os.path.exists(dst):
+            os.remove(dst)
+        return False
+
+def place_file(src, dst, hardlink=True):
+    """
+    Place a copy of src at dst without copying bytes when possible: dst is a
+    reflink (copy-on-write clone) of src, or if the file system does not
+    support reflinks and hardlink is true, a hard link to it. If src and dst
+    are on different file systems, src is copied.
+    Return the method used: "reflink", "hardlink", "copy", or "same" if dst
+    already is src.
+    A hard link shares its content with src, so the tools writing to dst
+    must replace it rather than modify it in place (as all the commands of
+    this package do).
+    """
+    import threading
+    src, dst = str(src), str(dst)
+    if os.path.exists(dst) and os.path.samefile(src, dst):
+        return "same"
+    # dst is replaced atomically, and never modified in place (it may be a
+    # hard link to a file placed before)
+    tmpname = "%s.%d-%d.tmp" % (dst, os.getpid(), threading.get_ident())
+    try:
+        if _reflink(src, tmpname):
+            method = "reflink"
+        else:
+            try:
+                if not hardlink:
+                    raise OSError("hard links disabled")
+                os.link(src, tmpname)
+                method = "hardlink"
+            except OSError:
+                shutil.copyfile(src, tmpname)
+                method = "copy"
+        os.replace(tmpname, dst)
+    finally:
+        if os.path.exists(tmpname):
+            os.remove(tmpname)
+    return method
+
+@contextlib.contextmanager
+def file_lock(filename):
+    """
+    Hold an exclusive lock on filename (created if needed) for the duration
+    of the block. Without fcntl (e.g. on Windows), this does nothing.
+    """
+    try:
+        import fcntl
+    except ImportError:
+        yield
+        return
+    os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+    with open(filename, "a") as fp:
+        fcntl.flock(fp.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fp.fileno(), fcntl.LOCK_UN)
+
+def default_cache_dir():
+    """
+    Return the user-level cache directory: $EXPAND_LATEX_MACROS_CACHE if set,
+    otherwise expand-latex-macros in $XDG_CACHE_HOME or ~/.cache.
+    """
+    if os.environ.get("EXPAND_LATEX_MACROS_CACHE"):
+        return Path(os.environ["EXPAND_LATEX_MACROS_CACHE"])
+    base = os.environ.get("XDG_CACHE_HOME") or Path.home()/".cache"
+    return Path(base)/"expand-latex-macros"
+
+class Defs_cache:
+    """Compiled definitions, shared across projects and keyed by the hash of
+    the content of each definitions file, so that a file is parsed once
+    per user rather than once per project.
+
+    Entries are written atomically, and a lock file per entry makes
+    concurrent processes wait for a single parse instead of repeating it.
+    """
+    version = 1  # Increase when the pickled format changes
+
+    def __init__(self, directory=None):
+        if directory is None:
+            directory = default_cache_dir()
+        self.directory = Path(directory)/"defs"
+
+    def key(self, content):
+        return hashlib.sha256(
+            ("%d\0%s" % (self.version, content)).encode()).hexdigest()
+
+    def get(self, key):
+        "Return the cached definitions for key, or None."
+        try:
+            with open(self.directory/(key + ".pickle"), "rb") as fp:
+                return pickle.load(fp)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            warn(f"Ignoring unreadable cache entry {key}: {e}")
+            return None
+
+    def put(self, key, defs):
+        atomic_write(self.directory/(key + ".pickle"),
+                     pickle.dumps(defs, pickle.HIGHEST_PROTOCOL))
+
+    def lock(self, key):
+        return file_lock(self.directory/(key + ".lock"))
+
+class Token_cache:
+    r"""Tokenized files, keyed by the hash of their content (and of the
+    tokenizer version and settings), so that a file whose text did not
+    change is not tokenized again, e.g. when only definitions are edited.
+
+    An entry holds the token types and values, zlib-compressed, and the
+    private packages and \input files met while tokenizing, which must be
+    loaded or processed again when the entry is used. The least recently
+    used entries beyond max_entries are removed.
+    """
+    version = 2  # Increase when the tokenizer or the pickled format changes
+
+    def __init__(self, directory=None, max_entries=32):
+        if directory is None:
+            directory = default_cache_dir()
+        self.directory = Path(directory)/"tokens"
+        self.max_entries = max_entries
+
+    def key(self, content, strip_comments=False):
+        return hashlib.sha256(
+            ("%d\0%d\0%s" % (self.version, strip_comments, content)
+             ).encode()).hexdigest()
+
+    def get(self, key):
+        """Return the cached (tokens, events, isatletter) for key, or None.
+        Equal tokens are shared, which they can be since they are never
+        modified."""
+        filename = self.directory/(key + ".pickle")
+        try:
+            with open(filename, "rb") as fp:
+                types, vals, events, isatletter = pickle.loads(
+                    zlib.decompress(fp.read()))
+            os.utime(filename)  # Mark the entry as recently used
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            warn(f"Ignoring unreadable cache entry {key}: {e}")
+            return None
+        shared = {}
+        tokens = []
+        for type_v, val in zip(types, vals):
+            token = shared.get((type_v, val))
+            if token is None:
+                token = shared[type_v, val] = Token(type_v, val)
+            tokens.append(token)
+        return tokens, events, isatletter
+
+    def put(self, key, tokens, events, isatletter):
+        types = bytes(token.type for token in tokens)
+        vals = [token.val for token in tokens]
+        atomic_write(self.directory/(key + ".pickle"),
+                     zlib.compress(pickle.dumps(
+                         (types, vals, events, isatletter),
+                         pickle.HIGHEST_PROTOCOL), 1))
+        self.prune()
+
+    def prune(self):
+        entries = []
+        for entry in self.directory.glob("*.pickle"):
+            try:
+                entries.append((entry.stat().st_mtime, entry))
+            except FileNotFoundError:  # Removed by another process
+                pass
+        entries.sort(reverse=True)
+        for mtime, entry in entries[self.max_entries:]:
+            try:
+                entry.unlink()
+            except FileNotFoundError:
+                pass
+
+class Block_cache:
+    r"""Expanded blocks (paragraphs, see Tex_stream.block_chunks) of each
+    document, keyed by the hash of their text, of the definitions and of the
+    expansion settings, so that a rebuild only expands the blocks which
+    changed.
+
+    The entries of a document are stored together, in a file named after
+    the hash of its path, which only keeps the blocks of its last run.
+    """
+    version = 2  # Increase when the expansion or the pickled format changes
+
+    def __init__(self, directory=None):
+        if directory is None:
+            directory = default_cache_dir()
+        self.directory = Path(directory)/"blocks"
+
+    def key(self, block, defs_key, isatletter=False, strip_comments=False):
+        return hashlib.sha256(
+            ("%d\0%s\0%d\0%d\0%s" % (self.version, defs_key, isatletter,
+                                     strip_comments, block)
+             ).encode()).hexdigest()
+
+    def filename(self, file):
+        return self.directory/(hashlib.sha256(
+            os.path.abspath(file).encode()).hexdigest() + ".pickle")
+
+    def load(self, file):
+        """Return the entries of document file, mapping keys to
+        (output, isatletter) pairs."""
+        try:
+            with open(self.filename(file), "rb") as fp:
+                return pickle.loads(zlib.decompress(fp.read()))
+        except FileNotFoundError:
+            return {}
+        except Exception as e:
+            warn(f"Ignoring unreadable cache entry for {file}: {e}")
+            return {}
+
+    def save(self, file, entries):
+        atomic_write(self.filename(file),
+                     zlib.compress(pickle.dumps(
+                         entries, pickle.HIGHEST_PROTOCOL), 1))
+
+def write_chunks(chunks, fp, inputs=None):
+    """
+    Write chunks, as produced by Tex_stream.detokenize_chunks, to the file
+    object fp.
+    inputs maps input files expanded in memory to their own chunks; the
+    other input files are copied from their -clean.tex file.
+    """
+    for chunk in chunks:
+        if isinstance(chunk, Clean_input):
+            if inputs and chunk.file in inputs:
+                write_chunks(inputs[chunk.file], fp, inputs)
+            else:
+                print("Reading file %s" % (chunk.clean_file))
+                copy_file_into(chunk.clean_file, fp)
+        else:
+            fp.write(chunk)
+
+def _is_escaped(text, pos):
+    "Whether the character at pos is preceded by an odd number of backslashes."
+    n = 0
+    while n < pos and "\\" == text[pos-n-1]:
+        n += 1
+    return n % 2 == 1
+
+def _in_comment(text, pos):
+    "Whether position pos of text lies within a comment."
+    i = text.rfind("\n", 0, pos) + 1
+    while True:
+        i = text.find("%", i, pos)
+        if i < 0:
+            return False
+        if not _is_escaped(text, i):
+            return True
+        i += 1
+
+def _escape_name_at(text, pos, isatletter=False):
+    r"""Return the name of the escape sequence whose \ is at pos, as the
+    tokenizer would read it.
+    """
+    end = pos + 1
+    if end < len(text) and isletter(text[end], isatletter):
+        while end < len(text) and isletter(text[end], isatletter):
+            end += 1
+        return text[pos+1:end]
+    return text[pos+1:pos+2]
+
+makeat_re = re.compile(r"\\makeat(letter|other)(?![^\W\d_])")
+paragraph_end_re = re.compile(r"\n[ \t]*\n")
+blank_lines_re = re.compile(r"\n(?:[ \t]*\n)+")
+side_effects_re = re.compile(r"\\(?:input|usepackage)(?![^\W\d_])")
+usepackage_re = re.compile(r"\\usepackage\s*(\{[^\s}]*)")
 
 class Stream:
     data = None
@@ -233,6 +1131,76 @@ class Token:
             out = "\\" + self.val
         return out
 
+class Token_rope:
+    """
+    A token sequence made of pieces of other sequences, which it shares
+    instead of copying them: slices of token lists (which must not be
+    modified afterwards), and whole ropes. Expansions are built as ropes of
+    the definition bodies, the expanded arguments and the source tokens, so
+    that nested expansions don't copy tokens at each level; only `flatten`
+    copies them, once.
+    Pieces shorter than `small` are cheaper to copy than to share: they are
+    copied into lists owned by the rope.
+    """
+    __slots__ = ("pieces", "length")
+    small = 64
+
+    def __init__(self):
+        self.pieces = []
+        self.length = 0
+
+    def __len__(self):
+        return self.length
+
+    def _leaf(self):
+        "Return the list owned by the rope at its end."
+        if not (self.pieces and list is type(self.pieces[-1])):
+            self.pieces.append([])
+        return self.pieces[-1]
+
+    def append_slice(self, tokens, start=0, stop=None):
+        "Add tokens[start:stop], where tokens is a list."
+        if stop is None:
+            stop = len(tokens)
+        if stop - start >= self.small:
+            self.pieces.append((tokens, start, stop))
+        elif start < stop:
+            self._leaf().extend(tokens[start:stop])
+        else:
+            return
+        self.length += stop - start
+
+    def extend(self, tokens):
+        "Add all of tokens, a list or a Token_rope."
+        if not isinstance(tokens, Token_rope):
+            self.append_slice(tokens)
+        elif tokens.length >= self.small:
+            self.pieces.append(tokens)
+            self.length += tokens.length
+        elif tokens.length:
+            # A small rope only has its own list
+            self._leaf().extend(tokens.pieces[0])
+            self.length += tokens.length
+
+    def flatten(self):
+        "Return the tokens as a list."
+        out = []
+        # Ropes may nest deeply: walk them with an explicit stack
+        stack = [iter(self.pieces)]
+        while stack:
+            for piece in stack[-1]:
+                if list is type(piece):
+                    out += piece
+                elif isinstance(piece, Token_rope):
+                    stack.append(iter(piece.pieces))
+                    break
+                else:
+                    tokens, start, stop = piece
+                    out += tokens[start:stop]
+            else:
+                stack.pop()
+        return out
+
 
 # Constants
 
@@ -303,17 +1271,34 @@ token_ty = g_group.token_ty
 group_ty = g_group.group_ty
 
 
-def tokenize(in_str):
-    """Returns a list of tokens.
+def _drop_indentation(tokens):
+    """
+    If tokens end with the blanks starting a line, remove them and return
+    True (a comment which follows starts the line).
+    """
+    i = len(tokens)
+    while 0 < i and simple_ty == tokens[i-1].type and tokens[i-1].val in " \t":
+        i -= 1
+    if 0 < i and not (simple_ty == tokens[i-1].type and "\n" == tokens[i-1].val):
+        return False
+    del tokens[i:]
+    return True
+
+def tokenize(in_str, isatletter=False, strip_comments=False):
+    r"""Returns a list of tokens.
+    isatletter is the \makeatletter state at the start of in_str.
+    If strip_comments, comments are dropped as TeX would read them, instead
+    of being returned as comment tokens.
     """
     text = []
-    isatletter=False
     cs = Char_stream(in_str)
     cs.reset()
     if not cs.legal():
         raise ValueError("No string to tokenize.")
     while cs.uplegal():
-        if "%" == cs.item:
+        if "%" == cs.item and strip_comments:
+            cs.skip_comment(_drop_indentation(text))
+        elif "%" == cs.item:
             comment = cs.scan_comment_token()
             text.append(Token(comment_ty, comment))
         elif "\\" != cs.item:
@@ -321,6 +1306,9 @@ def tokenize(in_str):
             cs.next()
         else:
             cs.next()
+            if not cs.uplegal():  # An escape sign ending the text
+                text.append(Token(simple_ty, "\\"))
+                continue
             name = cs.scan_escape_token(isatletter)
             if isletter(name[0], isatletter):
                 token = Token(esc_str_ty, name)
@@ -339,12 +1327,21 @@ class Command_def:
     name = "1"
     numargs = 0
     body= ""
+    resolved = None  # Body with all other macros expanded; see compile_def
+    compiled = False  # Whether resolved was computed
 
     def __init__(self, name_v, numargs_v, body_v):
         self.name = name_v
         self.numargs = numargs_v
         self.body = body_v
 
+    def __getstate__(self):
+        # The compiled body depends on the uses; it is not stored
+        state = dict(self.__dict__)
+        state.pop("resolved", None)
+        state.pop("compiled", None)
+        return state
+
     def show(self):
         out = "\\newcommand{\\%s}" % (self.name)
         if 0 < self.numargs:
@@ -358,6 +1355,8 @@ class Env_def:
     numargs = 0
     begin = ""
     end = ""
+    resolved = None  # (begin, end) with all macros expanded; see compile_def
+    compiled = False  # Whether resolved was computed
 
     def __init__(self, name_v, numargs_v, begin_v, end_v):
         self.name = name_v
@@ -365,6 +1364,13 @@ class Env_def:
         self.begin = begin_v
         self.end = end_v
 
+    def __getstate__(self):
+        # The compiled body depends on the uses; it is not stored
+        state = dict(self.__dict__)
+        state.pop("resolved", None)
+        state.pop("compiled", None)
+        return state
+
     def show(self):
         out = "\\newenvironment{%s}" % self.name
         if 0 < self.numargs:
@@ -406,6 +1412,53 @@ class Env_instance:
         out += "\\end{%s}" % self.name
         return out
 
+class Expansion_target:
+    """
+    A variant of the expanded document, see Tex_stream.process_targets.
+    The definitions of the files defs_files (.sty, with or without
+    extension) are added to the shared ones, possibly replacing some, and
+    the commands (named without their backslash) and environments named in
+    keep are left unexpanded.
+    """
+    name_re = re.compile(r"[\w.+-]+")
+
+    def __init__(self, name, keep=(), defs_files=()):
+        if not self.name_re.fullmatch(name):
+            raise ValueError("Invalid target name %r: only letters, digits, "
+                             "and '_.+-' are allowed." % (name))
+        self.name = name
+        self.keep = tuple(keep)
+        self.defs_files = tuple(defs_files)
+
+    @classmethod
+    def parse(cls, spec):
+        """Parse a target given on the command line as
+        NAME[:keep=MACRO,...][:defs=FILE,...]."""
+        name, *fields = spec.split(":")
+        settings = {"keep": [], "defs": []}
+        for field in fields:
+            key, sep, values = field.partition("=")
+            if not sep or key not in settings:
+                raise ValueError("Invalid target setting %r in %r: expected "
+                                 "keep=... or defs=..." % (field, spec))
+            settings[key].extend(value.strip().lstrip("\\")
+                                 if "keep" == key else value.strip()
+                                 for value in values.split(",")
+                                 if value.strip())
+        return cls(name, settings["keep"], settings["defs"])
+
+    def output_file(self, file):
+        "Name of the output of this target for file (given without extension)."
+        return "%s-%s-clean.tex" % (file, self.name)
+
+class Clean_input:
+    r"""Stands for the content of file-clean.tex, which replaces an
+    \input{file} in the detokenized output.
+    """
+    def __init__(self, file):
+        self.file = file
+        self.clean_file = "%s-clean.tex" % (file)
+
 class Char_stream(Stream):
 
     def scan_escape_token(self, isatletter=False):
@@ -428,7 +1481,7 @@ class Char_stream(Stream):
         including the % and all empty space after it.
         """
         comment = ""
-        while "\n" != self .item:
+        while self.uplegal() and "\n" != self.item:
             comment += self.item
             self.next()
         while self.uplegal() and blank_re.match(self.item):
@@ -436,6 +1489,30 @@ class Char_stream(Stream):
             self.next()
         return comment
 
+    def skip_comment(self, whole_line=False):
+        """
+        Starts at the comment sign %, and skips the comment as TeX reads it:
+        up to and including the end of the line, and the blanks starting the
+        next line. If that line is empty, the end of line is kept, since the
+        empty line ends a paragraph.
+        If whole_line, the comment is all there is on its line (its
+        indentation was already dropped); the whole line is then skipped,
+        and the next one is left as it is.
+        """
+        while self.uplegal() and "\n" != self.item:
+            self.next()
+        if not self.uplegal():
+            return
+        if whole_line:
+            self.next()
+            return
+        end = self.pos + 1
+        while end < len(self.data) and self.data[end] in " \t":
+            end += 1
+        if end < len(self.data) and "\n" != self.data[end]:
+            self.pos = end
+            self.item = self.data[end]
+
     def scan_input_filename(self):
         r"""We just read an \input token.  The next group or word will be
         interpreted as a filename (possibly without .tex).
@@ -474,24 +1551,76 @@ class Char_stream(Stream):
 
 class Tex_stream(Stream):
 
-    defs = ({}, {})
+    defs = None          # (command_defs, env_defs), set for each stream
     defs_db = "x"
     defs_db_file = "x.db"
     debug = False
+    engine = "compiled"  # "compiled", "sparse" or "reference"
+    defs_cache = None    # A Defs_cache, shared by all projects of the user
+    token_cache = None   # A Token_cache, for the files of expand_file_chunks
+    block_cache = None   # A Block_cache, to expand files block by block
+    jobs = 1             # Number of processes expanding \input files
+    write_inputs = True  # Write file-clean.tex for each \input file
+    expanded_inputs = None  # Chunks of the input files kept in memory
+    outputs = None       # An Output_summary of the files written
+    profiler = Memory_profiler()  # Records the memory or time of each stage
+    strip_comments = False  # Drop comments while tokenizing
+    budget = None        # An Expansion_budget limiting the expansions
+    directory = None     # Directory of the private packages, if not the cwd
+    max_resolved_tokens = 10000  # Longer bodies are expanded when used
+
+    inherited = ["defs_db", "defs_db_file", "debug", "engine", "defs_cache",
+                 "jobs", "write_inputs", "expanded_inputs", "outputs",
+                 "profiler", "strip_comments", "budget", "token_cache",
+                 "directory", "block_cache", "max_resolved_tokens"]
+
+    def __init__(self, data_v=None):
+        super().__init__(data_v)
+        # Each stream has its own definitions, unless they are shared
+        # explicitly (see child_stream)
+        self.defs = ({}, {})
+
+    @property
+    def expansion_engine(self):
+        "The Expansion_engine registered under the name self.engine."
+        try:
+            return engines[self.engine]
+        except KeyError:
+            raise ValueError("Unknown expansion engine %r (registered: %s)"
+                             % (self.engine, ", ".join(sorted(engines))))
+
+    def child_stream(self, data=None):
+        """Return a new stream over data, which shares the definitions and
+        settings of this one.
+        """
+        ts = Tex_stream(data)
+        ts.defs = self.defs
+        for attr in self.inherited:
+            setattr(ts, attr, getattr(self, attr))
+        return ts
 
-    def smart_tokenize(self, in_str, handle_inputs=False):
+    def smart_tokenize(self, in_str, handle_inputs=False, isatletter=False,
+                       process_inputs=True, events=None):
         r"""Returns a list of tokens.
-        It may interpret and carry out all \input commands.
+        It may interpret and carry out all \input commands; if not
+        process_inputs, they are only normalized to \input{file}, and the
+        input files are assumed to be processed separately.
+        isatletter is the \makeatletter state at the start of in_str; the
+        state at its end is stored in self.isatletter.
+        The private packages loaded and the \input files handled are
+        appended, in order, to the list events, if given, as ("package",
+        file) and ("input", file).
         """
         self.data = []
         text = self.data
-        isatletter=False
         cs = Char_stream(in_str)
         cs.reset()
         if not cs.legal():
             raise ValueError("No string to tokenize.")
         while cs.uplegal():
-            if "%" == cs.item:
+            if "%" == cs.item and self.strip_comments:
+                cs.skip_comment(_drop_indentation(text))
+            elif "%" == cs.item:
                 comment = cs.scan_comment_token()
                 text.append(Token(comment_ty, comment))
             elif "\\" != cs.item:
@@ -499,10 +1628,19 @@ class Tex_stream(Stream):
                 cs.next()
             else:
                 cs.next()
+                if not cs.uplegal():  # An escape sign ending the text
+                    text.append(Token(simple_ty, "\\"))
+                    continue
                 name = cs.scan_escape_token(isatletter)
                 if "input" == name and handle_inputs:
                     file = cs.scan_input_filename()
-                    to_add = self.process_if_newer(file)
+                    if events is not None:
+                        events.append(("input", file))
+                    if process_inputs:
+                        to_add = self.process_if_newer(file)
+                    else:
+                        to_add = tokenize("\\input{%s}"
+                                          % (cut_extension(file, ".tex")))
                     text.extend(to_add)
                 elif "usepackage" == name:
                     while cs.uplegal() and blank_re.match(cs.item):
@@ -521,7 +1659,10 @@ class Tex_stream(Stream):
                             i += 1
                             continue
                         defs_db_file = file+".db"
-                        self.add_defs(file)
+                        if events is not None:
+                            events.append(("package", file))
+                        with self.profiler.stage("defs loading", file):
+                            self.add_defs(file)
                         del files[i:(i+1)]
                     if files: # non-private packages left
                         group_content = ",".join(files)
@@ -538,7 +1679,11 @@ class Tex_stream(Stream):
                         isatletter=True
                     elif "makeatother" == name:
                         isatletter=False
+        self.isatletter = isatletter
         self.reset()
+        if self.budget is not None:
+            self.budget.add_input(len(self.data))
+            self.budget.check()
         return self.data
 
     def smart_detokenize(self):
@@ -547,10 +1692,24 @@ class Tex_stream(Stream):
         If the list contains an \input{file} then the content of file
         file-clean.tex replaces it in the output.
         """
+        out = io.StringIO()
+        self.write_detokenized(out)
+        return out.getvalue()
+
+    def detokenize_chunks(self, chunk_size=1 << 16):
+        r"""
+        Generate the output of `smart_detokenize` piece by piece.
+        Strings are yielded in chunks of roughly `chunk_size` characters;
+        an \input{file} is yielded as a `Clean_input` marker, standing for
+        the content of file-clean.tex. Handled inputs always have braces: an
+        \input without them (as in text tokenized without handling inputs)
+        is output as it is.
+        """
         self.reset()
         if not self.legal():
-            return ""
-        out = ""
+            return
+        out = []
+        size = 0
         previtem = None
         while self.uplegal():
             item = self.item
@@ -558,22 +1717,43 @@ class Tex_stream(Stream):
             string and is followed by a letter."""
             if (None != previtem and esc_str_ty == previtem.type
                 and simple_ty == item.type and isletter(item.val[0], False)):
-                out += " "
+                out.append(" ")
             previtem = item
-            if not (esc_str_ty == item.type and "input" == item.val):
-                out += item.show()
+            nextpos = self.pos + 1
+            if not (esc_str_ty == item.type and "input" == item.val
+                    and nextpos < len(self.data)
+                    and simple_ty == self.data[nextpos].type
+                    and "{" == self.data[nextpos].val):
+                s = item.show()
+                out.append(s)
+                size += len(s)
                 self.next()
+                if size >= chunk_size:
+                    if self.budget is not None:
+                        # The output of a small input can be huge
+                        self.budget.check()
+                    yield "".join(out)
+                    out = []
+                    size = 0
             else:
                 self.next()
                 group = self.scan_group()
-                file = detokenize(group.val)
-                clean_file = "%s-clean.tex" % (file)
-                print("Reading file %s" % (clean_file))
-                fp = open(clean_file,"r")
-                content = fp.read()
-                fp.close()
-                out += content
-        return out
+                if out:
+                    yield "".join(out)
+                    out = []
+                    size = 0
+                yield Clean_input(detokenize(group.val))
+        if out:
+            yield "".join(out)
+
+    def write_detokenized(self, fp):
+        r"""
+        Write the output of `smart_detokenize` to the file object `fp`,
+        without ever building the whole string.
+        The content of \input-ed files is copied file to file, or from
+        memory if they were not written.
+        """
+        write_chunks(self.detokenize_chunks(), fp, self.expanded_inputs)
 
     # Basic tex scanning
 
@@ -897,49 +2077,94 @@ class Tex_stream(Stream):
     def restore_defs(self):
         if os.path.isfile(self.defs_db_file):
             print("Using defs db %s" % (self.defs_db_file))
-            db_h = shelve.open(self.defs_db)
-            self.defs = db_h["defs"]
-            db_h.close()
+            with file_lock(self.defs_db + ".lock"):
+                db_h = shelve.open(self.defs_db)
+                self.defs = db_h["defs"]
+                db_h.close()
+            self.compile_defs()
 
     def save_defs(self):
-        db_h = shelve.open(self.defs_db)
-        if "defs" in db_h:
-            del db_h["defs"]
-        db_h["defs"] = self.defs
-        db_h.close()
+        """Store the definitions in the db, unless it already has them."""
+        with file_lock(self.defs_db + ".lock"):
+            db_h = shelve.open(self.defs_db)
+            changed = not ("defs" in db_h and pickle.dumps(db_h["defs"])
+                           == pickle.dumps(self.defs))
+            if changed:
+                if "defs" in db_h:
+                    del db_h["defs"]
+                db_h["defs"] = self.defs
+            db_h.close()
+        if self.outputs is not None:
+            self.outputs.add(self.defs_db, changed)
 
     def add_defs(self, defs_file):
+        if self.directory is not None:
+            defs_file = os.path.join(self.directory, defs_file)
         defs_file_compl = defs_file + ".sty"
         if not os.path.isfile(defs_file_compl):
             raise FileNotFoundError("%s does not exist" % (defs_file_compl))
 
         defs_db_file = self.defs_db_file
-        if newer(defs_db_file, defs_file_compl):
+        if defs_db_file is not None and newer(defs_db_file, defs_file_compl):
             print("Using defs db %s for %s" % (defs_db_file, defs_file))
         else:
-            defs_fp = open(defs_file_compl, "r")
-            defs_str = defs_fp.read()
-            defs_fp.close()
-            ds = Tex_stream()
-            ds.defs = self.defs
-            defs_text = ds.smart_tokenize(defs_str)
-            # changing ds.defs will change self.defs
-            if self.debug:
-                defs_seen_file = "%s-seen.sty" % (defs_file)
-                defs_seen_fp = open(defs_seen_file, "w")
-                out = detokenize(defs_text)
-                defs_seen_fp.write(out)
-                defs_seen_fp.close()
-            ds.scan_defs()
-            if self.debug:
-                out = ""
-                command_defs, env_defs = self.defs
-                for def_name in command_defs.keys():
-                    out += command_defs[def_name].show() + "\n"
-                for def_name in env_defs.keys():
-                    out += env_defs[def_name].show() +"\n"
-                print("Definitions after reading %s:" % (defs_file))
-                print(out)
+            defs_str = read_tex_file(defs_file_compl)
+            cache = self.defs_cache
+            if cache is None or self.debug or usepackage_re.search(defs_str):
+                # Files loading other packages are not cached, since the
+                # key would not cover the loaded files.
+                self.scan_defs_file(defs_file, defs_str)
+            else:
+                key = cache.key(defs_str)
+                defs = cache.get(key)
+                hit = defs is not None
+                if not hit:
+                    with cache.lock(key):
+                        # Another process may have parsed the file meanwhile
+                        defs = cache.get(key)
+                        if defs is None:
+                            ds = self.child_stream()
+                            ds.defs = ({}, {})
+                            ds.scan_defs_file(defs_file, defs_str)
+                            cache.put(key, ds.defs)
+                            defs = ds.defs
+                        else:
+                            hit = True
+                if hit:
+                    print("Using cached definitions for %s" % (defs_file))
+                for known_defs, new_defs in zip(self.defs, defs):
+                    known_defs.update(new_defs)
+        if self.budget is not None:
+            self.budget.check()
+        self.compile_defs()
+
+    def scan_defs_file(self, defs_file, defs_str):
+        """Add the definitions in defs_str, the content of defs_file.sty."""
+        ds = self.child_stream()
+        # Comments are dropped from the bodies by scan_defs; keeping the
+        # same tokens in all modes lets the parsed definitions be cached.
+        ds.strip_comments = False
+        # The definitions don't count as input tokens of the budget, which
+        # add_defs checks
+        ds.budget = None
+        defs_text = ds.smart_tokenize(defs_str)
+        # changing ds.defs will change self.defs
+        if self.debug:
+            defs_seen_file = "%s-seen.sty" % (defs_file)
+            defs_seen_fp = open(defs_seen_file, "w")
+            out = detokenize(defs_text)
+            defs_seen_fp.write(out)
+            defs_seen_fp.close()
+        ds.scan_defs()
+        if self.debug:
+            out = ""
+            command_defs, env_defs = self.defs
+            for def_name in command_defs.keys():
+                out += command_defs[def_name].show() + "\n"
+            for def_name in env_defs.keys():
+                out += env_defs[def_name].show() +"\n"
+            print("Definitions after reading %s:" % (defs_file))
+            print(out)
 
     # Applying definitions, recursively
     # (maybe not quite in Knuth order, so avoid tricks!)
@@ -966,6 +2191,28 @@ class Tex_stream(Stream):
             pos += 1
         return out
 
+    def subst_args_rope(self, body, args, out):
+        """Like subst_args, but add the result to the Token_rope out, which
+        shares the body and the arguments (lists or ropes)."""
+        start = pos = 0
+        while pos < len(body):
+            item = body[pos]
+            if not (simple_ty == item.type and "#" == item.val):
+                pos += 1
+                continue
+            out.append_slice(body, start, pos)
+            argnum = body[pos+1].val
+            if not pos_digit_re.match(argnum):
+                raise ArgumentError("# is not followed by number.")
+            argnum = int(argnum)
+            if argnum > len(args):
+                raise ArgumentError("Too large argument number.")
+            out.extend(args[argnum-1])
+            pos += 2
+            start = pos
+        out.append_slice(body, start)
+        return out
+
     def apply_command_recur(self, command_instance):
         command_defs, env_defs = self.defs
         name = command_instance.name
@@ -975,11 +2222,15 @@ class Tex_stream(Stream):
         body = command_def.body
         result = self.subst_args(body, args)
         try:
-            result = self.apply_all_recur(result)
+            if result:  # A macro may expand to nothing
+                result = self.apply_all_recur(result)
         except Empty_text_error as e:
             raise RuntimeError("apply_all_recur fails on command instance {}: "
                                "{}, {}".format(command_instance.show(),
                                                detokenize(e.data), e.message))
+        # Charged once, for the whole expansion, as by compiled_rope
+        if self.budget is not None:
+            self.budget.charge("\\" + name, len(result))
         return result
 
     def apply_env_recur(self, env_instance):
@@ -990,12 +2241,15 @@ class Tex_stream(Stream):
         begin, end = env_def.begin, env_def.end
         body, args = env_instance.body, env_instance.args
         out = self.subst_args(begin, args) + body + self.subst_args(end, args)
-        return self.apply_all_recur(out)
+        if out:
+            out = self.apply_all_recur(out)
+        if self.budget is not None:
+            self.budget.charge("{%s}" % (name), len(out))
+        return out
 
 
     def apply_all_recur(self, data, report=False):
-        ts = Tex_stream(data)
-        ts.defs = self.defs
+        ts = self.child_stream(data)
         command_defs, env_defs = self.defs
         out = []
         progress_step = 10000
@@ -1034,19 +2288,592 @@ class Tex_stream(Stream):
         return out
 
 
+    # Compiling definitions
+    # Each body is expanded once, with respect to all other definitions, so
+    # that documents can be expanded in a single substitution pass.
+
+    def definition_dependencies(self, tokens):
+        """Return the set of definitions used in tokens, as
+        ("command", name) or ("env", name) keys.
+        """
+        command_defs, env_defs = self.defs
+        deps = set()
+        if not tokens:
+            return deps
+        ts = Tex_stream(tokens)
+        while ts.uplegal():
+            item = ts.item
+            if 1 == ts.test_env_boundary(item):
+                env_name = ts.scan_env_begin()
+                if env_name in env_defs:
+                    deps.add(("env", env_name))
+            else:
+                if (item.type in [esc_symb_ty, esc_str_ty]
+                    and item.val in command_defs):
+                    deps.add(("command", item.val))
+                ts.next()
+        return deps
+
+    def ordered_definitions(self):
+        """Return the keys of all definitions, ordered such that each comes
+        after the definitions it uses.
+        Raises Cyclic_definition_error if definitions use each other.
+        """
+        command_defs, env_defs = self.defs
+        graph = {}
+        for name, command_def in command_defs.items():
+            graph[("command", name)] = self.definition_dependencies(
+                command_def.body)
+        for name, env_def in env_defs.items():
+            graph[("env", name)] = (self.definition_dependencies(env_def.begin)
+                                    | self.definition_dependencies(env_def.end))
+        def show(key):
+            kind, name = key
+            return "\\" + name if kind == "command" else "{%s}" % name
+        order = []
+        state = {}  # 1: being visited, 2: done
+        for root in graph:
+            if root in state:
+                continue
+            state[root] = 1
+            stack = [(root, iter(sorted(graph[root])))]
+            while stack:
+                node, children = stack[-1]
+                for child in children:
+                    if 1 == state.get(child):
+                        path = [key for key, _ in stack]
+                        cycle = path[path.index(child):] + [child]
+                        raise Cyclic_definition_error([show(k) for k in cycle])
+                    elif child not in state:
+                        state[child] = 1
+                        stack.append((child, iter(sorted(graph[child]))))
+                        break
+                else:
+                    stack.pop()
+                    state[node] = 2
+                    order.append(node)
+        return order
+
+    def resolve_body(self, body):
+        """Return body expanded with respect to the compiled definitions,
+        or None if it cannot be expanded ahead of its arguments, or would be
+        longer than max_resolved_tokens.
+        """
+        if re.search(r"\\(begin|end)\s*\{[^}]*#", detokenize(body) or ""):
+            # An environment name built from an argument
+            return None
+        try:
+            rope = self.compiled_rope(body, strict=True)
+        except (Incomplete_call, Unresolvable_call):
+            return None
+        if len(rope) > self.max_resolved_tokens:
+            return None
+        return rope.flatten()
+
+    def compile_defs(self):
+        """Prepare the definitions to be compiled, once they are all known:
+        each is compiled on its first use by the compiled engine (see
+        compile_def), so that unused definitions cost nothing, and the
+        reference engine compiles none.
+        Raises Cyclic_definition_error if definitions use each other.
+        """
+        command_defs, env_defs = self.defs
+        for defs in (command_defs, env_defs):
+            for definition in defs.values():
+                definition.resolved = None
+                definition.compiled = False
+        self.ordered_definitions()
+
+    def compile_def(self, key):
+        """Store in the definition key, ("command", name) or ("env", name),
+        its body already expanded with respect to all other definitions,
+        after compiling the definitions it uses.
+        Definitions which cannot be pre-expanded keep `resolved = None`;
+        they are expanded recursively when used.
+        """
+        command_defs, env_defs = self.defs
+        def definition(key):
+            kind, name = key
+            return command_defs[name] if "command" == kind else env_defs[name]
+        def dependencies(key):
+            d = definition(key)
+            if "command" == key[0]:
+                deps = self.definition_dependencies(d.body)
+            else:
+                deps = (self.definition_dependencies(d.begin)
+                        | self.definition_dependencies(d.end))
+            return iter(sorted(k for k in deps if not definition(k).compiled))
+        # Post-order of the definitions still to compile (there is no cycle)
+        seen = {key}
+        stack = [(key, dependencies(key))]
+        while stack:
+            node, children = stack[-1]
+            for child in children:
+                if child not in seen:
+                    seen.add(child)
+                    stack.append((child, dependencies(child)))
+                    break
+            else:
+                stack.pop()
+                if self.budget is not None:
+                    self.budget.check()
+                d = definition(node)
+                if "command" == node[0]:
+                    d.resolved = self.resolve_body(d.body)
+                else:
+                    begin = self.resolve_body(d.begin)
+                    end = (None if begin is None
+                           else self.resolve_body(d.end))
+                    if end is not None:
+                        d.resolved = (begin, end)
+                d.compiled = True
+
+    # Applying compiled definitions, in a single pass
+
+    def scan_args_checked(self, command_or_env_def):
+        """Like scan_args, but raise Incomplete_call if the tokens end before
+        all arguments are read, and Unresolvable_call if an argument is a
+        bare parameter #.
+        """
+        args = []
+        for i in range(command_or_env_def.numargs):
+            if not self.uplegal():
+                raise Incomplete_call
+            item = self.item
+            if not (simple_ty == item.type and "{" == item.val):
+                if simple_ty == item.type and "#" == item.val:
+                    raise Unresolvable_call
+                args.append([item])
+                self.next()
+                continue
+            count = 1
+            group = []
+            item = self.next()
+            while self.uplegal():
+                if simple_ty == item.type:
+                    if "{" == item.val:
+                        count += 1
+                    elif "}" == item.val:
+                        count -= 1
+                if count == 0:
+                    break
+                group.append(item)
+                item = self.next()
+            if count != 0:
+                raise Incomplete_call
+            self.next()
+            args.append(group)
+        return args
+
+    def scan_env_rest_checked(self, env_def):
+        r"""Like scan_env_rest, but raise Incomplete_call if the tokens end
+        before the environment does.
+        """
+        count = 1
+        args = self.scan_args_checked(env_def)
+        body = []
+        while count and self.uplegal():
+            old_pos = self.pos
+            d = self.test_env_boundary(self.item)
+            count += d
+            if 1 == d:
+                self.scan_env_begin()
+            elif -1 == d:
+                self.scan_env_end()
+            else:
+                self.next()
+            if 0 < count:
+                body.extend(self.data[old_pos : self.pos])
+        if count:
+            raise Incomplete_call
+        return Env_instance(env_def.name, args, body)
+
+    def apply_all_compiled(self, data, strict=False):
+        """Expand data with the resolved bodies set by compile_def.
+        Only arguments are expanded recursively; bodies are substituted as-is.
+        Calls which cannot be handled this way are expanded by the recursive
+        (reference) engine, or, if strict, make this function raise
+        Incomplete_call or Unresolvable_call.
+        """
+        return self.compiled_rope(data, strict).flatten()
+
+    def compiled_rope(self, data, strict=False):
+        """Like apply_all_compiled, but return the expansion as a Token_rope,
+        which shares the tokens of data and of the definitions."""
+        command_defs, env_defs = self.defs
+        out = Token_rope()
+        if not data:
+            return out
+        ts = self.child_stream(data)
+        run = 0  # The tokens of data from run on are output as they are
+        n = len(data)
+        while ts.uplegal():
+            # Skip to the next escape sequence
+            pos = ts.pos
+            while pos < n and data[pos].type not in (esc_symb_ty, esc_str_ty):
+                pos += 1
+            if pos == n:
+                break
+            ts.pos = old_pos = pos
+            ts.item = item = data[pos]
+            if 1 == ts.test_env_boundary(item):
+                env_name = ts.scan_env_begin()
+                if env_name not in env_defs:
+                    continue
+                env_def = env_defs[env_name]
+                try:
+                    if not env_def.compiled:
+                        self.compile_def(("env", env_name))
+                    if env_def.resolved is None:
+                        raise Unresolvable_call
+                    env_instance = ts.scan_env_rest_checked(env_def)
+                    begin, end = env_def.resolved
+                    args = [self.compiled_rope(arg, strict=True)
+                            for arg in env_instance.args]
+                    result = Token_rope()
+                    self.subst_args_rope(begin, args, result)
+                    result.extend(self.compiled_rope(env_instance.body,
+                                                     strict=True))
+                    self.subst_args_rope(end, args, result)
+                    if self.budget is not None:
+                        self.budget.charge("{%s}" % (env_name), len(result))
+                except (Incomplete_call, Unresolvable_call):
+                    if strict:
+                        raise
+                    ts.pos = old_pos
+                    ts.item = ts.data[old_pos]
+                    ts.scan_env_begin()
+                    env_instance = ts.scan_env_rest(env_def)
+                    result = ts.apply_env_recur(env_instance)
+            elif item.val not in command_defs:
+                ts.next()
+                continue
+            else:
+                command_def = command_defs[item.val]
+                try:
+                    if not command_def.compiled:
+                        self.compile_def(("command", item.val))
+                    if command_def.resolved is None:
+                        raise Unresolvable_call
+                    ts.next()
+                    if 0 < command_def.numargs:
+                        ts.skip_blank_tokens()
+                    args = [self.compiled_rope(arg, strict=True)
+                            for arg in ts.scan_args_checked(command_def)]
+                    result = self.subst_args_rope(command_def.resolved, args,
+                                                  Token_rope())
+                    if self.budget is not None:
+                        self.budget.charge("\\" + item.val, len(result))
+                except (Incomplete_call, Unresolvable_call):
+                    if strict:
+                        raise
+                    ts.pos = old_pos
+                    ts.item = ts.data[old_pos]
+                    command_inst = ts.scan_command(command_def)
+                    result = ts.apply_command_recur(command_inst)
+            out.append_slice(data, run, old_pos)
+            out.extend(result)
+            run = ts.pos
+        out.append_slice(data, run)
+        return out
+
+
+    # Sparse expansion
+    # Only the neighbourhoods of defined macros are tokenized and expanded;
+    # the rest of the text is copied through verbatim.
+
+    def macro_matcher(self, handle_inputs=False):
+        r"""Return a regex matching the candidate positions of defined
+        commands and environments, \usepackage, (if handle_inputs) \input,
+        and comments if they are stripped. Matches must still be checked
+        with `valid_match`.
+        """
+        command_defs, env_defs = self.defs
+        names = list(command_defs) + ["usepackage"]
+        if handle_inputs:
+            names.append("input")
+        names.sort(key=len, reverse=True)
+        patterns = [r"\\(?:%s)" % "|".join(re.escape(n) for n in names)]
+        if env_defs:
+            patterns.append(r"\\begin\{(?:%s)\}"
+                            % "|".join(re.escape(n) for n in env_defs))
+        if self.strip_comments:
+            patterns.append("%")
+        return re.compile("|".join(patterns))
+
+    def valid_match(self, text, match, isatletter=False, handle_inputs=False):
+        """Whether match, found by `macro_matcher`, is an actual use of a
+        defined macro: not escaped, not in a comment, and with the name the
+        tokenizer would read.
+        """
+        pos = match.start()
+        if _is_escaped(text, pos) or _in_comment(text, pos):
+            return False
+        if "%" == text[pos]:
+            return True
+        name = _escape_name_at(text, pos, isatletter)
+        command_defs, env_defs = self.defs
+        if "begin" == name:
+            close = text.find("}", pos + 7)
+            return ("{" == text[pos+6:pos+7] and 0 <= close
+                    and text[pos+7:close] in env_defs)
+        return (name in command_defs or "usepackage" == name
+                or (handle_inputs and "input" == name))
+
+    def calls_complete(self, tokens):
+        """Whether every call of a defined macro in tokens has all its
+        arguments (and, for environments, its end) within tokens.
+        """
+        command_defs, env_defs = self.defs
+        if not tokens:
+            return True
+        ts = self.child_stream(tokens)
+        try:
+            while ts.uplegal():
+                item = ts.item
+                if 1 == ts.test_env_boundary(item):
+                    env_name = ts.scan_env_begin()
+                    if env_name in env_defs:
+                        ts.scan_env_rest_checked(env_defs[env_name])
+                elif (item.type in [esc_symb_ty, esc_str_ty]
+                      and item.val in command_defs):
+                    command_def = command_defs[item.val]
+                    ts.next()
+                    if 0 < command_def.numargs:
+                        ts.skip_blank_tokens()
+                    try:
+                        ts.scan_args_checked(command_def)
+                    except Unresolvable_call:
+                        ts.next()
+                else:
+                    ts.next()
+        except (Incomplete_call, ParsingError):
+            return False
+        return True
+
+    def preload_private_packages(self, text):
+        r"""Add the definitions of all private packages loaded in text.
+        The full engine loads them while tokenizing the whole text, so they
+        apply even before the \usepackage; the sparse engine needs them
+        before scanning for macros.
+        """
+        for match in usepackage_re.finditer(text):
+            if _is_escaped(text, match.start()) or _in_comment(text, match.start()):
+                continue
+            for file in match.group(1)[1:].split(","):
+                if file.endswith("-private"):
+                    with self.profiler.stage("defs loading", file):
+                        self.add_defs(file)
+
+    def sparse_chunks(self, text, handle_inputs=False, process_inputs=True,
+                      isatletter=False):
+        r"""Generate the expanded text in chunks, like `detokenize_chunks`,
+        tokenizing and expanding only the regions which contain a defined
+        command or environment (or a \usepackage, an \input, or a comment
+        to strip).
+        A region starts at the beginning of the line of its first match and
+        extends paragraph by paragraph until all its macro calls are
+        complete.
+        As with smart_tokenize, isatletter is the \makeatletter state at the
+        start of text, and the state at its end is stored in self.isatletter.
+        """
+        self.preload_private_packages(text)
+        matcher = self.macro_matcher(handle_inputs)
+        ndefs = tuple(map(len, self.defs))
+        pos = 0         # Text before pos has been output
+        search_pos = 0  # Matches before search_pos have been checked
+        at_pos = 0      # isatletter is the \makeatletter state at at_pos
+        while True:
+            match = matcher.search(text, search_pos)
+            if match is None:
+                break
+            # Update the \makeatletter state up to the match (which may be
+            # part of a \makeatletter, if a \ma... command is defined)
+            for m in makeat_re.finditer(text, at_pos, match.start()):
+                if not (_is_escaped(text, m.start())
+                        or _in_comment(text, m.start())):
+                    isatletter = "letter" == m.group(1)
+            at_pos = match.start()
+            search_pos = match.start() + 1
+            if not self.valid_match(text, match, isatletter, handle_inputs):
+                continue
+            start = max(pos, text.rfind("\n", 0, match.start()) + 1)
+            end = match.end()
+            while True:
+                m = paragraph_end_re.search(text, end)
+                # A comment token also takes the blank lines following it
+                while m and _in_comment(text, m.start()):
+                    m = paragraph_end_re.search(text, m.start() + 1)
+                end = m.start() + 1 if m else len(text)
+                if (end == len(text)
+                    or self.calls_complete(tokenize(text[start:end],
+                                                    isatletter))):
+                    break
+            if pos < start:
+                yield text[pos:start]
+            self.smart_tokenize(text[start:end], handle_inputs, isatletter,
+                                process_inputs)
+            isatletter = self.isatletter
+            self.data = self.apply_all_compiled(self.data)
+            yield from self.detokenize_chunks()
+            pos = search_pos = at_pos = end
+            if tuple(map(len, self.defs)) != ndefs:
+                matcher = self.macro_matcher(handle_inputs)
+                ndefs = tuple(map(len, self.defs))
+        if pos < len(text):
+            yield text[pos:]
+        for m in makeat_re.finditer(text, at_pos):
+            if not (_is_escaped(text, m.start())
+                    or _in_comment(text, m.start())):
+                isatletter = "letter" == m.group(1)
+        self.isatletter = isatletter
+
+    def expand_text_chunks(self, text, isatletter=False, handle_inputs=False,
+                           process_inputs=True):
+        r"""Tokenize and expand text, handling \input only if handle_inputs
+        (see smart_tokenize).
+        Returns its output as chunks, see detokenize_chunks; self.isatletter
+        is the \makeatletter state at the end of text once they are
+        consumed.
+        """
+        return self.expansion_engine.chunks(self, text, handle_inputs,
+                                            process_inputs, isatletter)
+
+    def filter_chunks(self, lines):
+        """
+        Generate the expanded text of lines, an iterable of lines of TeX,
+        as chunks like `detokenize_chunks`. The text is expanded block by
+        block, as soon as a block is complete: blocks end before an empty
+        line (if the line before it is not a comment), once all the macro
+        calls in the block are complete.
+        """
+        block = []
+        isatletter = False
+        for line in lines:
+            if (block and not line.strip() and block[-1].strip()
+                and not _in_comment(block[-1], len(block[-1].rstrip("\n")))):
+                text = "".join(block)
+                if self.calls_complete(tokenize(text, isatletter)):
+                    yield from self.expand_text_chunks(text, isatletter)
+                    isatletter = self.isatletter
+                    block = []
+            block.append(line)
+        if block:
+            yield from self.expand_text_chunks("".join(block), isatletter)
+
+    def defs_key(self):
+        "Return a hash of the definitions, as they would be written out."
+        command_defs, env_defs = self.defs
+        h = hashlib.sha256()
+        for defs in (command_defs, env_defs):
+            for name in sorted(defs):
+                h.update(defs[name].show().encode())
+                h.update(b"\0")
+            h.update(b"\1")
+        return h.hexdigest()
+
+    def block_chunks(self, text, file, process_inputs=True):
+        r"""Generate the expanded text of file in chunks, like
+        `detokenize_chunks`, block by block, reusing the blocks expanded by
+        a previous run (see Block_cache).
+        Blocks end after empty lines (if the line before them is not a
+        comment), once all the macro calls in the block are complete. The
+        blocks which may \input a file or load a package are expanded each
+        time, for their side effects. As with the sparse engine, the private
+        packages are loaded first, so that they apply to every block.
+        """
+        cache = self.block_cache
+        entries = cache.load(file)
+        used = {}
+        self.preload_private_packages(text)
+        defs_key = self.defs_key()
+        isatletter = False
+        nblocks = nexpanded = 0
+        pos = 0
+        while pos < len(text):
+            end = pos
+            while True:
+                m = blank_lines_re.search(text, end)
+                while m and _in_comment(text, m.start()):
+                    m = blank_lines_re.search(text, m.start() + 1)
+                end = m.end() if m else len(text)
+                block = text[pos:end]
+                key = cache.key(block, defs_key, isatletter,
+                                self.strip_comments)
+                if (key in entries or end == len(text)
+                    or self.calls_complete(tokenize(block, isatletter))):
+                    break
+            nblocks += 1
+            if key in entries:
+                output, isatletter = used[key] = entries[key]
+                yield output
+            elif side_effects_re.search(block):
+                nexpanded += 1
+                yield from self.expand_text_chunks(block, isatletter, True,
+                                                   process_inputs)
+                isatletter = self.isatletter
+            else:
+                nexpanded += 1
+                output = "".join(self.expand_text_chunks(block, isatletter))
+                isatletter = self.isatletter
+                used[key] = (output, isatletter)
+                yield output
+            pos = end
+        self.isatletter = isatletter
+        cache.save(file, used)
+        print("Expanded %d of %d blocks" % (nexpanded, nblocks))
+
     # Processing files
 
-    def process_file(self, file):
-        """Returns the new defs.
+    def tokenize_file(self, text_str, process_inputs=True):
+        r"""smart_tokenize text_str, the content of a file, handling \input.
+        With a token_cache, a text tokenized before is not tokenized again:
+        its private packages and \input files are only loaded or processed
+        again, in order.
         """
-        file = cut_extension(file, ".tex")
-        source_file = "%s.tex" % (file)
-        print("File %s [" % (source_file))
-        source_fp = open(source_file, "r")
-        text_str = source_fp.read()
-        source_fp.close()
+        cache = self.token_cache
+        if cache is None or self.debug:
+            return self.smart_tokenize(text_str, handle_inputs=True,
+                                       process_inputs=process_inputs)
+        key = cache.key(text_str, self.strip_comments)
+        entry = cache.get(key)
+        if entry is None:
+            events = []
+            self.smart_tokenize(text_str, handle_inputs=True,
+                                process_inputs=process_inputs, events=events)
+            cache.put(key, self.data, events, self.isatletter)
+            return self.data
+        print("Using cached tokens")
+        tokens, events, isatletter = entry
+        for kind, file in events:
+            if "package" == kind:
+                with self.profiler.stage("defs loading", file):
+                    self.add_defs(file)
+            elif process_inputs:
+                self.process_if_newer(file)
+        self.data = tokens
+        self.isatletter = isatletter
+        self.reset()
+        if self.budget is not None:
+            self.budget.add_input(len(self.data))
+            self.budget.check()
+        return self.data
 
-        self.smart_tokenize(text_str, handle_inputs=True)
+    def expand_file_chunks(self, file, process_inputs=True):
+        """Tokenize and expand file.tex.
+        Returns its output as chunks, see detokenize_chunks.
+        """
+        text_str = read_tex_file("%s.tex" % (file))
+        if self.block_cache is not None and not self.debug:
+            return self.block_chunks(text_str, file, process_inputs)
+        engine = self.expansion_engine
+        if engine.streaming:
+            return engine.chunks(self, text_str, handle_inputs=True,
+                                 process_inputs=process_inputs)
+
+        with self.profiler.stage("tokenization", file):
+            self.tokenize_file(text_str, process_inputs)
+        del text_str
         if not self.data:
             raise RuntimeError("Empty tokenization result.")
         self.reset()
@@ -1057,16 +2884,154 @@ class Tex_stream(Stream):
             source_seen_fp.write(detokenize(self.data))
             source_seen_fp.close()
 
-        self.data = self.apply_all_recur(self.data, report=True)
+        with self.profiler.stage("expansion", file):
+            self.data = engine.apply(self, self.data, report=True)
+        return self.detokenize_chunks()
+
+    def process_file(self, file, process_inputs=True):
+        """Returns the new defs.
+        """
+        file = cut_extension(file, ".tex")
+        source_file = "%s.tex" % (file)
+        print("File %s [" % (source_file))
+        if not self.write_inputs and self.expanded_inputs is None:
+            self.expanded_inputs = {}
+        if (process_inputs and 1 < self.jobs
+            and self.process_inputs_concurrently(file)):
+            process_inputs = False
+        chunks = self.expand_file_chunks(file, process_inputs)
 
         result_fname = "%s-clean.tex" % (file)
         print("Writing %s [" % (result_fname))
-        result_fp = open(result_fname, "w")
-        result_fp.write(self.smart_detokenize())
-        result_fp.close()
+        # Streaming engines and the block cache tokenize and expand while
+        # the output is written
+        if self.block_cache is not None and not self.debug:
+            stage = "block expansion"
+        elif self.expansion_engine.streaming:
+            stage = "%s expansion" % (self.engine)
+        else:
+            stage = "detokenization"
+        with self.profiler.stage(stage, file), \
+             output_file(result_fname, self.outputs,
+                         buffering=1 << 16) as result_fp:
+            write_chunks(chunks, result_fp, self.expanded_inputs)
         print("] file %s" % (result_fname))
         print("] file %s" % (source_file))
 
+    def target_stream(self, target, data=None):
+        """Return a child stream over data, with the definitions of the
+        Expansion_target target, compiled for it."""
+        ts = self.child_stream(data)
+        # compile_defs stores its results in the definitions themselves
+        ts.defs = copy.deepcopy(self.defs)
+        ts.defs_db_file = None
+        for defs_file in target.defs_files:
+            ts.add_defs(cut_extension(defs_file, ".sty"))
+        for name in target.keep:
+            for defs in ts.defs:
+                defs.pop(name, None)
+        ts.compile_defs()
+        return ts
+
+    def expand_target_chunks(self, tokens, target):
+        """Expand the tokens with the definitions of target.
+        Returns the output as chunks, see detokenize_chunks."""
+        ts = self.target_stream(target, tokens)
+        with self.profiler.stage("expansion", target.name):
+            ts.data = ts.expansion_engine.apply(ts, tokens)
+        return ts.detokenize_chunks()
+
+    def process_targets(self, file, targets):
+        r"""Tokenize file.tex once, and write its expansion for each of the
+        Expansion_target targets to their output_file.
+        Files \input by file.tex are not expanded, and stay as \input: the
+        targets are meant for documents already merged by FLaP. Streaming
+        engines, which do not tokenize the whole file, only `apply` theirs
+        (the sparse engine thus expands like the compiled one).
+        With jobs > 1, the targets are expanded concurrently by worker
+        processes.
+        """
+        from concurrent.futures import ProcessPoolExecutor
+        file = cut_extension(file, ".tex")
+        source_file = "%s.tex" % (file)
+        print("File %s [" % (source_file))
+        with self.profiler.stage("tokenization", file):
+            # Private packages loaded by file.tex are added to the shared
+            # definitions
+            tokens = self.tokenize_file(read_tex_file(source_file),
+                                        process_inputs=False)
+        if not tokens:
+            raise RuntimeError("Empty tokenization result.")
+        if 1 < self.jobs and 1 < len(targets):
+            # Stages are only profiled in the main process
+            settings = {attr: getattr(self, attr) for attr in self.inherited
+                        if "profiler" != attr}
+            with ProcessPoolExecutor(max_workers=min(self.jobs, len(targets)),
+                                     initializer=_init_target_worker,
+                                     initargs=(self.defs, settings, tokens)
+                                     ) as executor:
+                futures = [executor.submit(_expand_target_job, target)
+                           for target in targets]
+                for target, future in zip(targets, futures):
+                    self.write_target(file, target, future.result())
+        else:
+            for target in targets:
+                self.write_target(file, target,
+                                  self.expand_target_chunks(tokens, target))
+        print("] file %s" % (source_file))
+
+    def write_target(self, file, target, chunks):
+        result_fname = target.output_file(file)
+        print("Writing %s [" % (result_fname))
+        with self.profiler.stage("detokenization", result_fname), \
+             output_file(result_fname, self.outputs,
+                         buffering=1 << 16) as result_fp:
+            for chunk in chunks:
+                if isinstance(chunk, Clean_input):
+                    result_fp.write("\\input{%s}" % (chunk.file))
+                else:
+                    result_fp.write(chunk)
+        print("] file %s" % (result_fname))
+
+    def process_inputs_concurrently(self, file):
+        r"""Expand all files \input by file.tex, recursively, on a pool of
+        self.jobs processes, and write their -clean.tex files (or keep
+        their output in memory if not self.write_inputs).
+        Returns False, without processing anything, if one of the files
+        loads private packages: their definitions must then be added in
+        document order.
+        """
+        from concurrent.futures import ProcessPoolExecutor
+        files, loads_private = discover_inputs(file)
+        if loads_private:
+            print("Private packages are loaded from input files; "
+                  "processing them sequentially.")
+            return False
+        if not files:
+            return True
+        # Input files see the private packages loaded by the main file
+        self.preload_private_packages(read_tex_file("%s.tex" % (file)))
+        # Stages are only profiled in the main process
+        settings = {attr: getattr(self, attr) for attr in self.inherited
+                    if "profiler" != attr}
+        with ProcessPoolExecutor(max_workers=self.jobs,
+                                 initializer=_init_input_worker,
+                                 initargs=(self.defs, settings)) as executor:
+            futures = [executor.submit(_expand_input_job, f) for f in files]
+            # Files are in post-order, so the -clean.tex files an output
+            # includes are always written before it.
+            for input_file, future in zip(files, futures):
+                if not self.write_inputs:
+                    self.expanded_inputs[input_file] = future.result()
+                    continue
+                result_fname = "%s-clean.tex" % (input_file)
+                print("Writing %s [" % (result_fname))
+                with output_file(result_fname, self.outputs,
+                                 buffering=1 << 16) as result_fp:
+                    write_chunks(future.result(), result_fp)
+                print("] file %s" % (result_fname))
+        return True
+
     def process_if_newer(self, file):
         r"""
         \input{file} is be added to the token list.
@@ -1078,97 +3043,1281 @@ class Tex_stream(Stream):
         clean_tex_file = file+"-clean.tex"
         if newer(clean_tex_file, tex_file):
             print("Using %s." % (clean_tex_file))
+        elif not self.write_inputs:
+            ts = self.child_stream()
+            ts.data = []
+            print("File %s [" % (tex_file))
+            self.expanded_inputs[file] = list(ts.expand_file_chunks(file))
+            print("] file %s" % (tex_file))
         else:
-            ts = Tex_stream()
+            ts = self.child_stream()
             ts.data = []
-            ts.defs = self.defs
             ts.process_file(file)
         to_add = "\\input{%s}" % (file)
         return tokenize(to_add)
 
-def _rename_figures(renamestr, maintex, extensions=None, start=1):
-    """This function added by Alexandre René."""
+class Expansion_engine:
+    """
+    An expansion engine, selected by its name in `engines` with
+    Tex_stream.engine (and --engine).
+
+    `apply` returns the expansion of a list of tokens, with the definitions
+    of a Tex_stream; `chunks` tokenizes and expands a text, and returns the
+    output like Tex_stream.detokenize_chunks. Streaming engines, which do
+    not tokenize the whole text up front, override `chunks`.
+    """
+    streaming = False  # Whether chunks only works as its output is consumed
+    compiled = False   # Whether apply uses the compiled bodies (compile_def)
+
+    def apply(self, ts, tokens, report=False):
+        raise NotImplementedError
+
+    def chunks(self, ts, text, handle_inputs=False, process_inputs=True,
+               isatletter=False):
+        ts.smart_tokenize(text, handle_inputs, isatletter, process_inputs)
+        ts.data = self.apply(ts, ts.data)
+        return ts.detokenize_chunks()
+
+class Compiled_engine(Expansion_engine):
+    "Pre-expanded definitions, applied in a single pass (the default)."
+    compiled = True
+
+    def apply(self, ts, tokens, report=False):
+        return ts.apply_all_compiled(tokens)
+
+class Sparse_engine(Compiled_engine):
+    "Only tokenizes and expands the paragraphs with defined macros."
+    streaming = True
+
+    def chunks(self, ts, text, handle_inputs=False, process_inputs=True,
+               isatletter=False):
+        return ts.sparse_chunks(text, handle_inputs, process_inputs,
+                                isatletter)
+
+class Reference_engine(Expansion_engine):
+    "The original recursive expansion, against which others are checked."
+    def apply(self, ts, tokens, report=False):
+        return ts.apply_all_recur(tokens, report=report)
+
+engines = {"compiled": Compiled_engine(),
+           "sparse": Sparse_engine(),
+           "reference": Reference_engine()}
+
+def register_engine(name, engine):
+    """Make the Expansion_engine engine available as name. Worker processes
+    (see Tex_stream.jobs) only know it if they are forked, or if the module
+    registering it is imported when they start."""
+    engines[name] = engine
+
+class Expander:
+    """
+    Reentrant expansion engine, safe to share between threads.
+
+    It owns a copy of the definitions, compiled when it is created (within
+    the Expansion_budget budget, if given) if the engine uses compiled
+    bodies, and never modifies it afterwards (it is exposed as read-only
+    mappings); each call scans the text with its own Tex_stream. A text
+    which loads private packages is expanded with a private copy of the
+    definitions, to which the packages are added.
+    """
+    def __init__(self, defs, engine="compiled", strip_comments=False,
+                 defs_cache=None, budget=None):
+        command_defs, env_defs = copy.deepcopy(tuple(map(dict, defs)))
+        self.defs = (types.MappingProxyType(command_defs),
+                     types.MappingProxyType(env_defs))
+        self.engine = engine
+        self.strip_comments = strip_comments
+        self.defs_cache = defs_cache
+        self._compile(budget)
+
+    def _compile(self, budget=None):
+        "Compile all the definitions, for the engines which use them."
+        ts = Tex_stream()
+        ts.defs = self.defs
+        ts.engine = self.engine
+        ts.budget = budget
+        ts.compile_defs()
+        if not ts.expansion_engine.compiled:
+            return
+        for kind, defs in zip(["command", "env"], self.defs):
+            for name, definition in defs.items():
+                if not definition.compiled:
+                    ts.compile_def((kind, name))
+
+    @classmethod
+    def from_files(cls, defs_files, engine="compiled", strip_comments=False,
+                   defs_cache=None, budget=None):
+        """Return an Expander with the definitions of the .sty files
+        defs_files (with or without extension), loaded within the
+        Expansion_budget budget, if given."""
+        ts = Tex_stream()
+        ts.defs_db_file = None
+        ts.defs_cache = defs_cache
+        ts.budget = budget
+        for defs_file in defs_files:
+            ts.add_defs(cut_extension(str(defs_file), ".sty"))
+        return cls(ts.defs, engine, strip_comments, defs_cache, budget)
+
+    def __getstate__(self):
+        # Read-only mappings do not pickle (for process executors)
+        state = self.__dict__.copy()
+        state["defs"] = tuple(map(dict, self.defs))
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.defs = tuple(map(types.MappingProxyType, self.defs))
+        self._compile()  # The compiled bodies are not pickled
+
+    def stream(self, text, budget=None, directory=None):
+        """Return a new Tex_stream, with the scanning state of one call,
+        limited by the Expansion_budget budget. Private packages are looked
+        for in directory, if given."""
+        ts = Tex_stream()
+        ts.defs_db_file = None
+        ts.budget = budget
+        ts.directory = directory
+        ts.engine = self.engine
+        ts.strip_comments = self.strip_comments
+        ts.defs_cache = self.defs_cache
+        if any("-private" in match.group(1)
+               for match in usepackage_re.finditer(text)):
+            ts.defs = copy.deepcopy(tuple(map(dict, self.defs)))
+        else:
+            ts.defs = self.defs
+        return ts
+
+    def chunks(self, text, budget=None, directory=None):
+        r"""Generate the expansion of text (without handling \input) in
+        chunks, see Tex_stream.detokenize_chunks.
+        The expansion is limited by budget, if given, and raises
+        Expansion_limit_error when it runs out."""
+        if not text:
+            return iter(())
+        return self.stream(text, budget, directory).expand_text_chunks(text)
+
+    def expand(self, text, budget=None, directory=None):
+        "Return the expansion of text, see `chunks`."
+        out = io.StringIO()
+        for chunk in self.chunks(text, budget, directory):
+            if isinstance(chunk, Clean_input):
+                out.write("\\input{%s}" % (chunk.file))
+            else:
+                out.write(chunk)
+        return out.getvalue()
+
+class Expander_busy(RuntimeError):
+    "Raised by Async_expander when too many calls are already waiting."
+
+class Async_expander:
+    """
+    asyncio front end of an Expander, for services which must keep their
+    event loop responsive.
+
+    Files are read and written in the loop's default executor, and each
+    expansion runs in `executor` (a thread pool of `max_concurrent` threads
+    by default; a process pool also works, but cancellation then only takes
+    effect through the budget limits). At most `max_concurrent` expansions
+    run at once: further calls wait for a slot, and when `max_pending` calls
+    are already waiting, new ones raise Expander_busy instead.
+    Cancelling a call (e.g. with asyncio.wait_for) cancels its
+    Expansion_budget, so the expansion stops at its next macro; the slot is
+    released once it has stopped.
+    """
+    def __init__(self, expander, executor=None, max_concurrent=4,
+                 max_pending=None):
+        from concurrent.futures import ThreadPoolExecutor
+        self.expander = expander
+        self.owns_executor = executor is None
+        if executor is None:
+            executor = ThreadPoolExecutor(max_concurrent,
+                                          thread_name_prefix="expand")
+        self.executor = executor
+        self.max_concurrent = max_concurrent
+        self.max_pending = max_pending
+        self.pending = 0
+        self._slots = None
+
+    @classmethod
+    async def from_files(cls, defs_files, executor=None, max_concurrent=4,
+                         max_pending=None, **options):
+        """Return an Async_expander with the definitions of the .sty files
+        defs_files, which are loaded in the executor; options are passed to
+        Expander.from_files."""
+        import asyncio, functools
+        self = cls(None, executor, max_concurrent, max_pending)
+        loop = asyncio.get_running_loop()
+        self.expander = await loop.run_in_executor(
+            self.executor,
+            functools.partial(Expander.from_files, defs_files, **options))
+        return self
+
+    async def expand_text(self, text, budget=None, directory=None):
+        """Return the expansion of text, see Expander.expand. Without a
+        budget, the call gets an unlimited one, used for cancellation."""
+        import asyncio
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_concurrent)
+        if (self.max_pending is not None and self._slots.locked()
+                and self.pending >= self.max_pending):
+            raise Expander_busy("%d expansions are already waiting"
+                                % (self.pending))
+        if budget is None:
+            budget = Expansion_budget()
+        self.pending += 1
+        try:
+            await self._slots.acquire()
+        finally:
+            self.pending -= 1
+        try:
+            future = asyncio.wrap_future(self.executor.submit(
+                self.expander.expand, text, budget, directory))
+            try:
+                # The shield keeps the future running if we are cancelled
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                budget.cancel()
+                await asyncio.wait([future])
+                raise
+        finally:
+            self._slots.release()
+
+    async def expand_file(self, file, output=None, budget=None):
+        """Return the expansion of file, whose private packages are looked
+        for in its directory, and write it to output if given."""
+        import asyncio
+        loop = asyncio.get_running_loop()
+        text = await loop.run_in_executor(None, read_tex_file, file)
+        directory = os.path.dirname(os.path.abspath(file))
+        expanded = await self.expand_text(text, budget, directory)
+        if output is not None:
+            import locale
+            data = expanded.encode(locale.getpreferredencoding(False))
+            await loop.run_in_executor(None, atomic_write, output, data)
+        return expanded
+
+    def close(self):
+        "Shut down the executor, if it was created by this Async_expander."
+        if self.owns_executor:
+            self.executor.shutdown()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.close()
+
+input_re = re.compile(r"\\input(?![^\W\d_])\s*\{?([^\s}]*)")
+
+def discover_inputs(file):
+    r"""
+    Find the files \input by file.tex, recursively, skipping those whose
+    -clean.tex is up to date (and the files they input).
+    Returns (files, loads_private): files is in post-order (each file comes
+    after the files it inputs), and loads_private tells whether any of them
+    loads a private package.
+    """
+    files = []
+    loads_private = False
+    seen = {cut_extension(file, ".tex")}
+    def visit(parent):
+        nonlocal loads_private
+        text = read_tex_file("%s.tex" % (parent))
+        for match in input_re.finditer(text):
+            if _is_escaped(text, match.start()) or _in_comment(text, match.start()):
+                continue
+            child = cut_extension(match.group(1), ".tex")
+            if child in seen:
+                continue
+            seen.add(child)
+            if newer(child + "-clean.tex", child + ".tex"):
+                print("Using %s." % (child + "-clean.tex"))
+                continue
+            child_text = read_tex_file(child + ".tex")
+            for m in usepackage_re.finditer(child_text):
+                if "-private" in m.group(1):
+                    loads_private = True
+            visit(child)
+            files.append(child)
+    visit(cut_extension(file, ".tex"))
+    return files, loads_private
+
+_input_worker_stream = None
+
+def _init_input_worker(defs, settings):
+    global _input_worker_stream
+    _input_worker_stream = Tex_stream()
+    _input_worker_stream.defs = defs
+    for attr, value in settings.items():
+        setattr(_input_worker_stream, attr, value)
+
+def _expand_input_job(file):
+    "Expand one \\input file in a worker process; return its output chunks."
+    ts = _input_worker_stream.child_stream()
+    print("File %s.tex [" % (file))
+    chunks = list(ts.expand_file_chunks(file, process_inputs=False))
+    print("] file %s.tex" % (file))
+    return chunks
+
+_target_worker_state = None
+
+def _init_target_worker(defs, settings, tokens):
+    global _target_worker_state
+    ts = Tex_stream()
+    ts.defs = defs
+    for attr, value in settings.items():
+        setattr(ts, attr, value)
+    _target_worker_state = (ts, tokens)
+
+def _expand_target_job(target):
+    "Expand the shared tokens for target in a worker process."
+    ts, tokens = _target_worker_state
+    return list(ts.expand_target_chunks(tokens, target))
+
+# Analysis
+
+class Macro_index:
+    r"""
+    Index of the uses of the commands and environments defined in a
+    Tex_stream, found by a single regex scan of each file, without
+    tokenizing or expanding it (see Tex_stream.macro_matcher). Files \input
+    are scanned where they are input, and the private packages a file loads
+    are added to the definitions before it is scanned.
+
+    `occurrences` maps ("command", name) and ("env", name) keys to the list
+    of their (file, line) positions, in document order.
+    """
+    def __init__(self, ts):
+        self.ts = ts
+        self.occurrences = {}
+        self.files = []
+
+    def scan_file(self, file, _parents=()):
+        file = cut_extension(file, ".tex")
+        if file in _parents:
+            raise RuntimeError("%s.tex inputs itself" % (file))
+        text = read_tex_file("%s.tex" % (file))
+        self.files.append(file)
+        self.ts.preload_private_packages(text)
+        self.scan(text, "%s.tex" % (file), _parents + (file,))
+
+    def scan(self, text, source, _parents=()):
+        "Index the uses in text, the content of the file named source."
+        ts = self.ts
+        matcher = ts.macro_matcher(handle_inputs=True)
+        isatletter = False
+        line, line_pos = 1, 0
+        pos = at_pos = 0
+        while True:
+            match = matcher.search(text, pos)
+            if match is None:
+                break
+            for m in makeat_re.finditer(text, at_pos, match.start()):
+                if not (_is_escaped(text, m.start())
+                        or _in_comment(text, m.start())):
+                    isatletter = "letter" == m.group(1)
+            pos = match.start() + 1
+            at_pos = match.start()
+            if not ts.valid_match(text, match, isatletter, True):
+                continue
+            line += text.count("\n", line_pos, match.start())
+            line_pos = match.start()
+            name = _escape_name_at(text, match.start(), isatletter)
+            if "begin" == name:
+                close = text.find("}", match.start())
+                key = ("env", text[match.start()+7:close])
+            elif "input" == name:
+                child = input_re.match(text, match.start()).group(1)
+                self.scan_file(child, _parents)
+                continue
+            elif "usepackage" == name:
+                continue
+            else:
+                key = ("command", name)
+            self.occurrences.setdefault(key, []).append((source, line))
+
+    def definitions(self):
+        command_defs, env_defs = self.ts.defs
+        return ([("command", name) for name in command_defs]
+                + [("env", name) for name in env_defs])
+
+    def used(self):
+        """Return the keys of the definitions used by the document, directly
+        or through other definitions."""
+        command_defs, env_defs = self.ts.defs
+        used = set()
+        stack = list(self.occurrences)
+        while stack:
+            key = stack.pop()
+            if key in used:
+                continue
+            used.add(key)
+            kind, name = key
+            if "command" == kind:
+                stack.extend(self.ts.definition_dependencies(
+                    command_defs[name].body))
+            else:
+                stack.extend(
+                    self.ts.definition_dependencies(env_defs[name].begin)
+                    | self.ts.definition_dependencies(env_defs[name].end))
+        return used
+
+    def expansion_size(self, key):
+        """Return the number of tokens a use of key expands to, arguments
+        and environment bodies not counted."""
+        command_defs, env_defs = self.ts.defs
+        kind, name = key
+        self.ts.compile_def(key)
+        if "command" == kind:
+            command_def = command_defs[name]
+            body = (command_def.body if command_def.resolved is None
+                    else command_def.resolved)
+            return len(body)
+        env_def = env_defs[name]
+        begin, end = ((env_def.begin, env_def.end)
+                      if env_def.resolved is None else env_def.resolved)
+        return len(begin) + len(end)
+
+    def report(self, top=10):
+        "Return the analysis as a dict (see analyze-latex-macros)."
+        def show(key):
+            kind, name = key
+            return "\\" + name if "command" == kind else "{%s}" % (name)
+        used = self.used()
+        uses = sorted(self.occurrences.items(),
+                      key=lambda item: (-len(item[1]), show(item[0])))
+        hot_spots = sorted(
+            ((show(key), len(positions), self.expansion_size(key))
+             for key, positions in self.occurrences.items()),
+            key=lambda spot: (-spot[1] * spot[2], spot[0]))
+        lines = collections.Counter(
+            position for positions in self.occurrences.values()
+            for position in positions)
+        return {
+            "version": 1,
+            "files": ["%s.tex" % (file) for file in self.files],
+            "definitions": len(self.definitions()),
+            "uses": {show(key): {"count": len(positions),
+                                 "positions": ["%s:%d" % position
+                                               for position in positions]}
+                     for key, positions in uses},
+            "unused": sorted(show(key) for key in self.definitions()
+                             if key not in used),
+            "indirectly_used": sorted(show(key) for key in used
+                                      if key not in self.occurrences),
+            "hot_spots": [{"macro": macro, "count": count,
+                           "tokens_per_use": size,
+                           "tokens": count * size}
+                          for macro, count, size in hot_spots[:top]],
+            "busiest_lines": [{"position": "%s:%d" % position,
+                               "count": count}
+                              for position, count in lines.most_common(top)],
+            }
+
+# Differential testing
+
+def _random_tex(rng, depth, commands, environments, numargs=0, inline=False):
+    """Return random TeX calling the (name, numargs) commands and
+    environments, with parameters up to #numargs. Inline TeX has no line
+    breaks or comments."""
+    words = ["a", "b", "xy", "x y", " ", "  ", "~", ",", "(", "^2", "_i",
+             "$x$", r"\\", r"\%", r"\{", r"\foo", r"\foo{z}", r"\relax "]
+    separators = ["", "", " "]
+    if not inline:
+        words += ["\n", "\n", "% c\n", " % \\ma{\n"]
+        separators += ["\n", "% c\n"]
+    out = []
+    for i in range(rng.randint(0, 4)):
+        r = rng.random()
+        if depth <= 0 or r < 0.35:
+            out.append(rng.choice(words))
+        elif r < 0.45 and numargs:
+            out.append("#%d" % (rng.randint(1, numargs)))
+        elif r < 0.75 and commands:
+            name, nargs = rng.choice(commands)
+            out.append("\\" + name)
+            for j in range(nargs):
+                out.append(rng.choice(separators))
+                out.append("{%s}" % (_random_tex(rng, depth - 1, commands,
+                                                 environments, numargs,
+                                                 inline)))
+            if not nargs:
+                out.append(rng.choice(["", " ", "{}", "x", "1", " z"]))
+        elif r < 0.85 and environments:
+            name, nargs = rng.choice(environments)
+            out.append("\\begin{%s}" % (name))
+            for j in range(nargs):
+                out.append("{%s}" % (_random_tex(rng, depth - 1, commands,
+                                                 environments, numargs,
+                                                 inline)))
+            out.append(_random_tex(rng, depth - 1, commands, environments,
+                                   numargs, inline))
+            out.append("\\end{%s}" % (name))
+        else:
+            out.append("{%s}" % (_random_tex(rng, depth - 1, commands,
+                                             environments, numargs, inline)))
+    return "".join(out)
+
+def random_case(rng, ncommands=5, nenvironments=2, nparagraphs=4, depth=2):
+    r"""
+    Return a random (defs, text) case for compare_case, drawn with the
+    random.Random rng: definitions of commands and environments, one per
+    line, and a text of paragraphs which call them, with groups, comments,
+    blank lines and a \makeatletter section. Each definition only uses the
+    ones before it, so that there is no cycle.
+    """
+    commands = []
+    environments = []
+    lines = []
+    for i in range(ncommands + nenvironments):
+        nargs = rng.randint(0, 3)
+        if i < ncommands:
+            # The last command has an @ in its name
+            name = "m" + "abcdefghijklmnopqrstuvwxyz"[i]
+            if i == ncommands - 1:
+                name = "at@" + name
+            body = _random_tex(rng, depth, commands, environments, nargs,
+                               inline=True)
+            line = "\\newcommand{\\%s}" % (name)
+            line += "[%d]" % (nargs) if nargs else ""
+            line += "{%s}" % (body)
+            if "@" in name:
+                line = "\\makeatletter " + line + " \\makeatother"
+            commands.append((name, nargs))
+        else:
+            name = "e" + "abcdefghijklmnopqrstuvwxyz"[i - ncommands]
+            begin = _random_tex(rng, depth, commands, environments, nargs,
+                                inline=True)
+            end = _random_tex(rng, depth, commands, environments,
+                              inline=True)
+            line = "\\newenvironment{%s}" % (name)
+            line += "[%d]" % (nargs) if nargs else ""
+            line += "{%s}{%s}" % (begin, end)
+            environments.append((name, nargs))
+        lines.append(line)
+    paragraphs = [_random_tex(rng, depth, commands, environments)
+                  for i in range(nparagraphs)]
+    paragraphs.insert(rng.randint(0, nparagraphs),
+                      "\\makeatletter %s\\makeatother"
+                      % (_random_tex(rng, depth, commands, environments)))
+    return "\n".join(lines) + "\n", "\n\n".join(paragraphs)
+
+def expand_case(defs, text, engine, directory=None):
+    """
+    Return the expansion of text by engine, with the definitions of the
+    .sty content defs and the private packages of directory, as ("output",
+    expansion), or ("error", name of the exception) if the expansion fails.
+    """
+    ts = Tex_stream()
+    ts.defs_db_file = None
+    ts.engine = engine
+    ts.directory = directory
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            if defs:
+                ts.scan_defs_file("defs", defs)
+            ts.compile_defs()
+            out = io.StringIO()
+            if text:
+                for chunk in ts.expand_text_chunks(text):
+                    if isinstance(chunk, Clean_input):
+                        out.write("\\input{%s}" % (chunk.file))
+                    else:
+                        out.write(chunk)
+        return ("output", out.getvalue())
+    except Exception as e:
+        return ("error", type(e).__name__)
+
+def compare_case(defs, text, engines, directory=None):
+    """Return the results of expand_case for each of engines (a dict), or
+    None if they all agree."""
+    results = {engine: expand_case(defs, text, engine, directory)
+               for engine in engines}
+    if len(set(results.values())) == 1:
+        return None
+    return results
+
+def _shrink_items(items, failing):
+    """Remove runs of items, from half of them down to single ones, as long
+    as failing(items) stays true; return the remaining items."""
+    size = len(items) // 2
+    while size >= 1:
+        i = 0
+        while i < len(items):
+            candidate = items[:i] + items[i + size:]
+            if failing(candidate):
+                items = candidate
+            else:
+                i += size
+        size //= 2
+    return items
+
+def shrink_case(defs, text, failing):
+    """
+    Return a (defs, text) case, as small as can be found by removing lines
+    of defs and lines, then characters, of text, for which failing(defs,
+    text) still holds.
+    """
+    while True:
+        size = len(defs) + len(text)
+        defs = "".join(_shrink_items(
+            defs.splitlines(True), lambda lines: failing("".join(lines), text)))
+        text = "".join(_shrink_items(
+            text.splitlines(True), lambda lines: failing(defs, "".join(lines))))
+        text = "".join(_shrink_items(
+            list(text), lambda chars: failing(defs, "".join(chars))))
+        if len(defs) + len(text) == size:
+            return defs, text
+
+class Engine_mismatch:
+    """A case on which engines disagree, as found by differential_test
+    (shrunk), with the results of each engine (see expand_case)."""
+    def __init__(self, source, defs, text, results):
+        self.source = source
+        self.defs = defs
+        self.text = text
+        self.results = results
+
+    def show(self):
+        out = "Mismatch on %s:\n--- definitions\n%s\n--- text\n%s\n" % (
+            self.source, self.defs, self.text)
+        for engine, (kind, value) in self.results.items():
+            if "error" == kind:
+                value = "(raised %s)" % (value)
+            out += "--- %s\n%s\n" % (engine, value)
+        return out
+
+def differential_test(engines=("reference", "compiled", "sparse"),
+                      cases=100, seed=0, fixtures=(), shrink=True):
+    """
+    Expand `cases` random cases (see random_case) and the fixtures, given as
+    (source, defs, text, directory) tuples, with each of engines, and return
+    the list of Engine_mismatch found, each shrunk to a minimal reproducer.
+    """
+    import random
+    rng = random.Random(seed)
+    cases = [("random case %d (seed %d)" % (i, seed),) + random_case(rng)
+             + (None,) for i in range(cases)]
+    mismatches = []
+    for source, defs, text, directory in list(fixtures) + cases:
+        results = compare_case(defs, text, engines, directory)
+        if results is None:
+            continue
+        if shrink:
+            defs, text = shrink_case(
+                defs, text, lambda defs, text: compare_case(
+                    defs, text, engines, directory) is not None)
+            results = compare_case(defs, text, engines, directory)
+        mismatches.append(Engine_mismatch(source, defs, text, results))
+    return mismatches
+
+# Post-processing
+#
+# Transforms are callables taking an iterable of lines of the expanded
+# document and generating the transformed lines. They are chained by
+# `postprocess`, which reads and writes the document once for all of them.
+
+class Rename_figures:
+    r"""Rename the figures included with \includegraphics to
+    renamestr.format(i), with i counting from start, and move their files
+    (in directory) accordingly.
+    """
+    regex = re.compile(r"\\includegraphics(\[.*\])?\{(.*)\}")
+
+    def __init__(self, renamestr, directory=".", extensions=None, start=1,
+                 summary=None):
+        if extensions is not None:
+            if isinstance(extensions, str):
+                extensions = extensions.split(',')
+            extensions = ['.'+e.strip(' .') for e in extensions]
+        self.renamestr = renamestr
+        self.directory = Path(directory)
+        self.extensions = extensions
+        self.i = start
+        self.summary = summary
+        self.siblings = os.listdir(directory)
+        self.renamed = []  # (old path, new path) of the files moved
+
+    def __call__(self, lines):
+        for line in lines:
+            tokens = []
+            pos = 0
+            for match in self.regex.finditer(line):
+                # The match returns two groups:
+                #   First group is the optional argument, which we can ignore
+                #   Second group is the filename, which we need
+                #   (group '0' is the entire match)
+                texlink = self.rename(match.group(2))
+                if texlink is None:
+                    continue
+                # Update the TeX. start(2) returns the starting index of 2nd group)
+                tokens.extend([line[pos:match.start(2)], texlink])
+                pos = match.end(2)
+            tokens.append(line[pos:])
+            yield ''.join(tokens)
+
+    def rename(self, origstem):
+        """Move the files of the figure origstem to their new name.
+        Return the new name to use in the TeX source, or None if no file
+        matches origstem.
+        """
+        extensions = self.extensions
+        origfiles = [Path(fname) for fname in self.siblings
+                     if origstem in fname]
+        if len(origfiles) == 0:
+            warn("The figure reference {} was not renamed because it does "
+                 "not point to an existing file.".format(origstem))
+            return None
+        newstem = self.renamestr.format(self.i)
+        # If there is a period in the stem we need to include the extension
+        texlink = newstem
+        if '.' in texlink or extensions is not None:
+            if extensions is None:
+                raise ValueError(
+                "Your renamed figure files have non-extension periods in "
+                "their filenames. Because of this their extension needs to "
+                "be specified in the TeX source, and for this you need to "
+                "specify a preference order for extensions with the "
+                "`extensions` option.")
+            fileexts = [p.suffix for p in origfiles]
+            filefound = False
+            for ext in extensions:
+                if ext in fileexts:
+                    texlink = str(texlink) + ext
+                    filefound = True
+                    break
+            if not filefound:
+                raise FileNotFoundError(
+                    "No file with appropriate extension was found to "
+                    f"match {newstem}")
+        # Move the image files
+        for ofile in origfiles:
+            # Note: newstem may contain 'suffixes' which need to be kept
+            # (e.g. NECO asks for the format Figure.1.eps, …)
+            nfile = Path(newstem + ofile.suffix)
+            move_if_changed(self.directory/ofile, self.directory/nfile,
+                            self.summary)
+            self.renamed.append((self.directory/ofile, self.directory/nfile))
+        self.i += 1
+        return texlink
+
+class Fix_bib_filenames:
+    r"""Replace underscores by hyphens in the bibliography files named by
+    \bibliography (FLaP prefixes files from subdirectories with
+    'subdir_', which bibtex does not accept), and rename the .bib files in
+    directory accordingly.
+    """
+    regex = re.compile(r"\\bibliography\{([^}]*)\}")
+
+    def __init__(self, directory=".", summary=None):
+        self.directory = Path(directory)
+        self.summary = summary
+
+    def __call__(self, lines):
+        for line in lines:
+            if "\\bibliography" in line:
+                line = self.regex.sub(self.fix, line)
+            yield line
+
+    def fix(self, match):
+        names = []
+        for name in match.group(1).split(","):
+            fixed = name.replace("_", "-")
+            src = self.directory/(name.strip() + ".bib")
+            if fixed != name and src.exists():
+                move_if_changed(src, self.directory/(fixed.strip() + ".bib"),
+                                self.summary)
+            names.append(fixed)
+        return "\\bibliography{%s}" % (",".join(names))
+
+class Embed_bbl:
+    r"""Replace \bibliography{...} by the content of bblfile, as produced by
+    bibtex, so that the document can be compiled without it.
+    """
+    regex = re.compile(r"\\bibliography\{[^}]*\}")
+
+    def __init__(self, bblfile):
+        self.bblfile = bblfile
+
+    def __call__(self, lines):
+        for line in lines:
+            match = (self.regex.search(line) if "\\bibliography" in line
+                     else None)
+            if match is None or _in_comment(line, match.start()):
+                yield line
+                continue
+            yield line[:match.start()]
+            with open(self.bblfile, 'r') as bblfp:
+                yield from bblfp
+            yield line[match.end():]
+
+escape_word_end_re = re.compile(r"(?<!\\)(?:\\\\)*\\[^\W\d_]+$")
+
+class Strip_comments:
+    r"""Remove the comments, as `tokenize` does with strip_comments: a
+    comment also removes the end of its line and the blanks starting the next
+    line (unless it is empty, since it then ends a paragraph), and a line
+    holding only a comment is removed entirely.
+    """
+    def __call__(self, lines):
+        pending = None  # What precedes a comment, to be joined to next line
+        for line in lines:
+            if pending is not None:
+                rest = line.lstrip(" \t")
+                if "" == rest or "\n" == rest:
+                    yield pending + "\n"
+                elif escape_word_end_re.search(pending) and isletter(rest[0]):
+                    # Keep the control word from running into the next line
+                    line = pending + " " + rest
+                else:
+                    line = pending + rest
+                pending = None
+            i = line.find("%")
+            while 0 <= i and _is_escaped(line, i):
+                i = line.find("%", i + 1)
+            if i < 0:
+                yield line
+            elif not line[:i].strip(" \t"):
+                pass  # The line holds only a comment
+            elif line.endswith("\n"):
+                pending = line[:i]
+            else:  # Last line
+                yield line[:i]
+        if pending is not None:
+            yield pending + "\n"
+
+def postprocess(infile, outfile, transforms, summary=None):
+    """
+    Apply transforms to infile, in order, and write the result to outfile,
+    in a single read/write pass (outfile is only replaced if it changed).
+    """
+    with open(infile, 'r') as infp, \
+         output_file(outfile, summary) as outfp:
+        lines = infp
+        for transform in transforms:
+            lines = transform(lines)
+        outfp.writelines(lines)
+
+def _rename_figures(renamestr, maintex, extensions=None, start=1,
+                    summary=None):
+    """This function added by Alexandre René.
+    Outputs whose content is unchanged are left alone; they are recorded in
+    summary (an Output_summary), if given.
+    Return the (old path, new path) of the figure files renamed.
+    """
     maintex = Path(maintex)
-    if extensions is not None:
-        if isinstance(extensions, str):
-            extensions = extensions.split(',')
-        extensions = ['.'+e.strip(' .') for e in extensions]
     root = maintex.stem
-    os.chdir(maintex.parent)
-    siblings = os.listdir()
+    directory = maintex.parent
     if '{' in renamestr and '}' in renamestr:
         # Passing an invalid substitution string prevents figure renaming
         if str(root).endswith('-clean'):
-            cleanroot = Path(root).with_suffix('.tex')
+            cleanroot = directory/Path(root).with_suffix('.tex')
         else:
-            cleanroot = Path(str(root) + "-clean.tex")
+            cleanroot = directory/(str(root) + "-clean.tex")
         renamedroot = cleanroot.with_suffix(".renamed.tex")
         if not cleanroot.exists():
             raise FileNotFoundError(f"Could not find the file {cleanroot}.")
-        regex = re.compile(r"\\includegraphics(\[.*\])?\{(.*)\}")
-        with open(cleanroot, 'r') as f:
-            tex = f.read()
-        tokens = []
-        pos = 0
-        i = start
-        for match in regex.finditer(tex):
-            # The match returns two groups:
-            #   First group is the optional argument, which we can ignore
-            #   Second group is the filename, which we need
-            #   (group '0' is the entire match)
-            origstem = match.group(2)
-            origfiles = [Path(fname) for fname in siblings
-                         if origstem in fname]
-            if len(origfiles) == 0:
-                warn("The figure reference {} was not renamed because it does "
-                     "not point to an existing file.".format(origstem))
+        rename = Rename_figures(renamestr, directory, extensions, start,
+                                summary)
+        postprocess(cleanroot, renamedroot, [rename], summary)
+        return rename.renamed
+    return []
+
+class Linking_file_system(flap.ui.OSFileSystem):
+    """FLaP file system which places the files it copies (figures, ...)
+    with `place_file`, instead of copying their bytes.
+    """
+    def __init__(self, hardlink=True):
+        super().__init__()
+        self.hardlink = hardlink
+
+    def copy(self, file, destination):
+        self._create_path(destination)
+        source = self.for_OS(file.path())
+        target = destination if destination.has_extension() \
+            else destination / file.fullname()
+        place_file(source, self.for_OS(target), self.hardlink)
+
+class Syncing_file_system(Linking_file_system):
+    """
+    FLaP file system which updates an output directory incrementally:
+    it keeps an `Output_manifest` of the files it placed there, and only
+    places the files which changed since the previous run. `finish` removes
+    the files placed by the previous run which were not placed again.
+    Placed files renamed afterwards (see `renamed`) are moved back to be
+    renamed again, instead of being placed again.
+    """
+    def __init__(self, directory, hardlink=True, summary=None):
+        super().__init__(hardlink)
+        self.manifest = Output_manifest(directory)
+        self.summary = summary
+        self.placed = set()
+        self.restored = set()  # (name, renamed path) of the files moved back
+        self.previous_renamed = {
+            entry["renamed"] for entry in self.manifest.entries.values()
+            if entry.get("renamed") is not None}
+
+    def copy(self, file, destination):
+        self._create_path(destination)
+        source = self.for_OS(file.path())
+        target = self.for_OS(destination if destination.has_extension()
+                             else destination / file.fullname())
+        name = self.manifest.name(target)
+        self.placed.add(name)
+        renamed = self.manifest.renamed_file(name, source)
+        if renamed is not None and not os.path.exists(target):
+            Path(renamed).replace(target)  # Keeps its mtime
+            self.restored.add((name, renamed))
+        self.manifest.entries.get(name, {}).pop("renamed", None)
+        changed = not self.manifest.up_to_date(name, source)
+        if changed:
+            digest = file_hash(source).hex()
+            entry = self.manifest.entries.get(name)
+            # A source touched without changing its content
+            changed = not (entry is not None and digest == entry["sha256"]
+                           and _stat_key(target) == entry["stat"])
+            if changed:
+                place_file(source, target, self.hardlink)
+            self.manifest.record(name, source, digest)
+        if self.summary is not None:
+            self.summary.add(target, changed)
+
+    def create_file(self, path, content):
+        self._create_path(path)
+        target = self.for_OS(path)
+        with output_file(target, self.summary) as fp:
+            fp.write(content)
+        name = self.manifest.name(target)
+        self.placed.add(name)
+        self.manifest.record(name, None,
+                             hashlib.sha256(content.encode()).hexdigest())
+
+    def renamed(self, moves):
+        """Record that placed files were renamed, from the first to the
+        second path of each pair of moves."""
+        for src, dst in moves:
+            name = self.manifest.name(src)
+            entry = self.manifest.entries.get(name)
+            if entry is None:
                 continue
-            newstem = renamestr.format(i)
-            # If there is a period in the stem we need to include the extension
-            texlink = newstem
-            if '.' in texlink or extensions is not None:
-                if extensions is None:
-                    raise ValueError(
-                    "Your renamed figure files have non-extension periods in "
-                    "their filenames. Because of this their extension needs to "
-                    "be specified in the TeX source, and for this you need to "
-                    "specify a preference order for extensions with the "
-                    "`extensions` option.")
-                fileexts = [p.suffix for p in origfiles]
-                filefound = False
-                for ext in extensions:
-                    if ext in fileexts:
-                        texlink = str(texlink) + ext
-                        filefound = True
-                        break
-                if not filefound:
-                    raise FileNotFoundError(
-                        "No file with appropriate extension was found to "
-                        f"match {newstem}")
-
-            # Update the TeX. start(2) returns the starting index of 2nd group)
-            tokens.extend([tex[pos:match.start(2)], texlink])
-            pos = match.end(2)
-
-            #tex = tex[:match.start(2)] + newstem + tex[match.end(2):]
-            # print()
-            # print(tex[match.start(2)-10:match.start(2)])
-            # print(tex[match.end(2):match.end(2)+10])
-            # Move the image files
-            for ofile in origfiles:
-                # Note: newstem may contain 'suffixes' which need to be kept
-                # (e.g. NECO asks for the format Figure.1.eps, …)
-                nfile = Path(newstem + ofile.suffix)
-                ofile.replace(nfile)
-            i += 1
-        tokens.append(tex[pos:])
-        with open(renamedroot, 'w') as f:
-            f.write(''.join(tokens))
+            entry["renamed"] = self.manifest.name(dst)
+            entry["stat"] = _stat_key(dst)
+            if ((name, os.path.abspath(dst)) in self.restored
+                and self.summary is not None
+                and (str(src), str(dst)) in self.summary.moved):
+                # Moved back and forth: the output did not change
+                self.summary.moved.remove((str(src), str(dst)))
+
+    def finish(self):
+        "Remove the stale files and save the manifest."
+        entries = self.manifest.entries
+        stale = set(entries) - self.placed
+        current_renamed = {entries[name].get("renamed")
+                           for name in self.placed if name in entries}
+        stale |= self.previous_renamed - current_renamed - self.placed
+        for name in sorted(stale):
+            target = os.path.join(self.manifest.directory, name)
+            if os.path.isfile(target):
+                os.remove(target)
+                if self.summary is not None:
+                    self.summary.removed.append(target)
+            entries.pop(name, None)
+        self.manifest.save()
+
+# Pipelines
+
+class Pipeline_error(RuntimeError):
+    """Exception raised when a stage of a Pipeline fails.
+
+    Attributes:
+        stage -- name of the failed stage
+    """
+
+    def __init__(self, stage, message):
+        self.stage = stage
+        super().__init__("Stage %s failed: %s" % (stage, message))
+
+class Pipeline_stage:
+    """
+    A stage of a Pipeline. `run` is called without arguments, does the work
+    of the stage and returns the files it produced. The stage depends on the
+    stages named in deps, and reads their outputs and the files of inputs
+    (a list, or a callable returning one). params are the other values its
+    result depends on; they must be JSON-serializable.
+    """
+    def __init__(self, name, run, deps=(), inputs=(), params=None):
+        self.name = name
+        self.run = run
+        self.deps = tuple(deps)
+        self.inputs = inputs
+        self.params = params
+
+class Pipeline:
+    """
+    Run stages as a dependency graph: a stage starts as soon as the stages it
+    depends on are done, so independent stages run concurrently, on up to
+    `workers` threads.
+
+    With a cache_file, a stage whose params and input files (including the
+    outputs of the stages it depends on, directly or not) have the same
+    content as when it last ran,
+    and whose outputs have not changed since, is skipped. Hashes are kept
+    in the cache file too, and only recomputed for files whose size or
+    mtime changed.
+
+    After `run`, `records` gives the start, end and duration of each stage,
+    and `critical_path` the chain of stages which set the total time.
+    """
+    version = 1  # Increase when the format of the cache file changes
+
+    def __init__(self, stages, cache_file=None, workers=4):
+        self.stages = {}
+        for stage in stages:
+            if stage.name in self.stages:
+                raise ValueError("Duplicate stage %s" % (stage.name))
+            self.stages[stage.name] = stage
+        for stage in stages:
+            for dep in stage.deps:
+                if dep not in self.stages:
+                    raise ValueError("Stage %s depends on the unknown stage "
+                                     "%s" % (stage.name, dep))
+        self.order = self._topological_order()
+        self.cache_file = cache_file
+        self.workers = workers
+        self.records = {}
+        self.seconds = None
+        self._cache = {"stages": {}, "hashes": {}}
+
+    def _topological_order(self):
+        order, state = [], {}
+        def visit(name, path):
+            if state.get(name) == "done":
+                return
+            if state.get(name) == "visiting":
+                raise ValueError("Cyclic stages: %s"
+                                 % (" -> ".join(path + [name])))
+            state[name] = "visiting"
+            for dep in self.stages[name].deps:
+                visit(dep, path + [name])
+            state[name] = "done"
+            order.append(name)
+        for name in self.stages:
+            visit(name, [])
+        return order
+
+    def _load_cache(self):
+        import json
+        if self.cache_file is None or not os.path.isfile(self.cache_file):
+            return
+        try:
+            with open(self.cache_file) as fp:
+                data = json.load(fp)
+        except ValueError:
+            return
+        if data.get("version") == self.version:
+            self._cache = data
+
+    def _save_cache(self):
+        import json
+        if self.cache_file is None:
+            return
+        self._cache["version"] = self.version
+        atomic_write(self.cache_file,
+                     json.dumps(self._cache, indent=1).encode())
+
+    def file_hash(self, filename):
+        "Return the hex digest of filename, or None if it does not exist."
+        filename = os.path.abspath(filename)
+        key = _stat_key(filename)
+        if key is None:
+            return None
+        cached = self._cache["hashes"].get(filename)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        digest = file_hash(filename).hex()
+        self._cache["hashes"][filename] = [key, digest]
+        return digest
+
+    def _ancestors(self, name):
+        "Return the stages name depends on, directly or not."
+        found = set()
+        stack = list(self.stages[name].deps)
+        while stack:
+            dep = stack.pop()
+            if dep not in found:
+                found.add(dep)
+                stack.extend(self.stages[dep].deps)
+        return sorted(found)
+
+    def _stage_key(self, stage):
+        import json
+        inputs = stage.inputs() if callable(stage.inputs) else stage.inputs
+        files = [os.path.abspath(f) for f in inputs]
+        # A stage may read the outputs of any stage before it
+        for dep in self._ancestors(stage.name):
+            files.extend(self.records[dep]["outputs"])
+        hashes = {f: self.file_hash(f) for f in sorted(set(files))}
+        return hashlib.sha256(json.dumps(
+            [stage.name, stage.params, hashes], sort_keys=True).encode()
+            ).hexdigest()
+
+    def _execute(self, name):
+        import time
+        stage = self.stages[name]
+        record = self.records[name] = {"start": time.monotonic() - self._t0,
+                                       "cached": False}
+        record["outputs"] = []
+        try:
+            key = self._stage_key(stage)
+            cached = self._cache["stages"].get(name)
+            if (cached is not None and cached["key"] == key
+                and all(self.file_hash(f) == digest
+                        for f, digest in cached["outputs"].items())):
+                print("Stage %s: up to date" % (name))
+                record["cached"] = True
+                outputs = list(cached["outputs"])
+            else:
+                print("Stage %s: running" % (name))
+                self._cache["stages"].pop(name, None)
+                outputs = [os.path.abspath(f) for f in stage.run()]
+                self._cache["stages"][name] = {
+                    "key": key,
+                    "outputs": {f: self.file_hash(f) for f in outputs}}
+            record["outputs"] = sorted(outputs)
+        except BaseException:
+            record["failed"] = True
+            raise
+        finally:
+            record["end"] = time.monotonic() - self._t0
+            record["seconds"] = record["end"] - record["start"]
+        print("Stage %s: done in %.2f s" % (name, record["seconds"]))
+
+    def run(self):
+        """Run the stages. Raise Pipeline_error if one fails, once the
+        stages already started are done; the stages depending on it are
+        not started."""
+        import time
+        from concurrent.futures import (ThreadPoolExecutor, wait,
+                                        FIRST_COMPLETED)
+        self._load_cache()
+        self._t0 = time.monotonic()
+        self.records = {}
+        done, running, failed = set(), {}, None
+        with ThreadPoolExecutor(max_workers=max(1, self.workers)) as executor:
+            while True:
+                if failed is None:
+                    for name in self.order:
+                        if (name not in done and name not in running.values()
+                            and all(dep in done
+                                    for dep in self.stages[name].deps)):
+                            future = executor.submit(self._execute, name)
+                            running[future] = name
+                if not running:
+                    break
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    error = future.exception()
+                    if error is None:
+                        done.add(name)
+                    elif failed is None:
+                        failed = (name, error)
+        self.seconds = time.monotonic() - self._t0
+        self._save_cache()
+        if failed is not None:
+            name, error = failed
+            raise Pipeline_error(name, error) from error
+
+    def critical_path(self):
+        """Return the chain of stages, in order, whose durations add up to
+        the longest time, and that time."""
+        finish, previous = {}, {}
+        for name in self.order:
+            if name not in self.records:
+                continue
+            deps = [dep for dep in self.stages[name].deps if dep in finish]
+            before = max(deps, key=finish.get, default=None)
+            previous[name] = before
+            finish[name] = (self.records[name]["seconds"]
+                            + (finish[before] if before else 0.))
+        if not finish:
+            return [], 0.
+        name = max(finish, key=finish.get)
+        total = finish[name]
+        path = []
+        while name is not None:
+            path.append(name)
+            name = previous[name]
+        return path[::-1], total
+
+    def report(self):
+        path, seconds = self.critical_path()
+        return {"version": 1, "seconds": self.seconds,
+                "critical_path": path, "critical_path_seconds": seconds,
+                "stages": {name: self.records[name] for name in self.order
+                           if name in self.records}}
+
+    def print_report(self):
+        for name in self.order:
+            if name not in self.records:
+                print("  %-10s not run" % (name))
+                continue
+            record = self.records[name]
+            status = ("failed" if record.get("failed")
+                      else "cached" if record["cached"] else "ran")
+            print("  %-10s %7.2f s -> %7.2f s  (%.2f s, %s)" % (
+                name, record["start"], record["end"], record["seconds"],
+                status))
+        path, seconds = self.critical_path()
+        print("Critical path: %s (%.2f s of %.2f s)"
+              % (" -> ".join(path), seconds, self.seconds))
 
 # Main
+def budget_options(command):
+    "Add the options of an Expansion_budget to a click command."
+    options = [
+        click.option('--max-expansions', type=int, default=None,
+                     help="Fail after this many macro expansions."),
+        click.option('--max-ratio', type=float, default=None,
+                     help="Fail when the expansions produce more than this "
+                          "many tokens per input token."),
+        click.option('--max-macro-tokens', type=int, default=None,
+                     help="Fail when a single macro expands to more than "
+                          "this many tokens."),
+        click.option('--timeout', type=float, default=None,
+                     help="Fail when the expansion takes longer than this "
+                          "many seconds."),
+        ]
+    for option in reversed(options):
+        command = option(command)
+    return command
+
+def check_engine(ctx, param, value):
+    "Check that the --engine option names a registered engine."
+    if value not in engines:
+        raise click.BadParameter("unknown engine %r (registered: %s)"
+                                 % (value, ", ".join(sorted(engines))))
+    return value
+
+def make_budget(max_expansions, max_ratio, max_macro_tokens, timeout):
+    "Return the Expansion_budget of the command line options, or None."
+    if (max_expansions, max_ratio, max_macro_tokens, timeout) == (None,)*4:
+        return None
+    return Expansion_budget(max_expansions, max_ratio, timeout,
+                            max_macro_tokens)
+
 @click.command()
 @click.option('--debug/--no-debug', default=False)
 @click.option('--defs', default=None, type=click.File('r'))
+@click.option('--engine', default='compiled', metavar="NAME",
+              callback=check_engine,
+              help="'compiled' pre-expands the definitions on first use "
+                   "and expands the document in a single pass; "
+                   "'sparse' does the same, but only tokenizes the "
+                   "paragraphs which contain defined macros and copies the "
+                   "rest verbatim; 'reference' is the original recursive "
+                   "expansion. Other engines can be added with "
+                   "register_engine. Default: compiled.")
 @click.option('--renamefigs', default="figure_{}",
               help="Rename figures sequentially. Brackets are substituted by "
                    "the figure number with Python's `format` method, and the "
@@ -1179,12 +4328,121 @@ def _rename_figures(renamestr, maintex, extensions=None, start=1):
                    "pass multiple values by separating them with commas. "
                    "This will fix the file extension in the TeX source. "
                    "(Generally not recommended, but sometimes required.)")
+@click.option('--cache/--no-cache', default=True,
+              help="Share parsed definitions files across projects through "
+                   "a user-level cache, keyed by their content, and cache "
+                   "the tokenized documents. Default: --cache.")
+@click.option('--cache-dir', default=None,
+              type=click.Path(file_okay=False, dir_okay=True),
+              help="Location of the cache. Default: $EXPAND_LATEX_MACROS_CACHE, "
+                   "or expand-latex-macros in $XDG_CACHE_HOME or ~/.cache.")
+@click.option('--block-cache/--no-block-cache', default=False,
+              help="Expand the document paragraph by paragraph, and cache "
+                   "the expanded paragraphs, so that the next runs only "
+                   "expand the paragraphs which changed. "
+                   "Default: --no-block-cache.")
+@click.option('--write-inputs/--no-write-inputs', default=False,
+              help="Also write the expanded file-clean.tex of each \\input "
+                   "file. By default they are kept in memory and spliced "
+                   "directly into the main file.")
+@click.option('--strip-comments/--keep-comments', default=False,
+              help="Remove comments from the expanded document while "
+                   "tokenizing it, as TeX would ignore them. "
+                   "Default: --keep-comments.")
+@click.option('--hardlink/--no-hardlink', default=True,
+              help="Place the files copied to OUTPUTDIR as hard links to "
+                   "the originals when reflinks are not supported (and the "
+                   "directories are on the same file system). With hard "
+                   "links, editing a figure in place in OUTPUTDIR also "
+                   "changes the original. Default: --hardlink.")
+@click.option('--incremental/--no-incremental', default=False,
+              help="Update OUTPUTDIR incrementally: keep a manifest of the "
+                   "files placed there, and on the next runs only add, "
+                   "update or remove the files which changed. "
+                   "Default: --no-incremental.")
+@click.option('--profile-memory', type=click.Path(dir_okay=False),
+              default=None,
+              help="Record the memory used by each stage (with tracemalloc "
+                   "and RSS sampling) and write a JSON report to this file. "
+                   "This slows down the run considerably.")
+@click.option('--profile', type=click.Path(dir_okay=False), default=None,
+              help="Time each stage and write a JSON report to this file.")
+@click.option('--profile-pstats', type=click.Path(dir_okay=False),
+              default=None,
+              help="Profile the run with cProfile and write the statistics "
+                   "to this file (to be read with pstats or snakeviz).")
+@click.option('--profile-stacks', type=click.Path(dir_okay=False),
+              default=None,
+              help="Sample the stack of the run and write it to this file "
+                   "as collapsed stacks, for flamegraph tools.")
+@click.option('--jobs', '-j', type=int, default=1,
+              help="Number of processes used to expand \\input files "
+                   "concurrently. Default: 1.")
+@click.option('--target', 'targets', multiple=True, metavar="SPEC",
+              help="Write a variant of the expanded document, as "
+                   "merged-NAME-clean.tex, instead of merged-clean.tex. "
+                   "SPEC is NAME[:keep=MACRO,...][:defs=FILE,...]: the "
+                   "given macros and environments are not expanded, and the "
+                   "definitions of FILE are added. Can be given several "
+                   "times; the document is tokenized once for all targets, "
+                   "which --jobs expands concurrently. Figures are not "
+                   "renamed.")
+@budget_options
 @click.argument('maintex', type=click.Path(exists=False,
                                            file_okay=True, dir_okay=False))
 @click.argument('outputdir', type=click.Path(exists=False,
                                              file_okay=False, dir_okay=True),
                 default="flat-latex")
-def main(maintex, outputdir, renamefigs, figexts, debug, defs):
+def main(maintex, outputdir, renamefigs, figexts, debug, defs, engine,
+         cache, cache_dir, block_cache, jobs, write_inputs, strip_comments,
+         hardlink, incremental, profile_memory, profile, profile_pstats,
+         profile_stacks, targets, max_expansions, max_ratio,
+         max_macro_tokens, timeout):
+
+    try:
+        targets = [Expansion_target.parse(spec) for spec in targets]
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint="--target")
+
+    memory_profiler = Memory_profiler(enabled=profile_memory is not None)
+    time_profiler = Time_profiler(
+        enabled=(profile, profile_pstats, profile_stacks) != (None,)*3,
+        cprofile=profile_pstats is not None,
+        sample=profile_stacks is not None)
+    profile_memory, profile, profile_pstats, profile_stacks = [
+        None if filename is None else os.path.abspath(filename)
+        for filename in (profile_memory, profile, profile_pstats,
+                         profile_stacks)]
+    # Timings don't include the cost of memory profiling
+    profiler = Profiler_group(memory_profiler, time_profiler)
+    profiler.start()
+    try:
+        _main(maintex, outputdir, renamefigs, figexts, debug, defs, engine,
+              cache, cache_dir, block_cache, jobs, write_inputs,
+              strip_comments, hardlink, incremental, profiler,
+              make_budget(max_expansions, max_ratio, max_macro_tokens,
+                          timeout), targets)
+    except Expansion_limit_error as e:
+        raise click.ClickException(str(e))
+    finally:
+        profiler.stop()
+        if profile_memory is not None:
+            memory_profiler.write_report(profile_memory)
+            print("Memory profile written to %s" % (profile_memory))
+        if profile is not None:
+            time_profiler.write_report(profile)
+            print("Stage timings written to %s" % (profile))
+        if profile_pstats is not None:
+            time_profiler.write_pstats(profile_pstats)
+            print("cProfile statistics written to %s" % (profile_pstats))
+        if profile_stacks is not None:
+            time_profiler.write_collapsed(profile_stacks)
+            print("Sampled stacks written to %s" % (profile_stacks))
+
+def _main(maintex, outputdir, renamefigs, figexts, debug, defs, engine,
+          cache, cache_dir, block_cache, jobs, write_inputs,
+          strip_comments, hardlink, incremental, profiler, budget=None,
+          targets=()):
 
     # flap_output_dir = Path("_tmp_expand_macros/")
     flap_output_dir = Path(outputdir)
@@ -1193,10 +4451,16 @@ def main(maintex, outputdir, renamefigs, figexts, debug, defs):
     # First use flap to flatten the latex into a single file
     print("Merging files with FLaP...")
     os.makedirs(flap_output_dir, exist_ok=True)
-    flap.ui.Controller(
-        flap.ui.OSFileSystem(),
-        flap.ui.Display(sys.stdout, verbose=False)
-        ).run(maintex, str(flap_output_dir))
+    outputs = Output_summary()
+    if incremental:
+        file_system = Syncing_file_system(flap_output_dir, hardlink, outputs)
+    else:
+        file_system = Linking_file_system(hardlink)
+    with profiler.stage("flap merge", maintex):
+        flap.ui.Controller(
+            file_system,
+            flap.ui.Display(sys.stdout, verbose=False)
+            ).run(maintex, str(flap_output_dir))
 
     # Now run the ported de-macro code
     print("Expanding macros...")
@@ -1215,18 +4479,104 @@ def main(maintex, outputdir, renamefigs, figexts, debug, defs):
     ts.defs_db = defs_db
     ts.defs_db_file = defs_db_file
     ts.debug = debug
-
-    ts.restore_defs()
-    ts.process_file(root)
+    ts.engine = engine
+    if cache:
+        ts.defs_cache = Defs_cache(cache_dir)
+        ts.token_cache = Token_cache(cache_dir)
+    if block_cache:
+        ts.block_cache = Block_cache(cache_dir)
+    ts.jobs = jobs
+    ts.write_inputs = write_inputs
+    ts.strip_comments = strip_comments
+    ts.outputs = outputs
+    ts.profiler = profiler
+    ts.budget = budget
+
+    with profiler.stage("defs loading", defs_db):
+        ts.restore_defs()
+    if targets:
+        ts.process_targets(root, targets)
+    else:
+        ts.process_file(root)
     # for root in restargs:
     #     ts.process_file(root)
 
     print("(Re)creating defs db %s" % (defs_db))
-    ts.save_defs()
+    with profiler.stage("defs saving", defs_db):
+        ts.save_defs()
     del ts  # We are done with de-macro; free the associated memory
 
+    if targets:
+        if incremental:
+            file_system.finish()
+        outputs.report()
+        return
+
     # Replace figure names
-    _rename_figures(renamefigs, root, extensions=figexts)
+    with profiler.stage("figure renaming", root):
+        renamed = _rename_figures(renamefigs, root, extensions=figexts,
+                                  summary=outputs)
+    if incremental:
+        # The manifest follows the placed figures to their new names
+        file_system.renamed(renamed)
+        file_system.finish()
+    outputs.report()
+
+@click.command()
+@click.option('--defs', 'defs_files', multiple=True,
+              type=click.Path(dir_okay=False),
+              help="Definitions file (.sty); can be given several times. "
+                   "Private packages loaded by the input are also used.")
+@click.option('--engine', default='compiled', metavar="NAME",
+              callback=check_engine,
+              help="Expansion engine, see expand-latex-macros. "
+                   "Default: compiled.")
+@click.option('--strip-comments/--keep-comments', default=False,
+              help="Remove comments. Default: --keep-comments.")
+@click.option('--cache/--no-cache', default=False,
+              help="Use the user-level cache of parsed definitions files, "
+                   "which writes files there. Default: --no-cache.")
+@click.option('--cache-dir', type=click.Path(file_okay=False), default=None,
+              help="Location of the definitions cache.")
+@budget_options
+def expand_filter(defs_files, engine, strip_comments, cache, cache_dir,
+                  max_expansions, max_ratio, max_macro_tokens, timeout):
+    """
+    Expand the macros of already flattened TeX read from stdin, and write
+    the result to stdout. Nothing else is written: no intermediate files,
+    no definitions db, no cache files (unless --cache); messages go to
+    stderr.
+
+    The input is expanded block by block (a block ends at an empty line,
+    once all its macro calls are complete), and each block is written as
+    soon as it is expanded, so the command can sit in a pipe:
+
+    $ cat merged.tex | expand-latex-filter --defs macros.sty > expanded.tex
+    """
+    out = sys.stdout
+    with contextlib.redirect_stdout(sys.stderr):
+        ts = Tex_stream()
+        ts.defs = ({}, {})
+        ts.defs_db_file = None
+        ts.engine = engine
+        ts.strip_comments = strip_comments
+        if cache:
+            ts.defs_cache = Defs_cache(cache_dir)
+        # The budget also limits loading and compiling the definitions
+        ts.budget = make_budget(max_expansions, max_ratio, max_macro_tokens,
+                                timeout)
+        try:
+            for defs_file in defs_files:
+                ts.add_defs(cut_extension(defs_file, ".sty"))
+            for chunk in ts.filter_chunks(sys.stdin):
+                if isinstance(chunk, Clean_input):
+                    # The input is flattened: \input is left alone
+                    out.write("\\input{%s}" % (chunk.file))
+                else:
+                    out.write(chunk)
+                out.flush()
+        except Expansion_limit_error as e:
+            raise click.ClickException(str(e))
 
 @click.command()
 @click.option('--renamestr', type=str, default='figure_{}')
@@ -1239,7 +4589,224 @@ def main(maintex, outputdir, renamefigs, figexts, debug, defs):
                    "(Generally not recommended, but sometimes required.)")
 @click.argument('maintex', type=click.Path(exists=True, file_okay=True, dir_okay=False))
 def rename_figures(renamestr, maintex, start, figexts):
-    return _rename_figures(renamestr, maintex, extensions=figexts, start=start)
+    summary = Output_summary()
+    _rename_figures(renamestr, maintex, extensions=figexts, start=start,
+                    summary=summary)
+    summary.report()
+
+@click.command()
+@click.option('--strip-comments/--keep-comments', default=False,
+              help="Remove comments. Default: --keep-comments.")
+@click.option('--fix-bib/--no-fix-bib', default=False,
+              help="Replace underscores by hyphens in the bibliography "
+                   "filenames, and rename the .bib files accordingly.")
+@click.option('--embed-bbl', type=click.Path(exists=True, dir_okay=False),
+              default=None,
+              help="Replace \\bibliography by the content of this .bbl file.")
+@click.option('--renamestr', type=str, default=None,
+              help="Rename figures with this format string, e.g. "
+                   "'figure_{}'. By default figures are not renamed.")
+@click.option('--start', type=int, default=1,
+              help="Start numbering figures with this value.")
+@click.option('--figexts', default=None,
+              help="Define an order of preference for figure extensions; "
+                   "pass multiple values by separating them with commas.")
+@click.argument('texfile', type=click.Path(exists=True, file_okay=True, dir_okay=False))
+@click.argument('outfile', type=click.Path(dir_okay=False), required=False)
+def postprocess_latex(strip_comments, fix_bib, embed_bbl, renamestr, start,
+                      figexts, texfile, outfile):
+    """
+    Apply the selected post-processing steps to TEXFILE (typically
+    merged-clean.tex) in a single read/write pass, and write the result to
+    OUTFILE (default: TEXFILE with the suffix .final.tex).
+
+    Steps are applied in this order: comment stripping, bibliography
+    filename fixing, .bbl embedding, figure renaming. Figure and .bib files
+    are looked for, and renamed, in the directory of TEXFILE.
+    """
+    texfile = Path(texfile)
+    directory = texfile.parent
+    if outfile is None:
+        outfile = texfile.with_suffix(".final.tex")
+    summary = Output_summary()
+    transforms = []
+    if strip_comments:
+        transforms.append(Strip_comments())
+    if fix_bib:
+        transforms.append(Fix_bib_filenames(directory, summary))
+    if embed_bbl is not None:
+        transforms.append(Embed_bbl(embed_bbl))
+    if renamestr is not None:
+        transforms.append(Rename_figures(renamestr, directory, figexts,
+                                         start, summary))
+    postprocess(texfile, outfile, transforms, summary)
+    summary.report()
+
+@click.command()
+@click.option('--workers', type=int, default=8,
+              help="Number of files placed concurrently. Default: 8.")
+@click.option('--hardlink/--no-hardlink', default=True,
+              help="Use hard links when reflinks are not supported. "
+                   "Default: --hardlink.")
+@click.argument('flatdir', type=click.Path(exists=True, file_okay=False, dir_okay=True))
+@click.argument('figdir', type=click.Path(exists=True, file_okay=False, dir_okay=True))
+def cp_eps(flatdir, figdir, workers, hardlink):
+    """
+    Place the .eps version of each figure of FIGDIR in FLATDIR, next to the
+    figure FLaP copied there (FLaP only copies .pdf figures).
+    FLaP names the figures of FIGDIR 'FIGDIR_name'; FIGDIR must therefore
+    be exactly one directory deep (e.g. 'figures', not 'figures/eps').
+    Files are reflinked or hard linked when possible, and copied otherwise.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    figprefix = os.path.basename(os.path.normpath(figdir))
+    jobs = []
+    for filename in os.listdir(flatdir):
+        if filename.startswith(figprefix+'_'):
+            targetfilename = os.path.splitext(filename)[0] + '.eps'
+            sourcefilename = targetfilename[len(figprefix)+1:]
+            sourcepathname = os.path.join(figdir, sourcefilename)
+            targetpathname = os.path.join(flatdir, targetfilename)
+            if os.path.exists(sourcepathname):
+                jobs.append((sourcepathname, targetpathname))
+            else:
+                warn("Missing eps file '{}'".format(sourcepathname))
+    methods = {}
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        for method in executor.map(
+              lambda job: place_file(*job, hardlink=hardlink), jobs):
+            methods[method] = methods.get(method, 0) + 1
+    print("Placed %d .eps files (%s)" % (
+        len(jobs), ", ".join("%d %s" % (n, method)
+                             for method, n in sorted(methods.items()))))
+
+def _ps_string(s):
+    "Return `s` as a PostScript string literal."
+    s = str(s).replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)')
+    return f"({s})"
+
+class Ghostscript_worker:
+    """A long-lived ghostscript interpreter to which files are fed one after
+    another through its PostScript command stream, instead of starting a new
+    `gs` process for each file.
+
+    Each job is sent as a single line which sets the output file, runs the
+    input file and prints a marker telling whether it succeeded. The input
+    runs between `save` and `restore`, and the operand and dictionary stacks
+    are emptied after it, so that each file is converted as by a separate
+    `gs` run, whatever the files before it defined or left behind. Output
+    files are only guaranteed to be complete once the interpreter is closed.
+    """
+    ok_marker = "%%[elm-ok"
+    fail_marker = "%%[elm-fail"
+
+    def __init__(self, flags, gs="gs"):
+        import shlex, subprocess
+        cmd = shlex.split(gs) if isinstance(gs, str) else list(gs)
+        # `-` makes gs read PostScript from stdin; there is no -dBATCH, since
+        # the interpreter exits when we close its stdin.
+        self.cmd = cmd + [f for f in flags if f != "-dBATCH"] + ["-"]
+        self.njobs = 0
+        self.proc = subprocess.Popen(
+            self.cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT, text=True, bufsize=1)
+
+    @classmethod
+    def job_command(cls, inpath, outpath, jobid=0):
+        "Return the PostScript line which converts one file."
+        # The job is bound before the input runs, so that operators the
+        # input redefines don't affect it. The page device is set outside
+        # the save, which would otherwise restore the previous output file.
+        return ("{ { << /OutputFile %s >> setpagedevice } stopped "
+                "{ $error /errorname get } "
+                "{ userdict /elm-state save put "
+                "userdict /elm-dicts countdictstack put "
+                "{ %s run } stopped { $error /errorname get } { null } ifelse "
+                "count 1 sub { exch pop } repeat "
+                "countdictstack userdict /elm-dicts get sub { end } repeat "
+                "userdict /elm-state get restore } ifelse "
+                "dup null ne { (%s %d]%%%%) print ( ) print == } "
+                "{ pop (%s %d]%%%%) = } ifelse flush clear } bind exec\n"
+                % (_ps_string(outpath), _ps_string(inpath),
+                   cls.fail_marker, jobid, cls.ok_marker, jobid))
+
+    def convert(self, inpath, outpath):
+        """Convert one file.
+        Return an error message, or None if the conversion succeeded.
+        """
+        jobid = self.njobs
+        self.njobs += 1
+        command = self.job_command(inpath, outpath, jobid)
+        ok = f"{self.ok_marker} {jobid}]%%"
+        fail = f"{self.fail_marker} {jobid}]%%"
+        try:
+            self.proc.stdin.write(command)
+            self.proc.stdin.flush()
+        except (BrokenPipeError, OSError) as e:
+            return f"ghostscript interpreter is not running ({e})"
+        messages = []
+        for line in self.proc.stdout:
+            line = line.rstrip("\n")
+            if line == ok:
+                return None
+            elif line.startswith(fail):
+                return (line[len(fail):].strip() + "\n"
+                        + "\n".join(messages)).strip()
+            messages.append(line)
+        return ("ghostscript interpreter exited unexpectedly\n"
+                + "\n".join(messages)).strip()
+
+    @property
+    def alive(self):
+        return self.proc.poll() is None
+
+    def close(self):
+        "Close the interpreter; this completes the last output file."
+        if self.alive:
+            try:
+                self.proc.stdin.write("quit\n")
+                self.proc.stdin.close()
+            except (BrokenPipeError, OSError):
+                pass
+        self.proc.wait()
+        self.proc.stdout.close()
+
+def _convert_persistent(jobs, flags, gs="gs", workers=1):
+    """Convert `jobs`, a list of (inpath, outpath) tuples, with `workers`
+    long-lived ghostscript interpreters.
+    Return a dict {inpath: error message} of the files which failed.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    workers = max(1, min(workers, len(jobs)))
+    # Interpreters run with -dSAFER, so they need explicit permission to
+    # read the figures and write the results.
+    dirs = sorted({str(Path(p).parent.resolve()) for job in jobs for p in job})
+    flags = flags + [f"--permit-file-all={d}{os.sep}" for d in dirs]
+    def run_chunk(chunk):
+        failed = {}
+        worker = Ghostscript_worker(flags, gs=gs)
+        try:
+            for inpath, outpath in chunk:
+                if not worker.alive:
+                    # A crash only loses the current file; start a new
+                    # interpreter for the remaining ones.
+                    worker.close()
+                    worker = Ghostscript_worker(flags, gs=gs)
+                print(f"Processing {Path(inpath).name}...")
+                error = worker.convert(inpath, outpath)
+                if error is not None:
+                    failed[inpath] = error
+        finally:
+            worker.close()
+        return failed
+    failed = {}
+    if not jobs:
+        return failed
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for chunk_failed in executor.map(
+              run_chunk, [jobs[i::workers] for i in range(workers)]):
+            failed.update(chunk_failed)
+    return failed
 
 @click.command()
 @click.option('--format', type=click.Choice(['pdf', 'eps'], case_sensitive=False), default='pdf')
@@ -1258,6 +4825,18 @@ def rename_figures(renamestr, maintex, start, figexts):
 @click.option('--echo/--no-echo',
               help="Print the command to console instead of executing it. "
                    "It's a good idea to run the script with this option first.")
+@click.option('--backend', type=click.Choice(['subprocess', 'persistent']),
+              default='subprocess',
+              help="'subprocess' starts a new ghostscript process for each "
+                   "file. 'persistent' keeps long-lived interpreters and "
+                   "feeds them the files one after another, which avoids "
+                   "the interpreter startup cost for each figure "
+                   "(requires ghostscript >= 9.50). Default: subprocess.")
+@click.option('--workers', type=int, default=1,
+              help="Number of ghostscript interpreters to run in parallel "
+                   "with the 'persistent' backend. Default: 1.")
+@click.option('--gs', 'gs_command', type=str, default='gs',
+              help="Ghostscript command. Default: gs.")
 @click.argument('srcdir',
                 type=click.Path(exists=True, file_okay=False, dir_okay=True),
                 default='flat-latex')
@@ -1275,7 +4854,8 @@ def rename_figures(renamestr, maintex, start, figexts):
               'with gs v9.27 causes conversion to fail.')
 @click.option('--dDownsampleMonoImages',    type=str, default='false', help='Default: false')
 @click.option('--dDownsampleGrayImages',    type=str, default='false', help='Default: false')
-def convert_to_cmyk(format, in_place, overwrite, exclude, echo, srcdir, **kwargs):
+def convert_to_cmyk(format, in_place, overwrite, exclude, echo, backend,
+                    workers, gs_command, srcdir, **kwargs):
     """
     Tested with ghostscript v9.27. © Alexandre René 2020.
 
@@ -1310,6 +4890,10 @@ def convert_to_cmyk(format, in_place, overwrite, exclude, echo, srcdir, **kwargs
 
     $ convert-to-cmyk --format eps flat-latex
 
+    To convert many small figures with four long-lived interpreters:
+
+    $ convert-to-cmyk --format eps --backend persistent --workers 4 flat-latex
+
     Where to find more information on the distiller options
     -------------------------------------------------------
 
@@ -1353,7 +4937,7 @@ def convert_to_cmyk(format, in_place, overwrite, exclude, echo, srcdir, **kwargs
     - [2] https://www.adobe.com/content/dam/acom/en/devnet/acrobat/pdfs/PDFCreationSettings_v9.pdf
 
     """
-    import subprocess
+    import shlex, subprocess
     # Fixed flags
     flags = ["-dSAFER",    # Recommend for all batch scripts; prevents opening/running external files
              "-dBATCH",    # Don't launch the gs console
@@ -1419,11 +5003,31 @@ def convert_to_cmyk(format, in_place, overwrite, exclude, echo, srcdir, **kwargs
 
     # Loop over the image files
     filenames = [f for f in os.listdir(srcdir) if Path(f).suffix == suffix]
+    if backend == 'persistent' and not echo:
+        jobs = [(str(srcdir/filename), str(outdir/filename))
+                for filename in filenames]
+        failed = _convert_persistent(jobs, flags, gs=gs_command,
+                                     workers=workers)
+        for inpath, outpath in jobs:
+            if inpath in failed:
+                warn(f"Conversion of {inpath} failed:\n{failed[inpath]}")
+            elif in_place:
+                Path(outpath).replace(inpath)
+        if failed:
+            sys.exit(1)
+        return
+    if echo and backend == 'persistent' and filenames:
+        # A single interpreter reads the job lines of all the files
+        print(' '.join([gs_command] + [f for f in flags if f != "-dBATCH"]
+                       + ["-"]))
     for filename in filenames:
         inpath = str(srcdir/filename)
         outpath = str(outdir/filename)
-        cmdlst = ["gs"] + flags + [f'-sOutputFile={outpath}', inpath]
-        if echo:
+        cmdlst = (shlex.split(gs_command) + flags
+                  + [f'-sOutputFile={outpath}', inpath])
+        if echo and backend == 'persistent':
+            print(Ghostscript_worker.job_command(inpath, outpath), end="")
+        elif echo:
             print(' '.join(cmdlst))
             if len(filenames) > 1:
                 print("Only the first command was printed. It would be "
@@ -1437,5 +5041,323 @@ def convert_to_cmyk(format, in_place, overwrite, exclude, echo, srcdir, **kwargs
                 # Move processed file on top of original
                 Path(outpath).replace(inpath)
 
+def _fresh_directory(directory):
+    "Create directory, removing its previous content."
+    if os.path.isdir(directory):
+        shutil.rmtree(directory)
+    os.makedirs(directory)
+
+def _directory_files(directory, suffix=None):
+    """Return the names of the files of directory (not in subdirectories),
+    or only of those with the given suffix, except hidden files."""
+    return [filename for filename in sorted(os.listdir(directory))
+            if not filename.startswith(".")
+            and (suffix is None or filename.endswith(suffix))
+            and os.path.isfile(os.path.join(directory, filename))]
+
+def _place_directory(src, dst, hardlink=True, suffix=None):
+    """Place (see place_file) the files of directory src, or only those with
+    the given suffix, in directory dst. Return the placed files."""
+    placed = []
+    for filename in _directory_files(src, suffix):
+        place_file(os.path.join(src, filename), os.path.join(dst, filename),
+                   hardlink)
+        placed.append(os.path.join(dst, filename))
+    return placed
+
+def _source_files(directory, exclude):
+    "Return the files under directory, except those under exclude."
+    exclude = os.path.abspath(exclude)
+    files = []
+    for root, dirs, filenames in os.walk(directory):
+        dirs[:] = [d for d in dirs if not d.startswith(".")
+                   and os.path.abspath(os.path.join(root, d)) != exclude]
+        files.extend(os.path.join(root, f) for f in filenames
+                     if not f.startswith("."))
+    return sorted(files)
+
+def _run_tool(command, cwd, ok_codes=(0,)):
+    "Run an external command in cwd; raise RuntimeError if it fails."
+    import subprocess
+    print("Running %s" % (" ".join(command)))
+    try:
+        result = subprocess.run(command, cwd=cwd, stdin=subprocess.DEVNULL)
+    except FileNotFoundError:
+        raise RuntimeError("%s is not installed" % (command[0]))
+    if result.returncode not in ok_codes:
+        raise RuntimeError("%s exited with code %d"
+                           % (" ".join(command), result.returncode))
+
+@click.command()
+@click.option('--defs', 'defs_files', multiple=True,
+              type=click.Path(dir_okay=False),
+              help="Definitions file (.sty); can be given several times. "
+                   "Private packages loaded by the document are also used.")
+@click.option('--cache/--no-cache', default=True,
+              help="Use the user-level cache of parsed definitions files. "
+                   "Default: --cache.")
+@click.option('--cache-dir', type=click.Path(file_okay=False), default=None,
+              help="Location of the definitions cache.")
+@click.option('--top', type=int, default=10,
+              help="Number of hot spots and lines listed. Default: 10.")
+@click.option('--json', 'json_file', type=click.Path(dir_okay=False),
+              default=None,
+              help="Also write the analysis, with the position of every "
+                   "use, to this JSON file.")
+@click.argument('maintex', type=click.Path(exists=True, dir_okay=False))
+def analyze(defs_files, cache, cache_dir, top, json_file, maintex):
+    """
+    Report which defined macros and environments MAINTEX (and the files it
+    inputs) uses, how often and where, which definitions are never used,
+    and the predicted hot spots of the expansion: the macros whose uses
+    produce the most tokens. The document is scanned once, without being
+    expanded, so this takes a fraction of the time of an expansion.
+    """
+    ts = Tex_stream()
+    ts.defs = ({}, {})
+    ts.defs_db_file = None
+    if cache:
+        ts.defs_cache = Defs_cache(cache_dir)
+    with contextlib.redirect_stdout(sys.stderr):
+        for defs_file in defs_files:
+            ts.add_defs(cut_extension(defs_file, ".sty"))
+        index = Macro_index(ts)
+        index.scan_file(maintex)
+    report = index.report(top)
+    if json_file is not None:
+        import json
+        with open(json_file, "w") as fp:
+            json.dump(report, fp, indent=2)
+    print("Scanned %s" % (", ".join(report["files"])))
+    print("%d definitions, %d used directly, %d only through other "
+          "definitions, %d unused" % (
+              report["definitions"], len(report["uses"]),
+              len(report["indirectly_used"]), len(report["unused"])))
+    print("\nUses:")
+    for macro, uses in report["uses"].items():
+        print("  %-20s %6d  (first at %s)"
+              % (macro, uses["count"], uses["positions"][0]))
+    if report["indirectly_used"]:
+        print("\nUsed only through other definitions:")
+        print("  " + " ".join(report["indirectly_used"]))
+    if report["unused"]:
+        print("\nUnused definitions:")
+        print("  " + " ".join(report["unused"]))
+    print("\nPredicted hot spots (tokens produced, arguments not counted):")
+    for spot in report["hot_spots"]:
+        print("  %-20s %6d uses x %4d tokens = %d" % (
+            spot["macro"], spot["count"], spot["tokens_per_use"],
+            spot["tokens"]))
+    print("\nLines with the most uses:")
+    for line in report["busiest_lines"]:
+        print("  %-30s %4d" % (line["position"], line["count"]))
+
+@click.command()
+@click.option('--engine', 'engine_names', multiple=True, metavar="NAME",
+              help="Engine to compare; can be given several times. "
+                   "Default: reference, compiled and sparse.")
+@click.option('--cases', type=int, default=200,
+              help="Number of random cases. Default: 200.")
+@click.option('--seed', type=int, default=0,
+              help="Seed of the random cases. Default: 0.")
+@click.option('--defs', 'defs_files', multiple=True,
+              type=click.Path(exists=True, dir_okay=False),
+              help="Definitions file (.sty) for FILES; can be given several "
+                   "times. Private packages loaded by FILES are also used.")
+@click.option('--shrink/--no-shrink', default=True,
+              help="Shrink each mismatch to a minimal case. "
+                   "Default: --shrink.")
+@click.argument('files', nargs=-1, type=click.Path(exists=True,
+                                                   dir_okay=False))
+def compare_engines(engine_names, cases, seed, defs_files, shrink, files):
+    """
+    Check that expansion engines agree: expand random documents and
+    definitions, and FILES, with each engine, and print each case on which
+    their outputs (or errors) differ, shrunk to a minimal reproducer.
+    Exits with status 1 if there is any.
+    """
+    engine_names = engine_names or ("reference", "compiled", "sparse")
+    for name in engine_names:
+        check_engine(None, None, name)
+    defs = "".join(read_tex_file(file) + "\n" for file in defs_files)
+    fixtures = [(file, defs, read_tex_file(file),
+                 os.path.dirname(os.path.abspath(file))) for file in files]
+    mismatches = differential_test(engine_names, cases, seed, fixtures,
+                                   shrink)
+    for mismatch in mismatches:
+        print(mismatch.show())
+    print("%d cases, %d mismatches" % (cases + len(files), len(mismatches)))
+    if mismatches:
+        sys.exit(1)
+
+@click.command()
+@click.option('--figdir', type=click.Path(exists=True, file_okay=False),
+              default=None,
+              help="Directory of the .eps figures, which must be exactly one "
+                   "directory deep (see cp-eps). They are converted to CMYK "
+                   "and placed next to the figures copied by FLaP.")
+@click.option('--cmyk/--no-cmyk', default=True,
+              help="Convert the .eps figures to CMYK. Default: --cmyk.")
+@click.option('--backend', type=click.Choice(['subprocess', 'persistent']),
+              default='subprocess',
+              help="Ghostscript backend, see convert-to-cmyk.")
+@click.option('--gs', 'gs_command', type=str, default='gs',
+              help="Ghostscript command. Default: gs.")
+@click.option('--figprefix', default=None,
+              help="Rename the figures to FIGPREFIX.format(i), e.g. "
+                   "'Figure.{}'.")
+@click.option('--name', default="final",
+              help="Name of the submission: the directory of OUTPUTDIR "
+                   "where it is assembled, and its .tex and .pdf files. "
+                   "Default: final.")
+@click.option('--latex/--no-latex', default=True,
+              help="Run latex and bibtex to embed the bibliography, and "
+                   "latex, dvips and ps2pdf to produce the PDF. "
+                   "Default: --latex.")
+@click.option('--jobs', '-j', type=int, default=1,
+              help="Number of processes used to expand \\input files, see "
+                   "expand-latex-macros. Default: 1.")
+@click.option('--workers', type=int, default=4,
+              help="Number of stages run concurrently. Default: 4.")
+@click.option('--force/--no-force', default=False,
+              help="Run all the stages, even those which are up to date.")
+@click.option('--report', type=click.Path(dir_okay=False), default=None,
+              help="Write the timings of the stages and the critical path "
+                   "to this JSON file.")
+@click.argument('maintex', type=click.Path(exists=True, dir_okay=False))
+@click.argument('outputdir', type=click.Path(file_okay=False),
+                default="flat-latex")
+def prepare_final(figdir, cmyk, backend, gs_command, figprefix, name, latex,
+                  jobs, workers, force, report, maintex, outputdir):
+    """
+    Prepare the final submission of MAINTEX, like example/prepare_final_latex.sh:
+    flatten it and expand its macros into OUTPUTDIR, convert the .eps
+    figures of FIGDIR to CMYK, assemble the submission in OUTPUTDIR/NAME,
+    embed the bibliography, rename the figures and compile NAME.pdf.
+
+    The stages form a dependency graph, and independent stages run
+    concurrently (the figures are converted while the macros are
+    expanded). A stage whose inputs did not change since the last run is
+    skipped. The time of each stage and the critical path, the chain of
+    stages which sets the total time, are reported at the end.
+    """
+    maintex = os.path.abspath(maintex)
+    outputdir = os.path.abspath(outputdir)
+    os.makedirs(outputdir, exist_ok=True)
+    workdir = os.path.join(outputdir, ".prepare-final")
+    assembled = os.path.join(workdir, "assembled")
+    finaldir = os.path.join(outputdir, name)
+    if figdir is not None:
+        figdir = os.path.abspath(figdir)
+        cmykdir = os.path.join(workdir, "figures",
+                               os.path.basename(os.path.normpath(figdir)))
+    clean_tex = "merged-clean.tex"
+
+    def expand():
+        main.main(["--incremental", "--strip-comments", "--renamefigs", "",
+                   "--jobs", str(jobs), maintex, outputdir],
+                  standalone_mode=False)
+        return [os.path.join(outputdir, f)
+                for f in _directory_files(outputdir)]
+
+    def convert():
+        _fresh_directory(cmykdir)
+        placed = _place_directory(figdir, cmykdir, suffix=".eps")
+        if cmyk and placed:
+            try:
+                convert_to_cmyk.main(
+                    ["--format", "eps", "--in-place", "--backend", backend,
+                     "--gs", gs_command, cmykdir], standalone_mode=False)
+            except SystemExit as e:
+                if e.code:
+                    raise RuntimeError("some figures could not be converted")
+        return placed
+
+    def assemble():
+        _fresh_directory(assembled)
+        # The definitions db and the private packages are not submitted
+        build_files = ["merged" + ext for ext in
+                       ["", ".db", ".dat", ".dir", ".bak", ".pag", ".lock"]]
+        for filename in _directory_files(outputdir):
+            if (filename not in build_files
+                and not filename.endswith("-private.sty")):
+                place_file(os.path.join(outputdir, filename),
+                           os.path.join(assembled, filename))
+        if figdir is not None:
+            cp_eps.callback(assembled, cmykdir, 8, True)
+        # bibtex does not accept the underscores FLaP puts in filenames
+        postprocess(os.path.join(outputdir, clean_tex),
+                    os.path.join(assembled, clean_tex),
+                    [Fix_bib_filenames(assembled)])
+        return [os.path.join(assembled, f)
+                for f in _directory_files(assembled)]
+
+    def bibliography():
+        _run_tool(["latex", "-interaction=nonstopmode", clean_tex], assembled)
+        # bibtex exits with code 1 when it only has warnings
+        _run_tool(["bibtex", "merged-clean"], assembled, ok_codes=(0, 1))
+        return [os.path.join(assembled, "merged-clean.bbl")]
+
+    def finalize():
+        _fresh_directory(finaldir)
+        _place_directory(assembled, finaldir)
+        transforms = []
+        if latex:
+            transforms.append(
+                Embed_bbl(os.path.join(assembled, "merged-clean.bbl")))
+        if figprefix is not None:
+            transforms.append(Rename_figures(figprefix, finaldir, "eps"))
+        postprocess(os.path.join(assembled, clean_tex),
+                    os.path.join(finaldir, name + ".tex"), transforms)
+        return [os.path.join(finaldir, f) for f in _directory_files(finaldir)]
+
+    def compile_pdf():
+        for i in range(3):  # So that all references are resolved
+            _run_tool(["latex", "-interaction=nonstopmode", name + ".tex"],
+                      finaldir)
+        _run_tool(["dvips", "-Ppdf", "-G0", name + ".dvi"], finaldir)
+        _run_tool(["ps2pdf", "-dPDFSETTINGS=/prepress",
+                   "-dEmbedAllFonts=true", name + ".ps"], finaldir)
+        return [os.path.join(finaldir, name + ".pdf")]
+
+    source_dir = os.path.dirname(maintex)
+    stages = [Pipeline_stage("expand", expand,
+                             inputs=lambda: _source_files(source_dir,
+                                                          outputdir),
+                             params=[jobs])]
+    assemble_deps = ["expand"]
+    if figdir is not None:
+        stages.append(Pipeline_stage(
+            "convert", convert,
+            inputs=lambda: _source_files(figdir, outputdir),
+            params=[cmyk, backend, gs_command]))
+        assemble_deps.append("convert")
+    stages.append(Pipeline_stage("assemble", assemble, deps=assemble_deps))
+    if latex:
+        stages.append(Pipeline_stage("bibliography", bibliography,
+                                     deps=["assemble"]))
+    stages.append(Pipeline_stage(
+        "finalize", finalize,
+        deps=["bibliography"] if latex else ["assemble"],
+        params=[figprefix, name]))
+    if latex:
+        stages.append(Pipeline_stage("pdf", compile_pdf, deps=["finalize"]))
+
+    cache_file = os.path.join(workdir, "stages.json")
+    if force and os.path.exists(cache_file):
+        os.remove(cache_file)
+    pipeline = Pipeline(stages, cache_file, workers)
+    try:
+        pipeline.run()
+    except Pipeline_error as e:
+        raise click.ClickException(str(e))
+    finally:
+        print("Stages:")
+        pipeline.print_report()
+        if report is not None:
+            import json
+            with open(report, "w") as fp:
+                json.dump(pipeline.report(), fp, indent=2)
+
 if __name__ == "__main__":
     main()
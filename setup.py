@@ -35,5 +35,11 @@ setup(
         expand-latex-macros=expand_latex_macros:main
         convert-to-cmyk=expand_latex_macros:convert_to_cmyk
         rename-figures=expand_latex_macros:rename_figures
+        postprocess-latex=expand_latex_macros:postprocess_latex
+        cp-eps=expand_latex_macros:cp_eps
+        expand-latex-filter=expand_latex_macros:expand_filter
+        prepare-final=expand_latex_macros:prepare_final
+        analyze-latex-macros=expand_latex_macros:analyze
+        compare-latex-engines=expand_latex_macros:compare_engines
     """
 )
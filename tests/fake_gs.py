@@ -0,0 +1,50 @@
+"""Stand-in for a persistent ghostscript interpreter.
+
+Reads the job lines sent by `Ghostscript_worker` on stdin and "converts" each
+input file by copying it to the output file with a "%CMYK" header line.
+Inputs whose content starts with "bad" are reported as failures. An input
+starting with "redefine NAME" changes NAME for the files after it, unless the
+job runs it between save and restore; one starting with "use NAME" fails if
+NAME was changed. If the environment variable FAKE_GS_LOG is set, one line is
+appended to that file each time an interpreter starts.
+"""
+import os, re, sys
+
+job_re = re.compile(r"/OutputFile \(((?:\\.|[^\\)])*)\).*?"
+                    r"\(((?:\\.|[^\\)])*)\) run.*?"
+                    r"\((%%\[elm-fail \d+\]%%)\).*?\((%%\[elm-ok \d+\]%%)\)")
+
+isolated_re = re.compile(r"save.*\) run.*restore")
+
+def unescape(s):
+    return re.sub(r"\\(.)", r"\1", s)
+
+if os.environ.get("FAKE_GS_LOG"):
+    with open(os.environ["FAKE_GS_LOG"], 'a') as f:
+        f.write(f"{os.getpid()}\n")
+
+redefined = set()
+for line in sys.stdin:
+    if line.strip() == "quit":
+        break
+    m = job_re.search(line)
+    if m is None:
+        continue
+    outpath, inpath = unescape(m.group(1)), unescape(m.group(2))
+    with open(inpath) as f:
+        content = f.read()
+    before = set(redefined)  # The state in which the input runs
+    words = content.split()
+    if content.startswith("redefine"):
+        redefined.add(words[1])
+    if isolated_re.search(line):
+        redefined = before
+    if content.startswith("use") and words[1] in before:
+        print(m.group(3), "/typecheck", flush=True)
+    elif content.startswith("bad"):
+        print("Error: /undefined in bad")
+        print(m.group(3), "/undefined", flush=True)
+    else:
+        with open(outpath, 'w') as f:
+            f.write("%CMYK\n" + content)
+        print(m.group(4), flush=True)
@@ -1,3 +1,4 @@
+import pytest
 import os
 from os import path
 # from pathlib import Path
@@ -37,3 +38,987 @@ def test_simple():
 
 def test_complex():
     return expand_and_compare('complex')
+
+# convert-to-cmyk command
+
+def test_cmyk_persistent_backend(tmp_path, monkeypatch):
+    import sys
+    log = tmp_path/"startups.log"
+    monkeypatch.setenv("FAKE_GS_LOG", str(log))
+    for name in ["fig1.eps", "fig2.eps", "fig3.eps"]:
+        (tmp_path/name).write_text(f"%!PS {name}\n")
+    (tmp_path/"broken.eps").write_text("bad\n")
+    gs = f"{sys.executable} {path.join(here, 'fake_gs.py')}"
+    result = CliRunner().invoke(
+        elm.convert_to_cmyk,
+        ("--format", "eps", "--backend", "persistent", "--gs", gs,
+         "--in-place", str(tmp_path)))
+    # Failures are reported individually, and don't prevent other conversions
+    assert result.exit_code == 1
+    assert len(log.read_text().split()) == 1
+    for name in ["fig1.eps", "fig2.eps", "fig3.eps"]:
+        assert (tmp_path/name).read_text() == f"%CMYK\n%!PS {name}\n"
+    assert (tmp_path/"broken.eps").read_text() == "bad\n"
+    # Each file is converted as by a separate interpreter
+    (tmp_path/"redefine.eps").write_text("redefine showpage\n")
+    (tmp_path/"use.eps").write_text("use showpage\n")
+    worker = elm.Ghostscript_worker([], gs=gs)
+    try:
+        for name in ["redefine.eps", "broken.eps", "use.eps"]:
+            error = worker.convert(str(tmp_path/name), str(tmp_path/"out.eps"))
+            assert (error is None) == (name != "broken.eps"), error
+    finally:
+        worker.close()
+    assert (tmp_path/"out.eps").read_text() == "%CMYK\nuse showpage\n"
+    for name in ["redefine.eps", "use.eps", "out.eps"]:
+        (tmp_path/name).unlink()
+    # With --echo, the interpreter command is printed once
+    result = CliRunner().invoke(
+        elm.convert_to_cmyk,
+        ("--format", "eps", "--backend", "persistent", "--gs", gs,
+         "--echo", str(tmp_path)))
+    assert result.exit_code == 0
+    assert result.output.count(gs) == 1
+    assert result.output.count("setpagedevice") == 4
+
+def test_cmyk_subprocess_backend(tmp_path):
+    import sys
+    (tmp_path/"fig.eps").write_text("%!PS\n")
+    (tmp_path/"gs.py").write_text(
+        "import sys\nopen(sys.argv[1], 'a').write(' '.join(sys.argv[2:]))\n")
+    gs = f"{sys.executable} {tmp_path/'gs.py'} {tmp_path/'args.log'}"
+    result = CliRunner().invoke(
+        elm.convert_to_cmyk,
+        ("--format", "eps", "--backend", "subprocess", "--gs", gs,
+         str(tmp_path)))
+    assert result.exit_code == 0
+    args = (tmp_path/"args.log").read_text().split()
+    assert "-sDEVICE=eps2write" in args and args[-1] == str(tmp_path/"fig.eps")
+
+# de-macro engine
+
+def write_project(tmp_path, files):
+    for name, content in files.items():
+        (tmp_path/name).write_text(content)
+
+def test_process_file_splices_inputs(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    write_project(tmp_path, {
+        "defs-private.sty": "\\newcommand{\\hist}{H}\n",
+        "main.tex": "\\usepackage{defs-private}\r\n$\\hist$\r\n"
+                    "\\input{chapter}\r\nend $\\hist$\r\n",
+        "chapter.tex": "Chapter: $p(x|\\hist)$ \\hist{}\n"})
+    ts = elm.Tex_stream()
+    ts.defs = ({}, {})
+    ts.process_file("main.tex")
+    assert (tmp_path/"chapter-clean.tex").read_text() == "Chapter: $p(x|H)$ H{}\n"
+    assert (tmp_path/"main-clean.tex").read_text() == (
+        "\n$H$\nChapter: $p(x|H)$ H{}\n\nend $H$\n")
+    # Spliced files get the same newlines as the expanded text
+    (tmp_path/"crlf.tex").write_bytes(b"a\r\nb\rc\n")
+    (tmp_path/"lf.tex").write_bytes(b"d\n")
+    with open(tmp_path/"out.tex", "w") as fp:
+        fp.write("x\n")
+        elm.copy_file_into(tmp_path/"crlf.tex", fp)
+        elm.copy_file_into(tmp_path/"lf.tex", fp)
+    assert (tmp_path/"out.tex").read_bytes() == b"x\na\nb\nc\nd\n"
+
+def make_stream(defs_tex, engine="compiled"):
+    ts = elm.Tex_stream()
+    ts.defs = ({}, {})
+    ts.engine = engine
+    ts.smart_tokenize(defs_tex)
+    ts.scan_defs()
+    ts.compile_defs()
+    return ts
+
+def expand_with(ts, text):
+    ts.smart_tokenize(text)
+    if ts.engine == "reference":
+        return elm.detokenize(ts.apply_all_recur(ts.data))
+    else:
+        return elm.detokenize(ts.apply_all_compiled(ts.data))
+
+nested_defs = r"""
+\newcommand{\a}{A}
+\newcommand{\b}[1]{\a{#1}\a}
+\newcommand{\c}{\b{x}}
+\newcommand{\f}[1]{[#1]}
+\newcommand{\g}[1]{#1{y}}
+\newenvironment{box}[1]{\c<#1|}{|\a>}
+"""
+
+def test_token_rope():
+    tokens = elm.tokenize("x" * 100)
+    rope = elm.Token_rope()
+    rope.append_slice(tokens, 10, 90)
+    assert rope.pieces[0][0] is tokens  # Large slices are shared
+    for i in range(5000):               # Deep nesting is fine
+        outer = elm.Token_rope()
+        outer.extend(rope)
+        rope = outer
+    small = elm.Token_rope()
+    small.append_slice(tokens, 0, 3)
+    rope.extend(small)
+    rope.extend(tokens[3:5])
+    assert len(rope) == 85
+    assert rope.flatten() == tokens[10:90] + tokens[:5]
+    ts = make_stream(nested_defs)
+    text = elm.tokenize(r"\g{\b} " * 30 + r"\b{\b{\c}} and \f{\f{\a}}")
+    assert (elm.detokenize(ts.compiled_rope(text).flatten())
+            == elm.detokenize(ts.apply_all_recur(text)))
+
+def test_compiled_definitions():
+    ts = make_stream(nested_defs)
+    command_defs, env_defs = ts.defs
+    # Definitions are compiled on first use, with those they use
+    assert command_defs["c"].resolved is None
+    ts.compile_def(("command", "c"))
+    ts.compile_def(("env", "box"))
+    assert command_defs["a"].compiled and not command_defs["f"].compiled
+    assert elm.detokenize(command_defs["c"].resolved) == "A{x}A"
+    assert elm.detokenize(command_defs["b"].resolved) == "A{#1}A"
+    assert [elm.detokenize(t) for t in env_defs["box"].resolved] == [
+        "A{x}A<#1|", "|A>"]
+    # Commands defined after the ones using them are resolved all the same
+    ts = make_stream(r"\newcommand{\x}{\y\y}\newcommand{\y}{Y}")
+    ts.compile_def(("command", "x"))
+    assert elm.detokenize(ts.defs[0]["x"].resolved) == "YY"
+
+def test_lazy_compilation():
+    # Each definition doubles the previous one: compiling them all ahead
+    # would take exponential time and memory
+    names = ["x" + chr(97 + i) for i in range(26)]
+    defs = r"\newcommand{\xa}{ab}" + "".join(
+        r"\newcommand{\%s}{\%s\%s}" % (name, prev, prev)
+        for prev, name in zip(names, names[1:]))
+    for engine in ["compiled", "sparse", "reference"]:
+        ts = make_stream(defs, engine)
+        assert expand_with(ts, "hello") == "hello"
+        assert not any(d.compiled for d in ts.defs[0].values())
+    ts = make_stream(defs)
+    assert expand_with(ts, r"\xc \xn") == "ab" * 4 + " " + "ab" * 2**13
+    command_defs = ts.defs[0]
+    assert elm.detokenize(command_defs["xc"].resolved) == "ab" * 4
+    # Bodies longer than the cap are expanded when used
+    assert command_defs["xn"].compiled and command_defs["xn"].resolved is None
+    assert not command_defs["xo"].compiled
+
+def test_compiled_engine_matches_reference():
+    text = (r"\c \b{\c} \g{\f} \f{\a} \begin{box}{\c}in \c\end{box}"
+            r" \begin{box}{1}\begin{box}{2}\a\end{box}\end{box}")
+    expected = expand_with(make_stream(nested_defs, "reference"), text)
+    assert expand_with(make_stream(nested_defs), text) == expected
+
+def test_cyclic_definitions():
+    import pytest
+    with pytest.raises(elm.Cyclic_definition_error) as excinfo:
+        make_stream(r"\newcommand{\a}{\b}\newcommand{\b}[1]{\c{#1}}"
+                    r"\newcommand{\c}{\a} \newcommand{\d}{\a}")
+    assert excinfo.value.cycle == ["\\a", "\\b", "\\c", "\\a"]
+
+def test_sparse_engine_matches_full_engine(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    defs = nested_defs + r"""
+\newcommand{\hist}{H}
+\newcommand{\histk}{H^k}
+\makeatletter
+\newcommand{\at@cmd}{AT}
+\makeatother
+\newcommand{\two}[2]{(#1,#2)}
+"""
+    main = r"""\title{\hist}
+\usepackage{defs-private}
+Plain text % \hist in a comment
+\\hist is not a macro, \histα neither, but \histk{} and \hist-x are.
+\two{a
+}
+
+{b} and \two % comment
+
+{c}%
+
+{d}
+\begin{box}{1}
+Long
+
+environment \c
+\end{box}
+\makeatletter \at@cmd \makeatother \at@cmd
+Last \hist"""
+    for engine in ["compiled", "sparse"]:
+        (tmp_path/engine).mkdir()
+        (tmp_path/engine/"defs-private.sty").write_text(defs)
+        (tmp_path/engine/"main.tex").write_text(main)
+        monkeypatch.chdir(tmp_path/engine)
+        ts = elm.Tex_stream()
+        ts.defs = ({}, {})
+        ts.engine = engine
+        ts.process_file("main.tex")
+    assert ((tmp_path/"sparse"/"main-clean.tex").read_text()
+            == (tmp_path/"compiled"/"main-clean.tex").read_text())
+
+def test_sparse_engine_on_fixtures(tmp_path, monkeypatch):
+    import shutil
+    outputs = {}
+    for engine in ["compiled", "sparse"]:
+        for prefix in ["simple", "complex"]:
+            srcdir = tmp_path/engine/prefix
+            shutil.copytree(path.join(here, f"{prefix}-latex-src"), srcdir)
+            monkeypatch.chdir(srcdir)
+            ts = elm.Tex_stream()
+            ts.defs = ({}, {})
+            ts.engine = engine
+            ts.process_file("main.tex")
+            outputs[engine, prefix] = (srcdir/"main-clean.tex").read_text()
+    for prefix in ["simple", "complex"]:
+        assert outputs["sparse", prefix] == outputs["compiled", prefix]
+
+def test_differential_engines():
+    import glob
+    fixtures = []
+    for prefix in ["simple", "complex"]:
+        srcdir = path.join(here, f"{prefix}-latex-src")
+        defs = "".join(elm.read_tex_file(file) + "\n"
+                       for file in glob.glob(path.join(srcdir, "*.sty")))
+        fixtures += [(file, defs, elm.read_tex_file(file), srcdir)
+                     for file in glob.glob(path.join(srcdir, "*.tex"))]
+    assert elm.differential_test(cases=100, fixtures=fixtures) == []
+    # Cases on which the engines used to disagree
+    defs = "\\newcommand{\\ma}[1]{}\n\\makeatletter\\newcommand{\\at@b}{B}\n"
+    for text in ["\\ma{x}y", "a\\", "\\makeatletter \\at@b"]:
+        assert elm.compare_case(defs, text, elm.engines) is None, text
+
+def test_engine_mismatch_shrinking(monkeypatch):
+    class Broken_engine(elm.Compiled_engine):
+        "Loses the x characters."
+        def apply(self, ts, tokens, report=False):
+            return [token for token in super().apply(ts, tokens)
+                    if token.val != "x"]
+    monkeypatch.setattr(elm, "engines", dict(elm.engines))
+    elm.register_engine("broken", Broken_engine())
+    mismatches = elm.differential_test(("reference", "broken"), cases=10)
+    assert mismatches
+    assert [(m.defs, m.text) for m in mismatches] == [("", "x")] * len(mismatches)
+    assert mismatches[0].results == {"reference": ("output", "x"),
+                                     "broken": ("output", "")}
+    result = CliRunner().invoke(elm.compare_engines,
+                                ["--engine", "reference", "--engine", "broken",
+                                 "--cases", "10"])
+    assert result.exit_code == 1
+    assert "--- broken\n\n" in result.output
+    result = CliRunner().invoke(elm.main, ["--engine", "missing", "main.tex"])
+    assert "registered: broken, compiled" in result.output
+
+def test_shared_defs_cache(tmp_path, monkeypatch):
+    from concurrent.futures import ThreadPoolExecutor
+    defs = r"\newcommand{\hist}{H}\newcommand{\dd}[1]{d#1}"
+    for project in ["a", "b"]:
+        (tmp_path/project).mkdir()
+        (tmp_path/project/"defs-private.sty").write_text(defs)
+    cache = elm.Defs_cache(tmp_path/"cache")
+    parses = []
+    scan_defs_file = elm.Tex_stream.scan_defs_file
+    def counting_scan_defs_file(self, *args):
+        parses.append(args[0])
+        return scan_defs_file(self, *args)
+    monkeypatch.setattr(elm.Tex_stream, "scan_defs_file",
+                        counting_scan_defs_file)
+    def load(project):
+        ts = elm.Tex_stream()
+        ts.defs = ({}, {})
+        ts.defs_cache = cache
+        ts.add_defs(str(tmp_path/project/"defs-private"))
+        return elm.detokenize(ts.defs[0]["dd"].body)
+    # Concurrent loads from two projects with the same definitions file
+    with ThreadPoolExecutor(4) as executor:
+        results = list(executor.map(load, ["a", "b"]*4))
+    assert results == ["d#1"]*8
+    assert len(parses) == 1
+    # Changing the content invalidates the entry
+    (tmp_path/"b"/"defs-private.sty").write_text(defs.replace("d#1", "D#1"))
+    assert load("b") == "D#1"
+    assert len(parses) == 2
+
+input_project = {
+    "defs-private.sty": nested_defs,
+    "main.tex": "\\usepackage{defs-private}\n\\c\n\\input{ch1}\n"
+                "% \\input{ch2}\n\\input ch2\n\\input{ch1}\n",
+    "ch1.tex": "One \\b{1}\n\\input{sec}\n",
+    "ch2.tex": "Two \\begin{box}{2}\\a\\end{box}\n",
+    "sec.tex": "Section \\f{\\a}\n"}
+
+def test_token_cache(tmp_path, monkeypatch):
+    write_project(tmp_path, input_project)
+    monkeypatch.chdir(tmp_path)
+    tokenized = []
+    smart_tokenize = elm.Tex_stream.smart_tokenize
+    def counting_tokenize(self, in_str, handle_inputs=False, *args, **kwargs):
+        if handle_inputs:
+            tokenized.append(in_str)
+        return smart_tokenize(self, in_str, handle_inputs, *args, **kwargs)
+    monkeypatch.setattr(elm.Tex_stream, "smart_tokenize", counting_tokenize)
+    def run(cache):
+        ts = elm.Tex_stream()
+        ts.write_inputs = False
+        ts.token_cache = cache
+        ts.process_file("main.tex")
+        return (tmp_path/"main-clean.tex").read_text()
+    cache = elm.Token_cache(tmp_path/"cache")
+    first = run(cache)
+    assert len(tokenized) == 4   # ch1 is read twice, but tokenized once
+    # Only the definitions change: nothing is tokenized again
+    (tmp_path/"defs-private.sty").write_text(
+        nested_defs.replace("{\\a}{A}", "{\\a}{B}"))
+    tokenized.clear()
+    second = run(cache)
+    assert tokenized == []
+    assert second == run(None) == first.replace("A", "B")
+    assert "Section [B]" in second
+    cache.max_entries = 1
+    cache.prune()
+    assert len(list((tmp_path/"cache"/"tokens").iterdir())) == 1
+    # The budget is checked when cached tokens are used, as when tokenizing
+    ts = elm.Tex_stream()
+    ts.token_cache = cache
+    ts.tokenize_file("Some text\n")
+    ts.budget = elm.Expansion_budget()
+    ts.budget.cancel()
+    with pytest.raises(elm.Expansion_cancelled):
+        ts.tokenize_file("Some text\n")
+
+def test_block_cache(tmp_path, monkeypatch, capsys):
+    import re
+    monkeypatch.chdir(tmp_path)
+    (tmp_path/"defs-private.sty").write_text(
+        "\\newcommand{\\a}{A}\n\\newcommand{\\two}[2]{(#1|#2)}\n")
+    paragraphs = ["\\usepackage{defs-private}\n",
+                  "First \\a.\n",
+                  # A call whose arguments span two paragraphs
+                  "\\two{x\n\ny}{z}\n",
+                  "\\makeatletter \\a@b \\a\n% comment\n\n\\a\n",
+                  "Last \\a."]
+    def run(block_cache, text):
+        (tmp_path/"doc.tex").write_text("\n\n".join(text))
+        ts = elm.Tex_stream()
+        ts.defs_db_file = None
+        ts.block_cache = block_cache
+        ts.process_file("doc")
+        counts = re.findall(r"Expanded (\d+) of (\d+) blocks",
+                            capsys.readouterr().out)
+        return (tmp_path/"doc-clean.tex").read_text(), counts
+    cache = elm.Block_cache(tmp_path/"cache")
+    expected, _ = run(None, paragraphs)
+    assert "(x\n\ny|z)" in expected
+    assert run(cache, paragraphs) == (expected, [("5", "5")])
+    # Only the block with a \usepackage is expanded again
+    assert run(cache, paragraphs) == (expected, [("1", "5")])
+    paragraphs[1] = "First \\a, edited.\n"
+    assert run(cache, paragraphs) == (run(None, paragraphs)[0], [("2", "5")])
+    # All blocks are expanded again when the definitions change
+    (tmp_path/"defs-private.sty").write_text(
+        "\\newcommand{\\a}{B}\n\\newcommand{\\two}[2]{(#1|#2)}\n")
+    assert run(cache, paragraphs) == (run(None, paragraphs)[0], [("5", "5")])
+
+def test_concurrent_inputs(tmp_path, monkeypatch):
+    outputs = {}
+    for jobs in [1, 3]:
+        (tmp_path/str(jobs)).mkdir()
+        write_project(tmp_path/str(jobs), input_project)
+        monkeypatch.chdir(tmp_path/str(jobs))
+        ts = elm.Tex_stream()
+        ts.defs = ({}, {})
+        ts.jobs = jobs
+        ts.process_file("main.tex")
+        outputs[jobs] = {name: (tmp_path/str(jobs)/f"{name}-clean.tex").read_text()
+                         for name in ["main", "ch1", "ch2", "sec"]}
+    assert outputs[3] == outputs[1]
+    assert "Section [A]" in outputs[3]["main"]
+
+def test_inputs_in_memory(tmp_path, monkeypatch):
+    write_project(tmp_path, input_project)
+    monkeypatch.chdir(tmp_path)
+    ts = elm.Tex_stream()
+    ts.defs = ({}, {})
+    ts.process_file("main.tex")
+    expected = (tmp_path/"main-clean.tex").read_text()
+    for jobs in [1, 3]:
+        (tmp_path/str(jobs)).mkdir()
+        write_project(tmp_path/str(jobs), input_project)
+        monkeypatch.chdir(tmp_path/str(jobs))
+        ts = elm.Tex_stream()
+        ts.defs = ({}, {})
+        ts.jobs = jobs
+        ts.write_inputs = False
+        ts.process_file("main.tex")
+        assert (tmp_path/str(jobs)/"main-clean.tex").read_text() == expected
+        assert sorted(p.name for p in (tmp_path/str(jobs)).glob("*-clean.tex")) \
+            == ["main-clean.tex"]
+
+def test_unchanged_outputs_are_not_rewritten(tmp_path, monkeypatch):
+    write_project(tmp_path, input_project)
+    monkeypatch.chdir(tmp_path)
+    def run():
+        summary = elm.Output_summary()
+        ts = elm.Tex_stream()
+        ts.defs = ({}, {})
+        ts.outputs = summary
+        ts.defs_db = str(tmp_path/"main")
+        ts.process_file("main.tex")
+        ts.save_defs()
+        (tmp_path/"plot.pdf").write_text("figure")  # As copied by FLaP
+        elm._rename_figures("figure_{}", "main.tex", summary=summary)
+        return summary
+    (tmp_path/"main.tex").write_text(
+        input_project["main.tex"] + "\\includegraphics{plot}\n")
+    first = run()
+    assert "main-clean.tex" in first.written
+    assert first.moved == [("plot.pdf", "figure_1.pdf")]
+    mtimes = {p.name: p.stat().st_mtime_ns for p in tmp_path.iterdir()}
+    for name in ["ch1.tex", "sec.tex"]:
+        (tmp_path/name).touch()  # Forces expansion, with the same result
+    second = run()
+    assert second.written == [] and second.moved == []
+    assert "sec-clean.tex" in second.unchanged
+    assert "main-clean.renamed.tex" in second.unchanged
+    assert not (tmp_path/"plot.pdf").exists()
+    for p in tmp_path.iterdir():
+        if p.name in mtimes and p.name not in ["ch1.tex", "sec.tex", "plot.pdf"]:
+            assert p.stat().st_mtime_ns == mtimes[p.name], p.name
+
+def test_profile_memory(tmp_path, monkeypatch):
+    import json, shutil
+    shutil.copytree(path.join(here, "simple-latex-src"), tmp_path/"src")
+    monkeypatch.chdir(tmp_path/"src")
+    result = CliRunner().invoke(
+        elm.main, ("--profile-memory", "../profile.json", "--no-cache",
+                   "main.tex", "../out"), catch_exceptions=False)
+    assert result.exit_code == 0
+    stages = json.loads((tmp_path/"profile.json").read_text())["stages"]
+    names = [stage["stage"] for stage in stages]
+    for name in ["flap merge", "defs loading", "tokenization", "expansion",
+                 "detokenization", "figure renaming"]:
+        assert name in names
+    for stage in stages:
+        assert stage["traced_peak"] >= max(stage["traced_start"],
+                                           stage["traced_end"])
+        assert isinstance(stage["top_allocations"], list)
+
+def test_profile_timings(tmp_path, monkeypatch):
+    import json, pstats, re, shutil
+    shutil.copytree(path.join(here, "simple-latex-src"), tmp_path/"src")
+    monkeypatch.chdir(tmp_path/"src")
+    result = CliRunner().invoke(
+        elm.main, ("--profile", "../timings.json",
+                   "--profile-pstats", "../run.pstats",
+                   "--profile-stacks", "../run.stacks", "--no-cache",
+                   "main.tex", "../out"), catch_exceptions=False)
+    assert result.exit_code == 0
+    report = json.loads((tmp_path/"timings.json").read_text())
+    for name in ["flap merge", "defs loading", "tokenization", "expansion",
+                 "detokenization", "defs saving", "figure renaming"]:
+        assert report["totals"][name]["count"] >= 1
+    for total in report["totals"].values():
+        assert total["seconds"] <= report["seconds"]
+    for stage in report["stages"]:
+        assert 0 <= stage["start"] <= report["seconds"]
+    stats = pstats.Stats(str(tmp_path/"run.pstats"))
+    assert any("process_file" == func[2] for func in stats.stats)
+    stacks = (tmp_path/"run.stacks").read_text().splitlines()
+    assert stacks
+    assert all(re.fullmatch(r"\S.* \d+", line) for line in stacks)
+
+def test_multiple_targets(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path/"defs-private.sty").write_text(nested_defs)
+    (tmp_path/"arxiv.sty").write_text("\\renewcommand{\\a}{arXiv}\n")
+    (tmp_path/"main.tex").write_text(
+        "\\usepackage{defs-private}\n\\c \\f{\\a}\n"
+        "\\begin{box}{1}in\\end{box}\n\\input{other}\n")
+    targets = [elm.Expansion_target.parse(spec) for spec in
+               ["full", "kept:keep=\\b,box", "arxiv:defs=arxiv.sty:keep=f"]]
+    assert targets[1].keep == ("b", "box")
+    expected = {"full": "\nA{x}A [A]\nA{x}A<1|in|A>\n\\input{other}\n",
+                "kept": "\n\\b{x} [A]\n\\begin{box}{1}in\\end{box}\n"
+                        "\\input{other}\n",
+                "arxiv": "\narXiv{x}arXiv \\f{arXiv}\n"
+                         "arXiv{x}arXiv<1|in|arXiv>\n\\input{other}\n"}
+    for engine in ["compiled", "reference"]:
+        for jobs in [1, 3]:
+            ts = elm.Tex_stream()
+            ts.engine = engine
+            ts.jobs = jobs
+            ts.process_targets("main", targets)
+            for name, text in expected.items():
+                assert (tmp_path/f"main-{name}-clean.tex").read_text() == text
+    # Targets don't modify the shared definitions
+    ts.compile_def(("command", "c"))
+    assert elm.detokenize(ts.defs[0]["c"].resolved) == "A{x}A"
+    with pytest.raises(ValueError):
+        elm.Expansion_target.parse("bad:skip=a")
+
+def test_strip_comments(tmp_path, monkeypatch):
+    cases = {"foo%c\nbar": "foobar",
+             "foo % c\n   bar": "foo bar",
+             "foo%\n\nbar": "foo\n\nbar",     # The empty line is kept
+             "a\n   % c\n  b\n": "a\n  b\n",  # Whole-line comment
+             "100\\% sure % really\nok": "100\\% sure ok",
+             "\\\\% c\nx": "\\\\x",
+             "end %eof": "end "}
+    for text, expected in cases.items():
+        tokens = elm.tokenize(text, strip_comments=True)
+        assert elm.detokenize(tokens) == expected
+    main = ("\\usepackage{defs-private}\n% \\c\n\\b{%\n  1}% \\a\n\n"
+            "  % The end\n\\a \\% \\c %\n")
+    outputs = {}
+    for engine in ["compiled", "sparse"]:
+        (tmp_path/engine).mkdir()
+        write_project(tmp_path/engine, {"defs-private.sty": nested_defs,
+                                        "main.tex": main})
+        monkeypatch.chdir(tmp_path/engine)
+        ts = elm.Tex_stream()
+        ts.defs = ({}, {})
+        ts.engine = engine
+        ts.strip_comments = True
+        ts.process_file("main.tex")
+        outputs[engine] = (tmp_path/engine/"main-clean.tex").read_text()
+    assert outputs["compiled"] == "\nA{1}A\n\nA \\% A{x}A \n"
+    assert outputs["sparse"] == outputs["compiled"]
+
+def test_postprocess_single_pass(tmp_path):
+    import io
+    write_project(tmp_path, {
+        "merged-clean.tex": "\\begin{document}% start\n"
+                            "\\includegraphics[width=2cm]{plot} 50\\% % c\n"
+                            "  text\n\\bibliography{folder_refs}\n"
+                            "\\end{document}\n",
+        "plot.pdf": "figure",
+        "folder_refs.bib": "@article{}",
+        "merged-clean.bbl": "\\begin{thebibliography}\n\\end{thebibliography}\n"})
+    result = CliRunner().invoke(
+        elm.postprocess_latex,
+        ("--strip-comments", "--fix-bib", "--renamestr", "Fig.{}",
+         "--figexts", "pdf", str(tmp_path/"merged-clean.tex"),
+         str(tmp_path/"final.tex")), catch_exceptions=False)
+    assert result.exit_code == 0
+    assert (tmp_path/"final.tex").read_text() == (
+        "\\begin{document}\\includegraphics[width=2cm]{Fig.1.pdf} 50\\% text\n"
+        "\\bibliography{folder-refs}\n\\end{document}\n")
+    assert (tmp_path/"Fig.1.pdf").exists() and not (tmp_path/"plot.pdf").exists()
+    assert (tmp_path/"folder-refs.bib").exists()
+    result = CliRunner().invoke(
+        elm.postprocess_latex,
+        ("--embed-bbl", str(tmp_path/"merged-clean.bbl"),
+         str(tmp_path/"final.tex"), str(tmp_path/"embedded.tex")))
+    assert (tmp_path/"embedded.tex").read_text() == (
+        "\\begin{document}\\includegraphics[width=2cm]{Fig.1.pdf} 50\\% text\n"
+        "\\begin{thebibliography}\n\\end{thebibliography}\n\n\\end{document}\n")
+    # Line by line comment stripping matches the tokenizer
+    for text in ["a%1\n%2\n b", "x%\n  \ny", "\\b%\n\tb", "a\n  %c\nb%"]:
+        stripped = "".join(elm.Strip_comments()(io.StringIO(text)))
+        assert stripped == elm.detokenize(elm.tokenize(text, strip_comments=True))
+
+def test_place_files(tmp_path):
+    (tmp_path/"flat").mkdir()
+    (tmp_path/"figures").mkdir()
+    for name in ["a", "b"]:
+        (tmp_path/"flat"/f"figures_{name}.pdf").write_text("pdf")
+        (tmp_path/"figures"/f"{name}.eps").write_text(f"eps {name}")
+    (tmp_path/"flat"/"figures_b.eps").write_text("stale")
+    result = CliRunner().invoke(
+        elm.cp_eps, (str(tmp_path/"flat"), str(tmp_path/"figures")),
+        catch_exceptions=False)
+    assert result.exit_code == 0
+    for name in ["a", "b"]:
+        assert (tmp_path/"flat"/f"figures_{name}.eps").read_text() == f"eps {name}"
+    src, dst = tmp_path/"figures"/"a.eps", tmp_path/"flat"/"figures_a.eps"
+    # Already placed: a hard link to src, or a reflink to be refreshed
+    assert elm.place_file(src, dst) in ["same", "reflink"]
+    assert elm.place_file(src, tmp_path/"copy.eps", hardlink=False) in [
+        "reflink", "copy"]
+    assert not (tmp_path/"copy.eps").samefile(src)
+    assert sorted(p.name for p in (tmp_path/"flat").iterdir()) == [
+        "figures_a.eps", "figures_a.pdf", "figures_b.eps", "figures_b.pdf"]
+
+def test_incremental_output_dir(tmp_path, monkeypatch):
+    (tmp_path/"src").mkdir()
+    write_project(tmp_path/"src", {
+        "main.tex": "\\documentclass{article}\n\\usepackage{defs-private}\n"
+                    "\\begin{document}\n\\includegraphics{plot}\n"
+                    "\\includegraphics{other}\n\\end{document}\n",
+        "defs-private.sty": "\\newcommand{\\hist}{H}\n",
+        "plot.pdf": "plot", "other.pdf": "other"})
+    monkeypatch.chdir(tmp_path/"src")
+    out = tmp_path/"out"
+    def run():
+        result = CliRunner().invoke(
+            elm.main, ("--incremental", "--no-cache", "--renamefigs", "",
+                       "main.tex", str(out)), catch_exceptions=False)
+        assert result.exit_code == 0
+        monkeypatch.chdir(tmp_path/"src")
+        return {p.name: p.stat().st_mtime_ns for p in out.iterdir()}
+    first = run()
+    assert "plot.pdf" in first and "other.pdf" in first
+    second = run()
+    for name in ["plot.pdf", "other.pdf", "merged.tex", "merged-clean.tex"]:
+        assert second[name] == first[name], name
+    assert "0 removed" in CliRunner().invoke(
+        elm.main, ("--incremental", "--no-cache", "--renamefigs", "",
+                   "main.tex", str(out))).output
+    monkeypatch.chdir(tmp_path/"src")
+    # Changed and removed assets
+    (tmp_path/"src"/"plot.pdf").write_text("new plot")
+    main = (tmp_path/"src"/"main.tex").read_text()
+    (tmp_path/"src"/"main.tex").write_text(
+        main.replace("\\includegraphics{other}\n", ""))
+    third = run()
+    assert "other.pdf" not in third
+    assert (out/"plot.pdf").read_text() == "new plot"
+
+def test_incremental_renamed_figures(tmp_path, monkeypatch):
+    (tmp_path/"src").mkdir()
+    write_project(tmp_path/"src", {
+        "main.tex": "\\includegraphics{plot}\n\\includegraphics{other}\n",
+        "plot.pdf": "plot", "other.pdf": "other"})
+    out = tmp_path/"out"
+    def run():
+        monkeypatch.chdir(tmp_path/"src")
+        result = CliRunner().invoke(
+            elm.main, ("--incremental", "--no-cache", "main.tex", str(out)),
+            catch_exceptions=False)
+        assert result.exit_code == 0
+        return result.output
+    def figures():
+        return {p.name: p.stat().st_mtime_ns for p in out.glob("*.pdf")}
+    run()
+    first = figures()
+    assert sorted(first) == ["figure_1.pdf", "figure_2.pdf"]
+    assert (out/"figure_1.pdf").read_text() == "plot"
+    # The renamed figures are not placed again
+    output = run()
+    assert "written: %s" % (out/"plot.pdf") not in output
+    assert "0 figures moved" in output
+    assert figures() == first
+    # The renamed file of a figure no longer included is removed
+    (tmp_path/"src"/"main.tex").write_text("\\includegraphics{other}\n")
+    run()
+    assert (out/"figure_1.pdf").read_text() == "other"
+    assert not (out/"figure_2.pdf").exists()
+    assert not (out/"plot.pdf").exists()
+
+def test_filter_mode(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("EXPAND_LATEX_MACROS_CACHE", str(tmp_path/"cache"))
+    (tmp_path/"macros.sty").write_text(nested_defs)
+    text = ("\\c and \\b{1} \\input ch2\n\n\\f% comment\n\n{x}\n\n\\input{file}"
+            " \\begin{box}{2}\n\nin\n\n\\end{box}\n")
+    for engine in ["compiled", "sparse", "reference"]:
+        result = CliRunner().invoke(
+            elm.expand_filter, ("--defs", "macros.sty", "--engine", engine),
+            input=text, catch_exceptions=False)
+        assert result.exit_code == 0
+        assert result.stdout == (
+            "A{x}A and A{1}A \\input ch2\n\n[x]\n\n"
+            "\\input{file} A{x}A<2|\n\nin\n\n|A>\n")
+        expander = elm.Expander.from_files(["macros.sty"], engine=engine)
+        assert (expander.expand("\\a \\input chapter \\input{ch}")
+                == "A \\input chapter \\input{ch}")
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["macros.sty"]
+    # Blocks are expanded as soon as they are complete
+    ts = elm.Tex_stream()
+    ts.defs = ({}, {})
+    ts.add_defs("macros")
+    read = []
+    def lines():
+        for line in ["\\a\n", "\n", "\\f\n", "\n", "{y}\n", "\n", "end\n"]:
+            read.append(line)
+            yield line
+    chunks = ts.filter_chunks(lines())
+    assert next(chunks) == "A\n" and len(read) == 2
+    assert "".join(chunks) == "\n[y]\n\nend\n"
+
+def test_expander_is_reentrant(tmp_path, monkeypatch):
+    import random, sys
+    from concurrent.futures import ThreadPoolExecutor
+    monkeypatch.chdir(tmp_path)
+    (tmp_path/"macros.sty").write_text(nested_defs)
+    # A package redefining \a must only affect the text which loads it
+    (tmp_path/"other-private.sty").write_text("\\renewcommand{\\a}{Z}\n")
+    texts = [r"\c \b{\c} \g{\f} \f{\a}",
+             r"\begin{box}{\c}in \c\end{box} \begin{box}{1}\a\end{box}",
+             "\\usepackage{other-private}\n\\a \\b{1} \\c",
+             "plain text % \\a\n\\a", ""]
+    for engine in ["compiled", "sparse", "reference"]:
+        expander = elm.Expander.from_files(["macros.sty"], engine=engine)
+        # The definitions are compiled up front: calls never modify them
+        definitions = [d for defs in expander.defs for d in defs.values()]
+        compiled = [(d.compiled, id(d.resolved)) for d in definitions]
+        assert all(c == (engine != "reference") for c, _ in compiled)
+        expected = [expander.expand(text) for text in texts]
+        assert expected[0] == "A{x}A A{A{x}A}A [y] [A]"
+        assert expected[2] == "\nZ Z{1}Z Z{x}Z"
+        jobs = list(range(len(texts))) * 40
+        random.Random(0).shuffle(jobs)
+        switchinterval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)  # Interleave the threads as much as possible
+        try:
+            with ThreadPoolExecutor(16) as executor:
+                results = list(executor.map(
+                    lambda i: expander.expand(texts[i]), jobs))
+        finally:
+            sys.setswitchinterval(switchinterval)
+        assert results == [expected[i] for i in jobs]
+        assert expander.expand(texts[0]) == expected[0]
+        assert [(d.compiled, id(d.resolved)) for d in definitions] == compiled
+    # Streams don't share definitions unless asked to
+    assert elm.Tex_stream().defs is not elm.Tex_stream().defs
+
+def test_expansion_budget(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path/"bomb.sty").write_text(
+        "\\newcommand{\\lol}[1]{#1#1#1#1#1#1#1#1}\n"
+        "\\newcommand{\\a}{A}\n")
+    bomb = "\\a " + "\\lol{" * 7 + "ha" + "}" * 7
+    for engine in ["compiled", "sparse", "reference"]:
+        expander = elm.Expander.from_files(["bomb.sty"], engine=engine)
+        # A generous budget does not change the expansion
+        budget = elm.Expansion_budget(max_expansions=10, max_ratio=2)
+        assert expander.expand("\\a \\a", budget) == "A A"
+        assert budget.expansions >= 2
+        for limit, value in [("max_expansions", 5), ("max_ratio", 50),
+                             ("max_macro_tokens", 1000),
+                             ("max_seconds", 0)]:
+            budget = elm.Expansion_budget(**{limit: value})
+            with pytest.raises(elm.Expansion_limit_error) as e:
+                expander.expand(bomb, budget)
+            assert e.value.limit == limit
+            if limit != "max_seconds":  # may run out before any expansion
+                assert e.value.macro == "\\lol", engine
+        budget = elm.Expansion_budget()
+        budget.cancel()
+        with pytest.raises(elm.Expansion_cancelled):
+            expander.expand("\\a", budget)
+        # Each call counts once, whatever the engine
+        budget = elm.Expansion_budget(max_expansions=4)
+        text = "\\a \\lol{x} \\a \\a"
+        assert expander.expand(text, budget) == "A " + "x" * 8 + " A A"
+        assert budget.expansions == 4
+        with pytest.raises(elm.Expansion_limit_error):
+            expander.expand(text, elm.Expansion_budget(max_expansions=3))
+
+    result = CliRunner().invoke(elm.expand_filter,
+                                ["--defs", "bomb.sty", "--max-ratio", "50"],
+                                input=bomb)
+    assert result.exit_code == 1
+    assert "\\lol" in result.output
+
+    # A bomb in the definitions themselves is limited when compiled
+    names = ["x" + chr(97 + i) for i in range(26)]
+    chain = r"\newcommand{\xa}{ab}" + "".join(
+        r"\newcommand{\%s}{\%s\%s}" % (name, prev, prev)
+        for prev, name in zip(names, names[1:]))
+    (tmp_path/"chain.sty").write_text(chain)
+    (tmp_path/"chain-private.sty").write_text(chain)
+    result = CliRunner().invoke(elm.expand_filter,
+                                ["--defs", "chain.sty", "--no-cache",
+                                 "--timeout", "1"], input="hello")
+    assert result.exit_code == 0 and result.output == "hello"
+    result = CliRunner().invoke(elm.expand_filter,
+                                ["--defs", "chain.sty", "--no-cache",
+                                 "--max-macro-tokens", "1000"], input="\\xz")
+    assert result.exit_code == 1
+    assert "\\x" in result.output
+    budget = elm.Expansion_budget()
+    budget.cancel()
+    with pytest.raises(elm.Expansion_cancelled):
+        elm.Expander.from_files(["chain.sty"], budget=budget)
+    for engine in ["compiled", "sparse", "reference"]:
+        expander = elm.Expander(({}, {}), engine=engine)
+        budget = elm.Expansion_budget(max_expansions=100)
+        with pytest.raises(elm.Expansion_limit_error):
+            expander.expand("\\usepackage{chain-private}\\xz", budget)
+
+def test_async_expander(tmp_path, monkeypatch):
+    import asyncio, time
+    (tmp_path/"bomb.sty").write_text(
+        "\\newcommand{\\lol}[1]{#1#1#1#1#1#1#1#1}\n"
+        "\\newcommand{\\a}{A}\n")
+    doc = tmp_path/"doc"
+    doc.mkdir()
+    (doc/"mine-private.sty").write_text("\\newcommand{\\b}{B}\n")
+    (doc/"doc.tex").write_text("\\usepackage{mine-private}\\a \\b")
+    bomb = "\\lol{" * 8 + "ha" + "}" * 8
+    # The service does not run in the directory of the documents
+    monkeypatch.chdir(tmp_path)
+
+    async def run():
+        async with await elm.Async_expander.from_files(
+                [tmp_path/"bomb.sty"], max_concurrent=1,
+                max_pending=1) as expander:
+            texts = await asyncio.gather(
+                *[expander.expand_text("\\a%d" % i) for i in range(3)],
+                return_exceptions=True)
+            # One call runs, one waits, and the third is rejected
+            assert texts[:2] == ["A0", "A1"]
+            assert isinstance(texts[2], elm.Expander_busy)
+            out = tmp_path/"doc-clean.tex"
+            assert await expander.expand_file(doc/"doc.tex", out) == "A B"
+            assert out.read_text() == "A B"
+            # A cancelled expansion stops, and frees its slot
+            start = time.monotonic()
+            with pytest.raises(asyncio.TimeoutError):
+                await asyncio.wait_for(expander.expand_text(bomb), 0.1)
+            assert await expander.expand_text("\\a") == "A"
+            assert time.monotonic() - start < 2
+
+    asyncio.run(run())
+
+def test_pipeline(tmp_path):
+    import threading, time
+    barrier = threading.Barrier(2, timeout=10)
+    (tmp_path/"in.txt").write_text("input")
+    runs = []
+    def stage(name, wait=False, fail=False):
+        def run():
+            runs.append(name)
+            if wait:
+                barrier.wait()  # Only returns if both stages run at once
+            if fail:
+                raise ValueError("broken")
+            time.sleep(0.05 if "c" == name else 0)
+            (tmp_path/(name + ".out")).write_text(name + str(len(runs)))
+            return [tmp_path/(name + ".out")]
+        return run
+    def pipeline(fail=False):
+        return elm.Pipeline(
+            [elm.Pipeline_stage("c", stage("c"), deps=["a", "b"]),
+             elm.Pipeline_stage("a", stage("a", wait=True),
+                                inputs=[tmp_path/"in.txt"]),
+             elm.Pipeline_stage("b", stage("b", wait=True, fail=fail)),
+             elm.Pipeline_stage("d", stage("d"), deps=["a"])],
+            cache_file=tmp_path/"cache.json")
+    p = pipeline()
+    p.run()
+    assert sorted(runs) == ["a", "b", "c", "d"]
+    path, seconds = p.critical_path()
+    assert path[-1] == "c" and seconds >= 0.05
+    # Nothing changed: all stages are skipped
+    runs.clear()
+    p = pipeline()
+    p.run()
+    assert runs == []
+    assert all(record["cached"] for record in p.records.values())
+    # Only the stages which depend on a changed file run again
+    (tmp_path/"in.txt").write_text("changed")
+    barrier = threading.Barrier(1)
+    pipeline().run()
+    assert sorted(runs) == ["a", "c", "d"]
+    # A failed stage stops the stages depending on it
+    (tmp_path/"b.out").unlink()
+    runs.clear()
+    barrier = threading.Barrier(1)
+    with pytest.raises(elm.Pipeline_error) as e:
+        pipeline(fail=True).run()
+    assert "b" == e.value.stage and "c" not in runs
+    with pytest.raises(ValueError):
+        elm.Pipeline([elm.Pipeline_stage("x", None, deps=["y"]),
+                      elm.Pipeline_stage("y", None, deps=["x"])])
+
+def test_prepare_final(tmp_path, monkeypatch):
+    import json, sys
+    paper = tmp_path/"paper"
+    (paper/"figures").mkdir(parents=True)
+    write_project(paper, {
+        "defs-private.sty": "\\newcommand{\\hello}{Hello}\n",
+        "main.tex": "\\usepackage{defs-private}\n\\hello{} world % note\n"
+                    "\\includegraphics{figures/fig1}\n"})
+    (paper/"figures"/"fig1.pdf").write_text("%PDF\n")
+    (paper/"figures"/"fig1.eps").write_text("%!PS\n")
+    monkeypatch.chdir(paper)
+    gs = f"{sys.executable} {path.join(here, 'fake_gs.py')}"
+    args = ("--figdir", "figures", "--no-latex", "--backend", "persistent",
+            "--gs", gs, "--figprefix", "Figure.{}", "--report",
+            "../report.json", "main.tex", "../flat")
+    result = CliRunner().invoke(elm.prepare_final, args,
+                                catch_exceptions=False)
+    assert result.exit_code == 0
+    final = tmp_path/"flat"/"final"
+    assert (final/"final.tex").read_text() == (
+        "\nHello{} world \\includegraphics{Figure.1.eps}\n")
+    assert (final/"Figure.1.eps").read_text() == "%CMYK\n%!PS\n"
+    assert (paper/"figures"/"fig1.eps").read_text() == "%!PS\n"
+    report = json.loads((tmp_path/"report.json").read_text())
+    assert set(report["stages"]) == {"expand", "convert", "assemble",
+                                     "finalize"}
+    assert report["critical_path"][-1] == "finalize"
+    # Rerun after editing the definitions: the figures are not converted
+    # again
+    (paper/"defs-private.sty").write_text("\\newcommand{\\hello}{Hi}\n")
+    result = CliRunner().invoke(elm.prepare_final, args,
+                                catch_exceptions=False)
+    assert result.exit_code == 0
+    report = json.loads((tmp_path/"report.json").read_text())
+    assert report["stages"]["convert"]["cached"]
+    assert not report["stages"]["expand"]["cached"]
+    assert "Hi{} world" in (final/"final.tex").read_text()
+    assembled = tmp_path/"flat"/".prepare-final"/"assembled"
+    names = {p.name for p in assembled.iterdir()}
+    assert "merged-clean.tex" in names
+    assert not names & {"merged", "merged.db", "merged.dat", "merged.dir",
+                        "merged.bak", "merged.lock", "defs-private.sty"}
+
+def test_prepare_final_latex(tmp_path, monkeypatch):
+    import json
+    (tmp_path/"paper").mkdir()
+    monkeypatch.chdir(tmp_path/"paper")
+    def run_tool(command, cwd, ok_codes=(0,)):
+        # Stands for latex, bibtex, dvips and ps2pdf
+        outputs = {"bibtex": "merged-clean.bbl", "dvips": "final.ps",
+                   "ps2pdf": "final.pdf"}
+        if command[0] in outputs:
+            source = path.join(cwd, "final.tex")
+            text = open(source).read() if path.exists(source) else ""
+            with open(path.join(cwd, outputs[command[0]]), "w") as fp:
+                fp.write(text)
+    monkeypatch.setattr(elm, "_run_tool", run_tool)
+    args = ("--report", "../report.json", "main.tex", "../flat")
+    for text in ["Hello world", "Goodbye world"]:
+        (tmp_path/"paper"/"main.tex").write_text(text + "\n")
+        result = CliRunner().invoke(elm.prepare_final, args,
+                                    catch_exceptions=False)
+        assert result.exit_code == 0
+        # The .bbl does not change, but the text does
+        final = tmp_path/"flat"/"final"
+        assert text in (final/"final.tex").read_text()
+        assert text in (final/"final.pdf").read_text()
+    report = json.loads((tmp_path/"report.json").read_text())
+    assert not report["stages"]["finalize"]["cached"]
+    assert not report["stages"]["pdf"]["cached"]
+
+def test_analyze(tmp_path, monkeypatch):
+    import json
+    write_project(tmp_path, {
+        "defs-private.sty": nested_defs,
+        "main.tex": "\\usepackage{defs-private}\n\\c % \\a\n\\input{ch1}\n"
+                    "\\begin{box}{1} \\f{2}\\end{box}\n\\input{ch1}\n",
+        "ch1.tex": "One\n\\f{\\c}\\c\n"})
+    monkeypatch.chdir(tmp_path)
+    result = CliRunner().invoke(elm.analyze, ("--no-cache", "--json",
+                                              "report.json", "main.tex"),
+                                catch_exceptions=False)
+    assert result.exit_code == 0
+    report = json.loads((tmp_path/"report.json").read_text())
+    assert report["files"] == ["main.tex", "ch1.tex", "ch1.tex"]
+    assert report["uses"]["\\c"] == {
+        "count": 5, "positions": ["main.tex:2", "ch1.tex:2", "ch1.tex:2",
+                                  "ch1.tex:2", "ch1.tex:2"]}
+    assert report["uses"]["{box}"]["positions"] == ["main.tex:4"]
+    assert report["uses"]["\\f"]["count"] == 3
+    assert report["unused"] == ["\\g"]
+    assert report["indirectly_used"] == ["\\a", "\\b"]
+    # \c expands to 5 tokens: A{x}A
+    assert report["hot_spots"][0] == {"macro": "\\c", "count": 5,
+                                      "tokens_per_use": 5, "tokens": 25}
+    assert report["busiest_lines"][0] == {"position": "ch1.tex:2",
+                                          "count": 6}
+    assert "Unused definitions:\n  \\g" in result.output